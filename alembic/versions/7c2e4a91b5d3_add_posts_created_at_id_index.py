@@ -0,0 +1,29 @@
+"""add posts created_at id index
+
+Revision ID: 7c2e4a91b5d3
+Revises: 033eab0ede91
+Create Date: 2026-10-18 10:12:41.508311
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7c2e4a91b5d3'
+down_revision: Union[str, Sequence[str], None] = '033eab0ede91'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    #matches the feed order so keyset pagination is an index range scan instead of a sort
+    op.create_index('ix_posts_created_at_id', 'posts', [sa.text('created_at DESC'), sa.text('id DESC')])
+    pass
+
+
+def downgrade() -> None:
+    op.drop_index('ix_posts_created_at_id', table_name='posts')
+    pass
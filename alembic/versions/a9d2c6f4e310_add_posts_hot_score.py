@@ -0,0 +1,34 @@
+"""add posts hot score
+
+Revision ID: a9d2c6f4e310
+Revises: e5a1f3c8d924
+Create Date: 2026-10-18 20:24:11.402118
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a9d2c6f4e310'
+down_revision: Union[str, Sequence[str], None] = 'e5a1f3c8d924'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+#same expression as models.HOT_SCORE_EXPRESSION, copied so later changes to the model dont rewrite this migration
+HOT_SCORE_EXPRESSION = "log(greatest(vote_count, 1)) + (extract(epoch from (created_at at time zone 'UTC')) - 1134028003) / 45000.0"
+
+
+def upgrade() -> None:
+    #generated column--> computed for every existing post here(rewrites the table), then kept exact by postgres on every vote_count update
+    op.add_column('posts', sa.Column('hot_score', sa.Float(precision=53), sa.Computed(HOT_SCORE_EXPRESSION, persisted=True)))
+    op.create_index('ix_posts_hot_score_id', 'posts', [sa.text('hot_score DESC'), sa.text('id DESC')])
+    pass
+
+
+def downgrade() -> None:
+    op.drop_index('ix_posts_hot_score_id', table_name='posts')
+    op.drop_column('posts', 'hot_score')
+    pass
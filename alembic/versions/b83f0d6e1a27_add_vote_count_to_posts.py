@@ -0,0 +1,34 @@
+"""add vote_count to posts
+
+Revision ID: b83f0d6e1a27
+Revises: 7c2e4a91b5d3
+Create Date: 2026-10-18 11:03:27.164902
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b83f0d6e1a27'
+down_revision: Union[str, Sequence[str], None] = '7c2e4a91b5d3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('posts', sa.Column('vote_count', sa.Integer(), nullable=False, server_default='0'))
+    #backfill from the existing votes, posts without votes keep the default 0
+    op.execute("""
+        UPDATE posts SET vote_count = v.total
+        FROM (SELECT post_id, COUNT(*) AS total FROM votes GROUP BY post_id) AS v
+        WHERE posts.id = v.post_id
+    """)
+    pass
+
+
+def downgrade() -> None:
+    op.drop_column('posts', 'vote_count')
+    pass
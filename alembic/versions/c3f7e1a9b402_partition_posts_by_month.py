@@ -0,0 +1,175 @@
+"""partition posts by month
+
+Revision ID: c3f7e1a9b402
+Revises: a9d2c6f4e310
+Create Date: 2026-10-18 21:12:40.318554
+
+"""
+from typing import Sequence, Union
+from datetime import datetime, timezone
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c3f7e1a9b402'
+down_revision: Union[str, Sequence[str], None] = 'a9d2c6f4e310'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+#copied here so later changes to the model/app.partitions dont rewrite this migration
+SEARCH_VECTOR_EXPRESSION = "setweight(to_tsvector('english', coalesce(title, '')), 'A') || setweight(to_tsvector('english', coalesce(content, '')), 'B')"
+HOT_SCORE_EXPRESSION = "log(greatest(vote_count, 1)) + (extract(epoch from (created_at at time zone 'UTC')) - 1134028003) / 45000.0"
+COLUMNS = "id, title, content, published, created_at, owner_id, vote_count"
+MONTHS_AHEAD = 3   #python -m app.maintenance create-partitions keeps this up from here on
+
+
+def _add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def _create_indexes(bind):
+    #on the partitioned table, postgres creates them on every partition(and on every partition created later)
+    op.create_index('ix_posts_created_at_id', 'posts', [sa.text('created_at DESC'), sa.text('id DESC')])
+    op.create_index('ix_posts_search_vector', 'posts', ['search_vector'], postgresql_using='gin')
+    op.create_index('ix_posts_hot_score_id', 'posts', [sa.text('hot_score DESC'), sa.text('id DESC')])
+    if bind.execute(sa.text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).scalar():
+        op.create_index('ix_posts_title_trgm', 'posts', ['title'], postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'})
+
+
+def _drop_indexes():
+    for index in ('ix_posts_created_at_id', 'ix_posts_search_vector', 'ix_posts_hot_score_id', 'ix_posts_title_trgm'):
+        op.execute(f'DROP INDEX IF EXISTS {index}')
+
+
+def upgrade() -> None:
+    #the whole table is copied once inside this transaction and posts is locked meanwhile, plan a maintenance window for big tables
+    bind = op.get_bind()
+
+    #a foreign key needs a unique key on posts.id alone, a partitioned table can only have unique keys that include created_at
+    #so votes.post_id is checked by triggers instead(end of this function)
+    op.drop_constraint('votes_post_id_fkey', 'votes', type_='foreignkey')
+    _drop_indexes()   #copying without them is faster, they are rebuilt on the new table
+    op.execute('ALTER TABLE posts RENAME TO posts_unpartitioned')
+    op.execute('ALTER TABLE posts_unpartitioned RENAME CONSTRAINT posts_pkey TO posts_unpartitioned_pkey')
+    op.execute('ALTER SEQUENCE posts_id_seq OWNED BY NONE')   #keeps the sequence(and the next id) when the old table is dropped
+
+    op.execute(f"""
+        CREATE TABLE posts (
+            id integer NOT NULL DEFAULT nextval('posts_id_seq'),
+            title varchar NOT NULL,
+            content varchar NOT NULL,
+            owner_id integer NOT NULL,
+            published boolean NOT NULL DEFAULT true,
+            created_at timestamptz NOT NULL DEFAULT now(),
+            vote_count integer NOT NULL DEFAULT 0,
+            search_vector tsvector GENERATED ALWAYS AS ({SEARCH_VECTOR_EXPRESSION}) STORED,
+            hot_score double precision GENERATED ALWAYS AS ({HOT_SCORE_EXPRESSION}) STORED,
+            CONSTRAINT posts_pkey PRIMARY KEY (id, created_at),
+            CONSTRAINT post_users_fk FOREIGN KEY (owner_id) REFERENCES users(id) ON DELETE CASCADE
+        ) PARTITION BY RANGE (created_at)
+    """)
+    op.execute('ALTER SEQUENCE posts_id_seq OWNED BY posts.id')
+
+    #one partition for every utc month that has posts and for this month and a few ahead
+    #no default partition, it would stop postgres from reading the partitions in feed order(see app/partitions.py)
+    months = {month.replace(tzinfo=timezone.utc) for month in bind.execute(sa.text(
+        "SELECT DISTINCT date_trunc('month', created_at AT TIME ZONE 'UTC') FROM posts_unpartitioned")).scalars()}
+    now = datetime.now(timezone.utc)
+    months.update(_add_months(datetime(now.year, now.month, 1, tzinfo=timezone.utc), offset) for offset in range(MONTHS_AHEAD + 1))
+    for month in sorted(months):
+        op.execute(f"CREATE TABLE posts_y{month.year}m{month.month:02d} PARTITION OF posts "
+                   f"FOR VALUES FROM ('{month.isoformat()}') TO ('{_add_months(month, 1).isoformat()}')")
+
+    op.execute(f'INSERT INTO posts ({COLUMNS}) SELECT {COLUMNS} FROM posts_unpartitioned')
+    op.execute('DROP TABLE posts_unpartitioned')
+    _create_indexes(bind)
+
+    #old months moved out by python -m app.maintenance archive-posts, read only and only looked up by id(GET /posts/{id})
+    #so no search_vector/hot_score and no index besides the primary key, about a third of the size of the same rows in posts
+    op.execute("""
+        CREATE TABLE posts_archive (
+            id integer NOT NULL,
+            title varchar NOT NULL,
+            content varchar NOT NULL,
+            owner_id integer NOT NULL,
+            published boolean NOT NULL,
+            created_at timestamptz NOT NULL,
+            vote_count integer NOT NULL,
+            CONSTRAINT posts_archive_pkey PRIMARY KEY (id),
+            CONSTRAINT posts_archive_users_fk FOREIGN KEY (owner_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+    """)
+    #long posts are compressed by toast, lz4 decompresses several times faster than the default pglz(only there when postgres was built with it)
+    has_lz4 = bind.execute(sa.text("SELECT 'lz4' = ANY(enumvals) FROM pg_settings WHERE name = 'default_toast_compression'")).scalar()
+    if has_lz4:
+        op.execute('ALTER TABLE posts_archive ALTER COLUMN title SET COMPRESSION lz4, ALTER COLUMN content SET COMPRESSION lz4')
+
+    #what the votes.post_id foreign key did--> a vote needs its post(locked FOR KEY SHARE like the foreign key check, so the post
+    #cant be deleted before the vote commits) and deleting a post deletes its votes
+    op.create_index('ix_votes_post_id', 'votes', ['post_id'])   #the delete trigger finds a post's votes with it
+    op.execute("""
+        CREATE FUNCTION votes_check_post() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            PERFORM 1 FROM posts WHERE id = NEW.post_id FOR KEY SHARE;
+            IF NOT FOUND THEN
+                RAISE foreign_key_violation USING MESSAGE = format('post %s does not exist', NEW.post_id);
+            END IF;
+            RETURN NEW;
+        END $$
+    """)
+    op.execute('CREATE TRIGGER votes_check_post BEFORE INSERT OR UPDATE OF post_id ON votes FOR EACH ROW EXECUTE FUNCTION votes_check_post()')
+    #AFTER DELETE doesnt fire when an UPDATE of created_at moves a row to another partition, and detaching a partition fires nothing
+    op.execute("""
+        CREATE FUNCTION posts_delete_votes() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            DELETE FROM votes WHERE post_id = OLD.id;
+            RETURN NULL;
+        END $$
+    """)
+    op.execute('CREATE TRIGGER posts_delete_votes AFTER DELETE ON posts FOR EACH ROW EXECUTE FUNCTION posts_delete_votes()')
+    op.execute('CREATE TRIGGER posts_archive_delete_votes AFTER DELETE ON posts_archive FOR EACH ROW EXECUTE FUNCTION posts_delete_votes()')
+    pass
+
+
+def downgrade() -> None:
+    #archived posts go back into the plain table too
+    bind = op.get_bind()
+    op.execute('DROP TRIGGER posts_archive_delete_votes ON posts_archive')
+    op.execute('DROP TRIGGER posts_delete_votes ON posts')
+    op.execute('DROP TRIGGER votes_check_post ON votes')
+    op.execute('DROP FUNCTION posts_delete_votes()')
+    op.execute('DROP FUNCTION votes_check_post()')
+    op.drop_index('ix_votes_post_id', table_name='votes')
+
+    _drop_indexes()
+    op.execute('ALTER TABLE posts RENAME TO posts_partitioned')
+    op.execute('ALTER TABLE posts_partitioned RENAME CONSTRAINT posts_pkey TO posts_partitioned_pkey')
+    op.execute('ALTER SEQUENCE posts_id_seq OWNED BY NONE')
+    op.execute(f"""
+        CREATE TABLE posts (
+            id integer NOT NULL DEFAULT nextval('posts_id_seq'),
+            title varchar NOT NULL,
+            content varchar NOT NULL,
+            owner_id integer NOT NULL,
+            published boolean NOT NULL DEFAULT true,
+            created_at timestamptz NOT NULL DEFAULT now(),
+            vote_count integer NOT NULL DEFAULT 0,
+            search_vector tsvector GENERATED ALWAYS AS ({SEARCH_VECTOR_EXPRESSION}) STORED,
+            hot_score double precision GENERATED ALWAYS AS ({HOT_SCORE_EXPRESSION}) STORED,
+            CONSTRAINT posts_pkey PRIMARY KEY (id),
+            CONSTRAINT post_users_fk FOREIGN KEY (owner_id) REFERENCES users(id) ON DELETE CASCADE
+        )
+    """)
+    op.execute('ALTER SEQUENCE posts_id_seq OWNED BY posts.id')
+    op.execute(f'INSERT INTO posts ({COLUMNS}) SELECT {COLUMNS} FROM posts_partitioned UNION ALL SELECT {COLUMNS} FROM posts_archive')
+    op.execute('DROP TABLE posts_partitioned')   #its partitions go with it
+    op.execute('DROP TABLE posts_archive')
+    _create_indexes(bind)
+
+    #partitions detached with archive-posts --detach-only are gone for good, their votes cant keep a foreign key
+    op.execute('DELETE FROM votes WHERE NOT EXISTS (SELECT 1 FROM posts WHERE posts.id = votes.post_id)')
+    op.create_foreign_key('votes_post_id_fkey', 'votes', 'posts', ['post_id'], ['id'], ondelete='CASCADE')
+    pass
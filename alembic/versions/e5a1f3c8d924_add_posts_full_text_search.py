@@ -0,0 +1,42 @@
+"""add posts full text search
+
+Revision ID: e5a1f3c8d924
+Revises: b83f0d6e1a27
+Create Date: 2026-10-18 13:26:05.771930
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5a1f3c8d924'
+down_revision: Union[str, Sequence[str], None] = 'b83f0d6e1a27'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    #generated column, postgres keeps it up to date on every insert/update of title or content
+    op.add_column('posts', sa.Column('search_vector', postgresql.TSVECTOR(), sa.Computed(
+        "setweight(to_tsvector('english', coalesce(title, '')), 'A') || setweight(to_tsvector('english', coalesce(content, '')), 'B')",
+        persisted=True)))
+    op.create_index('ix_posts_search_vector', 'posts', ['search_vector'], postgresql_using='gin')
+
+    #pg_trgm ships with the standard postgres images, but some minimal builds dont have it
+    #without it substring search still works, it just isnt indexed
+    has_trgm = op.get_bind().execute(sa.text("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")).scalar()
+    if has_trgm:
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        op.create_index('ix_posts_title_trgm', 'posts', ['title'], postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'})
+    pass
+
+
+def downgrade() -> None:
+    op.execute('DROP INDEX IF EXISTS ix_posts_title_trgm')
+    op.drop_index('ix_posts_search_vector', table_name='posts')
+    op.drop_column('posts', 'search_vector')
+    pass
@@ -0,0 +1,119 @@
+"""move posts hot score to post_scores
+
+Revision ID: f6b1d8e3a572
+Revises: c3f7e1a9b402
+Create Date: 2026-10-19 09:41:52.730164
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f6b1d8e3a572'
+down_revision: Union[str, Sequence[str], None] = 'c3f7e1a9b402'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+#copied from a9d2c6f4e310 for the downgrade
+HOT_SCORE_EXPRESSION = "log(greatest(vote_count, 1)) + (extract(epoch from (created_at at time zone 'UTC')) - 1134028003) / 45000.0"
+FILLFACTOR = 90   #same as app.partitions.FILLFACTOR, which new partitions get
+
+
+def _partitions(bind):
+    return bind.execute(sa.text("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                                "WHERE i.inhparent = 'posts'::regclass")).scalars().all()
+
+
+def upgrade() -> None:
+    #the indexed posts.hot_score changed with every vote, so no vote could be a HOT update and each one added entries to every
+    #index on posts, the two GIN ones included. the score now lives in post_scores, a vote updates posts without touching an
+    #indexed column and rewrites one narrow post_scores row(its primary key and score index)
+    op.execute('LOCK TABLE posts IN SHARE ROW EXCLUSIVE MODE')   #no post is written between the copy below and the triggers
+
+    op.execute(f"""
+        CREATE FUNCTION post_hot_score(vote_count integer, created_at timestamptz) RETURNS double precision
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$ SELECT {HOT_SCORE_EXPRESSION} $$
+    """)
+    #created_at so the join back to posts can pick the partition
+    op.execute("""
+        CREATE TABLE post_scores (
+            post_id integer NOT NULL,
+            created_at timestamptz NOT NULL,
+            hot_score double precision NOT NULL,
+            CONSTRAINT post_scores_pkey PRIMARY KEY (post_id)
+        )
+    """)
+    op.execute('INSERT INTO post_scores (post_id, created_at, hot_score) SELECT id, created_at, post_hot_score(vote_count, created_at) FROM posts')
+    op.create_index('ix_post_scores_hot_score_post_id', 'post_scores', [sa.text('hot_score DESC'), sa.text('post_id DESC')])
+
+    #statement level with transition tables, a bulk import or a vote batch is one INSERT/UPDATE here however many posts it has
+    #TRUNCATE posts fires no delete trigger, so it has its own. detaching a partition fires nothing at all,
+    #app.partitions.archive_partitions deletes the month's scores itself
+    op.execute("""
+        CREATE FUNCTION posts_insert_scores() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            INSERT INTO post_scores (post_id, created_at, hot_score)
+            SELECT id, created_at, post_hot_score(vote_count, created_at) FROM new_posts;
+            RETURN NULL;
+        END $$
+    """)
+    op.execute("""
+        CREATE FUNCTION posts_update_scores() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            UPDATE post_scores SET created_at = changed.created_at, hot_score = post_hot_score(changed.vote_count, changed.created_at)
+            FROM (SELECT n.id, n.created_at, n.vote_count FROM new_posts n JOIN old_posts o ON o.id = n.id
+                  WHERE n.vote_count <> o.vote_count OR n.created_at <> o.created_at) changed
+            WHERE post_scores.post_id = changed.id;
+            RETURN NULL;
+        END $$
+    """)
+    op.execute("""
+        CREATE FUNCTION posts_delete_scores() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            DELETE FROM post_scores WHERE post_id IN (SELECT id FROM old_posts);
+            RETURN NULL;
+        END $$
+    """)
+    op.execute("""
+        CREATE FUNCTION posts_truncate_scores() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            TRUNCATE post_scores;
+            RETURN NULL;
+        END $$
+    """)
+    op.execute('CREATE TRIGGER posts_insert_scores AFTER INSERT ON posts REFERENCING NEW TABLE AS new_posts '
+               'FOR EACH STATEMENT EXECUTE FUNCTION posts_insert_scores()')
+    op.execute('CREATE TRIGGER posts_update_scores AFTER UPDATE ON posts REFERENCING OLD TABLE AS old_posts NEW TABLE AS new_posts '
+               'FOR EACH STATEMENT EXECUTE FUNCTION posts_update_scores()')
+    op.execute('CREATE TRIGGER posts_delete_scores AFTER DELETE ON posts REFERENCING OLD TABLE AS old_posts '
+               'FOR EACH STATEMENT EXECUTE FUNCTION posts_delete_scores()')
+    op.execute('CREATE TRIGGER posts_truncate_scores AFTER TRUNCATE ON posts FOR EACH STATEMENT EXECUTE FUNCTION posts_truncate_scores()')
+
+    op.drop_index('ix_posts_hot_score_id', table_name='posts')
+    op.drop_column('posts', 'hot_score')
+    #and leave room for HOT updates in the existing partitions, only pages written from now on get it(VACUUM FULL rewrites the rest)
+    for partition in _partitions(op.get_bind()):
+        op.execute(f'ALTER TABLE {partition} SET (fillfactor = {FILLFACTOR})')
+    pass
+
+
+def downgrade() -> None:
+    #rewrites every partition to fill the generated column again
+    for partition in _partitions(op.get_bind()):
+        op.execute(f'ALTER TABLE {partition} RESET (fillfactor)')
+    op.add_column('posts', sa.Column('hot_score', sa.Float(precision=53), sa.Computed(HOT_SCORE_EXPRESSION, persisted=True)))
+    op.create_index('ix_posts_hot_score_id', 'posts', [sa.text('hot_score DESC'), sa.text('id DESC')])
+    op.execute('DROP TRIGGER posts_truncate_scores ON posts')
+    op.execute('DROP TRIGGER posts_delete_scores ON posts')
+    op.execute('DROP TRIGGER posts_update_scores ON posts')
+    op.execute('DROP TRIGGER posts_insert_scores ON posts')
+    op.execute('DROP FUNCTION posts_truncate_scores()')
+    op.execute('DROP FUNCTION posts_delete_scores()')
+    op.execute('DROP FUNCTION posts_update_scores()')
+    op.execute('DROP FUNCTION posts_insert_scores()')
+    op.drop_table('post_scores')
+    op.execute('DROP FUNCTION post_hot_score(integer, timestamptz)')
+    pass
@@ -0,0 +1,300 @@
+#bulk import/export of users, posts and votes as ndjson or csv through postgres COPY
+#shared by the admin endpoints(/admin) and the maintenance cli(python -m app.maintenance import/export)
+#
+#export--> COPY (SELECT ..) TO STDOUT streamed chunk by chunk, never more than a few chunks in memory
+#import--> rows are parsed as they arrive and written BULK_BATCH_SIZE at a time, each batch in its own transaction:
+#  COPY into a temp staging table(all text, postgres does the casting) --> one query finds references to missing users/posts
+#  --> INSERT .. SELECT .. into the real table, skipping rows whose key already exists(ON CONFLICT DO NOTHING, and for posts
+#  an explicit check of the id in posts and posts_archive, the partitioned primary key is (id, created_at) so it cant catch them)
+#  so running a batch twice changes nothing and an interrupted import can be resumed(or simply run again) without duplicates
+#  (as long as the rows carry their ids, like exports do), imported votes add to posts.vote_count only when they were really inserted
+import asyncio
+import csv
+import orjson
+from dataclasses import dataclass, field
+from datetime import timezone
+from .config import settings
+from . import database, partitions
+
+FORMATS = ("ndjson", "csv")
+
+
+@dataclass
+class Table:
+    name: str
+    columns: tuple
+    text_columns: tuple   #empty csv fields stay "" here, in every other column they mean NULL
+    export_query: str
+    missing_query: str = ""   #one row per staged row that references a user/post that doesnt exist
+    insert_query: str = ""
+    months_query: str = ""   #utc months the staged rows fall in, for tables partitioned by month(app/partitions.py)
+
+
+TABLES = {
+    "users": Table(
+        name="users",
+        columns=("id", "email", "password", "created_at"),
+        text_columns=("email", "password"),
+        export_query="SELECT id, email, password, created_at FROM users ORDER BY id",
+        #password is imported as it is, it must already be a hash(an export of another environment)
+        insert_query=(
+            "INSERT INTO users (id, email, password, created_at) "
+            "SELECT coalesce(s.id::int, nextval(pg_get_serial_sequence('users', 'id'))), s.email, s.password, "
+            "coalesce(s.created_at::timestamptz, now()) FROM {staging} s ON CONFLICT DO NOTHING RETURNING 1"
+        ),
+    ),
+    "posts": Table(
+        name="posts",
+        columns=("id", "title", "content", "published", "created_at", "owner_id"),
+        text_columns=("title", "content"),
+        #vote_count is not exported, it is rebuilt from the imported votes
+        export_query="SELECT id, title, content, published, created_at, owner_id FROM posts ORDER BY id",
+        missing_query="SELECT s.owner_id::int FROM {staging} s WHERE NOT EXISTS (SELECT 1 FROM users u WHERE u.id = s.owner_id::int)",
+        #a post is new when its id is in neither posts nor posts_archive(rows without created_at would get a new now() each run,
+        #archived posts arent in posts at all), an id repeated inside one batch is inserted once, rows without an id always are
+        insert_query=(
+            "INSERT INTO posts (id, title, content, published, created_at, owner_id) "
+            "SELECT coalesce(s.id::int, nextval(pg_get_serial_sequence('posts', 'id'))), s.title, s.content, "
+            "coalesce(s.published::boolean, true), coalesce(s.created_at::timestamptz, now()), s.owner_id::int "
+            "FROM (SELECT DISTINCT ON (coalesce(id, ctid::text)) * FROM {staging}) s "
+            "WHERE EXISTS (SELECT 1 FROM users u WHERE u.id = s.owner_id::int) "
+            "AND NOT EXISTS (SELECT 1 FROM posts p WHERE p.id = s.id::int) "
+            "AND NOT EXISTS (SELECT 1 FROM posts_archive a WHERE a.id = s.id::int) ON CONFLICT DO NOTHING RETURNING 1"
+        ),
+        months_query="SELECT DISTINCT date_trunc('month', coalesce(s.created_at::timestamptz, now()) AT TIME ZONE 'UTC') FROM {staging} s",
+    ),
+    "votes": Table(
+        name="votes",
+        columns=("user_id", "post_id"),
+        text_columns=(),
+        export_query="SELECT user_id, post_id FROM votes ORDER BY user_id, post_id",
+        missing_query=(
+            "SELECT s.user_id::int, s.post_id::int FROM {staging} s "
+            "WHERE NOT EXISTS (SELECT 1 FROM users u WHERE u.id = s.user_id::int) OR NOT EXISTS (SELECT 1 FROM posts p WHERE p.id = s.post_id::int)"
+        ),
+        #the same statement adds the inserted votes to vote_count, votes that already existed are not counted twice
+        insert_query=(
+            "WITH inserted AS ("
+            "INSERT INTO votes (user_id, post_id) SELECT s.user_id::int, s.post_id::int FROM {staging} s "
+            "WHERE EXISTS (SELECT 1 FROM users u WHERE u.id = s.user_id::int) AND EXISTS (SELECT 1 FROM posts p WHERE p.id = s.post_id::int) "
+            "ON CONFLICT DO NOTHING RETURNING post_id), "
+            "counts AS (SELECT post_id, count(*) AS added FROM inserted GROUP BY post_id), "
+            "updated AS (UPDATE posts SET vote_count = posts.vote_count + counts.added FROM counts WHERE posts.id = counts.post_id) "
+            "SELECT 1 FROM inserted"
+        ),
+    ),
+}
+
+
+class BulkImportError(Exception):
+    #the batch that failed was rolled back, everything before it is committed(rows_done) and the import can resume from there
+    def __init__(self, message: str, rows_done: int):
+        super().__init__(message)
+        self.rows_done = rows_done
+
+
+@dataclass
+class ImportResult:
+    table: str
+    rows_read: int = 0
+    inserted: int = 0
+    skipped_existing: int = 0
+    skipped_missing_references: int = 0
+    batches: int = 0
+    missing_references: list = field(default_factory=list)   #a sample, for the report
+
+    def as_dict(self):
+        return {key: value for key, value in self.__dict__.items()}
+
+
+def get_table(name: str):
+    if name not in TABLES:
+        raise ValueError(f"unknown table {name!r}, expected one of {', '.join(TABLES)}")
+    return TABLES[name]
+
+
+#export
+
+def export_query(table: Table, format: str):
+    #(query, COPY options) for connection.copy_from_query
+    if format == "csv":
+        return table.export_query, {"format": "csv", "header": True}
+    #one json object per line, written as csv with quote/delimiter characters json never contains unescaped
+    #so postgres copies the json text through untouched(text format would escape every backslash again)
+    return f"SELECT row_to_json(t) FROM ({table.export_query}) t", {"format": "csv", "quote": "\x01", "delimiter": "\x02"}
+
+
+async def export_chunks(table_name: str, format: str):
+    #async iterator of bytes, postgres is read only as fast as the consumer takes the chunks
+    query, options = export_query(get_table(table_name), format)
+    connection = await database.connect_raw()
+    chunks = asyncio.Queue(maxsize=8)
+    done = object()
+
+    async def copy():
+        try:
+            await connection.copy_from_query(query, output=chunks.put, **options)
+        finally:
+            await chunks.put(done)
+
+    copier = asyncio.create_task(copy())
+    try:
+        while True:
+            chunk = await chunks.get()
+            if chunk is done:
+                break
+            yield bytes(chunk)   #asyncpg hands out bytearrays
+        await copier   #raises if the COPY failed
+    finally:
+        copier.cancel()
+        await connection.close()
+
+
+#import
+
+async def _lines(chunks, offset: int):
+    #(line, byte offset right after it) from an async iterator of byte chunks, lines are split however the chunks fall
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            offset += len(line) + 1
+            yield line, offset
+    if buffer:
+        yield buffer, offset + len(buffer)
+
+
+def _text(value):
+    #ndjson values as the text postgres casts them from
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+class RowParser:
+    #turns byte chunks into row tuples in table.columns order, header is the csv header(passed back in when resuming)
+    def __init__(self, table: Table, format: str, header=None):
+        self.table = table
+        self.format = format
+        self.header = header
+
+    async def rows(self, chunks, offset: int = 0):
+        #yields (row, byte offset right after it)
+        if self.format == "ndjson":
+            async for line, end in _lines(chunks, offset):
+                if not line.strip():
+                    continue
+                record = orjson.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError(f"expected a json object per line, got {line[:80]!r}")
+                yield tuple(_text(record.get(column)) for column in self.table.columns), end
+            return
+
+        record = ""
+        async for line, end in _lines(chunks, offset):
+            record += line.decode()
+            if record.count('"') % 2:   #inside a quoted field, the newline belongs to the value
+                record += "\n"
+                continue
+            if record.strip():
+                values = next(csv.reader([record]))
+                if self.header is None:
+                    self.header = values
+                else:
+                    yield self._csv_row(dict(zip(self.header, values))), end
+            record = ""
+        if record.strip():
+            raise ValueError("csv ends inside a quoted field")
+
+    def _csv_row(self, values):
+        #csv cant tell NULL from an empty string, empty means NULL except in text columns
+        return tuple(values.get(column) if values.get(column) != "" or column in self.table.text_columns else None
+                     for column in self.table.columns)
+
+
+async def import_rows(table_name: str, format: str, chunks, offset: int = 0, header=None, skip_rows: int = 0,
+                      skip_missing: bool = False, batch_size: int = 0, on_batch=None):
+    #chunks--> async iterator of bytes(a file or a request body), offset--> where in the input they start
+    #skip_rows--> rows already imported by an earlier run that are read again(an http client resending the whole file)
+    #on_batch(result, offset, header) is awaited after every committed batch, the cli keeps its checkpoint with it
+    table = get_table(table_name)
+    batch_size = batch_size or settings.bulk_batch_size
+    staging = f"bulk_import_{table.name}"
+    parser = RowParser(table, format, header)
+    result = ImportResult(table=table.name)
+    connection = await database.connect_raw()
+    try:
+        #dropped with the connection, emptied by every commit
+        await connection.execute(f"CREATE TEMP TABLE {staging} ({', '.join(f'{column} text' for column in table.columns)}) ON COMMIT DELETE ROWS")
+
+        batch = []
+        async for row, end in parser.rows(chunks, offset):
+            if skip_rows:
+                skip_rows -= 1
+                continue
+            batch.append(row)
+            if len(batch) >= batch_size:
+                await _write_batch(connection, table, staging, batch, result, skip_missing)
+                batch = []
+                if on_batch is not None:
+                    await on_batch(result, end, parser.header)
+        if batch:
+            await _write_batch(connection, table, staging, batch, result, skip_missing)
+            if on_batch is not None:
+                await on_batch(result, end, parser.header)
+    finally:
+        await connection.close()
+    return result
+
+
+def _reference(row):
+    return tuple(row) if len(row) > 1 else row[0]
+
+
+async def _create_partitions(connection, table: Table, staging: str):
+    #posts only has partitions from its oldest post to a few months ahead, imported posts may fall outside them
+    existing = set(await connection.fetchval("SELECT array_agg(c.relname::text) FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                                             f"WHERE i.inhparent = '{table.name}'::regclass") or [])
+    for (month,) in await connection.fetch(table.months_query.format(staging=staging)):
+        month = month.replace(tzinfo=timezone.utc)
+        if partitions.partition_name(month) not in existing:
+            await connection.execute(partitions.create_partition_sql(month))
+
+
+async def _write_batch(connection, table: Table, staging: str, batch, result: ImportResult, skip_missing: bool):
+    rows = f"rows {result.rows_read + 1}-{result.rows_read + len(batch)}"
+    try:
+        async with connection.transaction():
+            await connection.copy_records_to_table(staging, records=batch, columns=table.columns)
+            missing = await connection.fetch(table.missing_query.format(staging=staging)) if table.missing_query else []
+            if missing and not skip_missing:
+                sample = list(dict.fromkeys(_reference(row) for row in missing))[:10]
+                raise BulkImportError(f"{rows}: {len(missing)} row(s) reference users/posts that dont exist, first: {sample}", result.rows_read)
+            if table.months_query:
+                await _create_partitions(connection, table, staging)
+            inserted = len(await connection.fetch(table.insert_query.format(staging=staging)))
+            #rows imported with their ids dont move the sequence, the next row created through the api would collide with them
+            #only ever forward--> max(id) is below the sequence when the newest rows were deleted or inserts burned values, going
+            #back would hand out those ids again and a reused post id would match old live subscriptions, cached pages and votes
+            if "id" in table.columns:
+                await connection.execute(
+                    f"SELECT setval(seq, top) FROM (SELECT pg_get_serial_sequence('{table.name}', 'id')::regclass AS seq, max(id) AS top "
+                    f"FROM {table.name}) s WHERE top > coalesce(pg_sequence_last_value(seq), 0)")
+    except BulkImportError:
+        raise
+    except Exception as error:
+        raise BulkImportError(f"{rows}: {error}", result.rows_read) from error
+
+    result.rows_read += len(batch)
+    result.inserted += inserted
+    result.skipped_missing_references += len(missing)
+    result.skipped_existing += len(batch) - inserted - len(missing)
+    result.batches += 1
+    for reference in dict.fromkeys(_reference(row) for row in missing):
+        if len(result.missing_references) >= 10:
+            break
+        if reference not in result.missing_references:
+            result.missing_references.append(reference)
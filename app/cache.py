@@ -0,0 +1,176 @@
+#small key/value caches for hot lookups, so repeated reads dont have to go to postgres
+#memory--> per process(default), redis--> shared between workers, picked with CACHE_BACKEND
+import time
+from collections import OrderedDict
+import json
+import logging
+import threading
+from typing import Any, Optional
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    #process local LRU with a max size, every entry also expires after its ttl
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()   #key--> (expires_at, value), oldest first
+        self._lock = threading.Lock()   #sync mode code runs on threadpool threads
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)   #mark as recently used
+            return value
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)   #evict the least recently used entry
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class CacheBackend:
+    #the interface every backend implements, values must be json serializable so they can go over the wire to redis
+    async def get(self, key: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        raise NotImplementedError
+
+    async def delete(self, key: str):
+        raise NotImplementedError
+
+    async def incr(self, key: str, amount: int = 1) -> int:
+        #counters never expire or get evicted, use them for things like cache generations
+        raise NotImplementedError
+
+
+class MemoryBackend(CacheBackend):
+    def __init__(self, max_size: int, ttl: float):
+        self.cache = TTLCache(max_size, ttl)
+        self.counters = {}
+
+    async def get(self, key):
+        return self.cache.get(key)
+
+    async def set(self, key, value, ttl=None):
+        self.cache.set(key, value, ttl)
+
+    async def delete(self, key):
+        self.cache.delete(key)
+
+    async def incr(self, key, amount=1):
+        self.counters[key] = self.counters.get(key, 0) + amount
+        return self.counters[key]
+
+
+class RedisBackend(CacheBackend):
+    #works with anything that speaks the redis.asyncio client api(a real redis, or fakeredis in tests)
+    #redis being down or slow is a cache miss--> get returns None, set/delete do nothing and the caller goes to the database
+    #(or its loader), same as the rate limiter letting requests through when its store fails
+    def __init__(self, client, namespace: str, ttl: float):
+        import redis.exceptions
+
+        self.client = client
+        self.namespace = namespace
+        self.ttl = ttl
+        self.unavailable = False   #logged once per outage, the next command that works resets it
+        self._errors = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)
+
+    def _key(self, key):
+        return f"{self.namespace}:{key}"
+
+    async def _run(self, command, *args, default=None, **kwargs):
+        try:
+            result = await command(*args, **kwargs)
+        except self._errors as error:
+            if not self.unavailable:
+                self.unavailable = True
+                logger.warning("cache unavailable", extra={"namespace": self.namespace, "error": repr(error)})
+            return default
+        if self.unavailable:
+            self.unavailable = False
+            logger.info("cache available again", extra={"namespace": self.namespace})
+        return result
+
+    async def get(self, key):
+        raw = await self._run(self.client.get, self._key(key))
+        return None if raw is None else json.loads(raw)
+
+    async def set(self, key, value, ttl=None):
+        ttl_ms = int((self.ttl if ttl is None else ttl) * 1000)
+        if ttl_ms <= 0:
+            return
+        await self._run(self.client.set, self._key(key), json.dumps(value), px=ttl_ms)
+
+    async def delete(self, key):
+        await self._run(self.client.delete, self._key(key))
+
+    async def incr(self, key, amount=1):
+        #0 while redis is down, the feed cache then uses generation 0 but its gets miss and its sets are dropped anyway
+        return await self._run(self.client.incrby, self._key(key), amount, default=0)
+
+
+_redis_client = None
+
+
+def get_redis_client():
+    #one shared client(and connection pool) per process, redis is only imported when it is actually configured
+    global _redis_client
+    if _redis_client is None:
+        import redis.asyncio
+
+        _redis_client = redis.asyncio.from_url(settings.redis_url)
+    return _redis_client
+
+
+def create_backend(namespace: str, max_size: int, ttl: float) -> CacheBackend:
+    if settings.cache_backend == "redis":
+        return RedisBackend(get_redis_client(), namespace, ttl)
+    return MemoryBackend(max_size, ttl)
+
+
+class LazyBackend(CacheBackend):
+    #a module level cache that is only created when it is first used, so defining it doesnt read settings at import
+    #build returns the real backend(usually create_backend(...)), its methods then replace these ones and calls go straight to it
+    def __init__(self, build):
+        self._build = build
+
+    def _resolve(self):
+        backend = self._build()
+        self.get, self.set, self.delete, self.incr = backend.get, backend.set, backend.delete, backend.incr
+        return backend
+
+    async def get(self, key):
+        return await self._resolve().get(key)
+
+    async def set(self, key, value, ttl=None):
+        await self._resolve().set(key, value, ttl)
+
+    async def delete(self, key):
+        await self._resolve().delete(key)
+
+    async def incr(self, key, amount=1):
+        return await self._resolve().incr(key, amount)
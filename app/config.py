@@ -1,6 +1,19 @@
+from functools import lru_cache
+from typing import Dict, List, Literal
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
-class Settings(BaseSettings):
+class ObservabilitySettings(BaseSettings):
+    #what main.py needs while it is imported(logging, sentry has to be set up before the routes are built)
+    #everything has a default, so importing the app never fails on a missing environment
+    log_level: str = "INFO"
+    log_json: bool = False   #one json object per line, for log collectors
+    sentry_dsn: str = ""   #error reporting, off when empty
+    sentry_traces_sample_rate: float = 0.0
+
+    model_config = SettingsConfigDict(env_file=".env", extra="ignore")
+
+
+class Settings(ObservabilitySettings):
     database_hostname: str 
     database_port: str 
     database_password: str 
@@ -9,9 +22,133 @@ class Settings(BaseSettings):
     secret_key: str
     algorithm: str 
     access_token_expire_minutes: int
+    database_mode: Literal["sync", "async"] = "sync"   #sync--> psycopg2 on the threadpool, async--> asyncpg on the event loop
+
+    #connection pool, one pool per worker process
+    database_pool_size: int = 5
+    database_max_overflow: int = 10
+    database_pool_timeout: float = 30   #seconds to wait for a free connection before failing
+    database_pool_recycle: int = -1     #seconds before a connection is replaced, -1 = never
+    database_pool_pre_ping: bool = True
+    database_statement_timeout_ms: int = 0   #0 = no limit
+    database_pgbouncer: bool = False    #running behind pgbouncer in transaction pooling mode
+    query_budget: int = 0   #dev/CI only--> requests running more sql statements than this fail with a 500, 0 = off
+    slow_query_ms: int = 500   #statements slower than this are logged, 0 = off
+    database_connect_retry_initial_delay: float = 0.5   #startup keeps retrying the database with backoff instead of crashing the worker
+    database_connect_retry_max_delay: float = 10
+    health_check_timeout: float = 2   #seconds /health/ready waits for the database
+
+    #read replicas, read only GET handlers are spread round robin over the healthy ones, everything else uses the primary
+    database_replica_urls: List[str] = []   #json list in env e.g. DATABASE_REPLICA_URLS=["postgresql://user:pw@replica1:5432/fastapi"]
+    database_replica_check_interval: float = 5   #seconds between replica health checks
+    database_replica_max_lag_seconds: float = 10   #replicas further behind the primary than this get no reads, 0 = dont check
+    read_your_writes_seconds: float = 5   #a user who just wrote reads from the primary for this long, 0 = off
+
+    #production server(python -m app.server), the settings apply per container
+    web_concurrency: int = 0   #worker processes, 0 = one per available cpu
+    server_bind: str = "0.0.0.0:8000"
+    server_keepalive: int = 5   #seconds an idle keep-alive connection stays open, keep it above the load balancer's idle timeout
+    server_timeout: int = 60    #a worker that stops responding for this long is killed and replaced
+    server_graceful_timeout: int = 30   #seconds in-flight requests get to finish on shutdown/reload
+    server_max_requests: int = 10000    #recycle a worker after this many requests to cap memory growth, 0 = never
+    server_max_requests_jitter: int = 1000   #random extra so the workers dont all restart at the same time
+    server_preload: bool = False   #import the app once in the master before forking
+    #proxies(load balancer, nginx) whose X-Forwarded-For/-Proto are believed, comma separated ips or networks, "*" = any
+    #the client address rate limits use is then the first one in X-Forwarded-For that isnt a trusted proxy, not the proxy's own
+    #same name and default as uvicorn's and gunicorn's own setting, so plain `uvicorn app.main:app` reads it too
+    forwarded_allow_ips: str = "127.0.0.1"
+
+    #rate limits per route and client, "<count>/<second|minute|hour> <user|ip> <token_bucket|sliding_window>"
+    #user--> keyed by the bearer token's user, anonymous requests fall back to their ip
+    #state is per worker with CACHE_BACKEND=memory, shared by every worker through redis otherwise
+    rate_limit_enabled: bool = True
+    rate_limit_rules: Dict[str, str] = {
+        "POST /login": "20/minute ip sliding_window",   #every attempt costs an argon2 hash
+        "POST /users/": "5/minute ip sliding_window",
+        "POST /posts/": "30/minute user token_bucket",
+        "POST /votes/": "120/minute user token_bucket",
+        "POST /votes/batch": "30/minute user token_bucket",
+    }
+    rate_limit_max_keys: int = 100000   #clients tracked by the memory backend, least recently seen are dropped first
+    admission_max_concurrent: int = 0   #requests handled at once per worker, 0 = 2 x (pool size + overflow), -1 = no limit
+    admission_queue_timeout: float = 0.5   #seconds a request may wait for a free slot before it gets a 503
+
+    #live vote counts pushed to clients(/live/votes over websocket or server sent events)
+    live_backend: Literal["local", "postgres"] = "local"   #local--> only subscribers on the worker that took the vote hear it, postgres--> LISTEN/NOTIFY reaches every worker
+    live_listen_url: str = ""   #postgres to LISTEN on, default the primary, LISTEN needs a session so point it past pgbouncer's transaction pooling
+    live_flush_ms: int = 100   #changes are collected for this long and go out as one frame per subscriber
+    live_max_posts: int = 100   #posts one connection may follow
+    live_max_subscribers: int = 10000   #open live connections per worker
+    live_heartbeat_seconds: float = 15   #sse comment sent on quiet streams so proxies dont close them
+
+    #observability, logging and sentry are in ObservabilitySettings
+    server_timing: bool = True   #add a Server-Timing header(app, db, pool wait) to every response
+
+    #caches, memory is per worker process, redis is shared by all of them
+    cache_backend: Literal["memory", "redis"] = "memory"
+    redis_url: str = "redis://localhost:6379/0"
+    user_cache_ttl_seconds: int = 60
+    user_cache_max_size: int = 10000
+    auth_trust_token_claims: bool = False   #skip the user lookup entirely and trust the user_id inside a valid token
+    token_cache_ttl_seconds: int = 300   #verified tokens, entries never outlive the token's own exp
+    token_cache_max_size: int = 10000
+    feed_cache_enabled: bool = True
+    #serialized feed pages, a post/vote write invalidates them through a generation counter in CACHE_BACKEND
+    #with memory that counter is per worker, the other workers keep serving their copy for up to this long
+    feed_cache_ttl_seconds: float = 5
+    feed_cache_max_size: int = 1000
+
+    #moderation
+    moderator_ids: List[int] = []   #users allowed to use the bulk post endpoints, json list in env e.g. MODERATOR_IDS=[1,2]
+    post_bulk_max_size: int = 1000
+
+    #bulk import/export(/admin and python -m app.maintenance import/export)
+    admin_ids: List[int] = []   #users allowed to import/export whole tables, exports include password hashes
+    bulk_batch_size: int = 5000   #rows per COPY batch and commit during imports
+
+    #posts partitions(app/partitions.py), there is no default partition so a post for a month without one cant be written
+    #every worker makes sure this month and the next exist at startup and then this often, on top of the create-partitions cron
+    partition_check_interval_seconds: float = 3600   #0 = only at startup
+
+    #votes
+    vote_batch_max_size: int = 500   #votes allowed in one POST /votes/batch
+    vote_buffer_enabled: bool = False   #group single votes from many requests into one bulk write
+    vote_buffer_max_size: int = 200     #flush as soon as this many votes are waiting
+    vote_buffer_flush_ms: int = 10      #...or after this long, a single vote never waits longer
+    voted_cache_enabled: bool = False   #cache the posts each user voted on so feed pages skip the voted_by_me lookup, best with redis
+    voted_cache_ttl_seconds: float = 60
+    voted_cache_max_size: int = 10000   #users kept by the memory backend
+    voted_cache_max_votes: int = 5000   #users who voted on more posts than this are looked up page by page instead
+
+    #password hashing(argon2)
+    argon2_time_cost: int = 3
+    argon2_memory_cost: int = 65536   #KiB per hash
+    argon2_parallelism: int = 4
+    password_hash_workers: int = 2      #dedicated hashing threads per worker process
+    password_hash_queue_size: int = 32  #hashes allowed to wait for a thread before we answer 503
 
     model_config = SettingsConfigDict(env_file=".env", extra="ignore") #since we added postgresdb and pswd so extra will be ignored
 
 
-settings = Settings()
+@lru_cache
+def get_settings():
+    return Settings()
+
+
+class _LazySettings:
+    #settings are read from the environment(.env) the first time one is used, not when this module is imported
+    #so tools can import app modules without a full environment, and tests/scripts can change values before the engines are built
+    #nothing in the app reads settings at import, values are read inside functions
+    def __getattr__(self, name):
+        #only called for names not in our __dict__ yet, after the first read every field is a plain attribute here
+        loaded = get_settings()
+        self.__dict__.update(vars(loaded))
+        return getattr(loaded, name)
+
+    def __setattr__(self, name, value):
+        setattr(get_settings(), name, value)
+        self.__dict__[name] = value
+
+
+settings = _LazySettings()
 
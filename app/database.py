@@ -1,29 +1,321 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, AsyncEngine
+from sqlalchemy import text
+from contextlib import asynccontextmanager
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool, NullPool
+from starlette.concurrency import run_in_threadpool
 import psycopg2
 from psycopg2.extras import RealDictCursor  #used to show column names
+import logging
+import os
+import threading
 import time
 from .config import settings
+from . import metrics
 
+slow_query_logger = logging.getLogger("app.sql.slow")
 
-SQLALCHEMY_DATABASE_URL = f'postgresql://{settings.database_username}:{settings.database_password}@{settings.database_hostname}:{settings.database_port}/{settings.database_name}'
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+def database_url(is_async=False):
+    driver = "postgresql+asyncpg" if is_async else "postgresql"
+    return f'{driver}://{settings.database_username}:{settings.database_password}@{settings.database_hostname}:{settings.database_port}/{settings.database_name}'
+
+
+def replica_url(index: int, is_async=False):
+    #DATABASE_REPLICA_URLS are written once, the driver follows DATABASE_MODE like the primary's
+    return make_url(settings.database_replica_urls[index]).set(drivername="postgresql+asyncpg" if is_async else "postgresql")
+
+
+class _TimedPoolMixin:
+    #measures how long we wait for a free connection, this is the number that tells us if the pool is starved
+    stats = None
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.stats.increment("timeouts")
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            self.stats.record_wait(waited)
+            metrics.record_pool_wait(waited)
+
+    def recreate(self):
+        #the pool is recreated on dispose/invalidate, keep counting into the same stats
+        new_pool = super().recreate()
+        new_pool.stats = self.stats
+        return new_pool
+
+
+class TimedQueuePool(_TimedPoolMixin, QueuePool):
+    pass
+
+
+class TimedAsyncQueuePool(_TimedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def _start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    context.statement_started = time.perf_counter()
+
+
+def _stop_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - context.statement_started
+    metrics.record_statement(statement, seconds)
+    #parameters are left out on purpose, they can hold emails and password hashes
+    if settings.slow_query_ms and seconds * 1000 >= settings.slow_query_ms:
+        slow_query_logger.warning("slow query", extra={"duration_ms": round(seconds * 1000, 2), "statement": statement})
+
+
+def _build_engine(name, url, is_async=False):
+    timeout_ms = settings.database_statement_timeout_ms
+    connect_args = {}
+    options = {"pool_pre_ping": settings.database_pool_pre_ping}   #pre ping replaces dead connections(eg after a failover) before handing them out
+
+    if settings.database_pgbouncer:
+        #pgbouncer already pools the server connections, holding idle ones here would just pin pgbouncer slots
+        options["poolclass"] = NullPool
+        if is_async:
+            #transaction pooling moves us between server connections, so asyncpg cant reuse prepared statements
+            connect_args.update(statement_cache_size=0, prepared_statement_cache_size=0)
+    else:
+        options.update(
+            poolclass=TimedAsyncQueuePool if is_async else TimedQueuePool,
+            pool_size=settings.database_pool_size,
+            max_overflow=settings.database_max_overflow,
+            pool_timeout=settings.database_pool_timeout,
+            pool_recycle=settings.database_pool_recycle,
+        )
+        #statement_timeout is set once per connection as a startup option
+        if timeout_ms:
+            if is_async:
+                connect_args["server_settings"] = {"statement_timeout": str(timeout_ms)}
+            else:
+                connect_args["options"] = f"-c statement_timeout={timeout_ms}"
+
+    if is_async:
+        new_engine = create_async_engine(url, connect_args=connect_args, **options)
+        sync_engine = new_engine.sync_engine   #events and the pool live on the sync engine underneath
+    else:
+        new_engine = sync_engine = create_engine(url, connect_args=connect_args, **options)
+
+    if settings.database_pgbouncer and timeout_ms:
+        #pgbouncer rejects startup options and a plain SET would leak to other clients, so scope it to each transaction
+        @event.listens_for(sync_engine, "begin")
+        def set_statement_timeout(conn):
+            conn.exec_driver_sql(f"SET LOCAL statement_timeout = {int(timeout_ms)}")
+
+    stats = metrics.PoolStats()
+    sync_engine.pool.stats = stats
+    event.listen(sync_engine, "checkout", lambda *args: stats.increment("checkouts"))
+    event.listen(sync_engine, "connect", lambda *args: stats.increment("connects"))
+    event.listen(sync_engine, "invalidate", lambda *args: stats.increment("invalidations"))
+    metrics.register_pool(name, sync_engine, stats)
+    event.listen(sync_engine, "before_cursor_execute", _start_statement_timer)
+    event.listen(sync_engine, "after_cursor_execute", _stop_statement_timer)
+
+    return new_engine
+
+
+#engines and session factories are built the first time they are used, importing the app never touches the database
+_engines = {}
+_session_factories = {}
+_engines_lock = threading.Lock()   #sync mode can ask for the engine from several threadpool threads at once
+
+
+_inherited_engines = []   #engines built before a fork, kept referenced in the child so their sockets are never closed from there
+
+
+def _forget_engines_after_fork():
+    #a forked worker must not share pooled connections with its parent, two processes talking over one socket corrupts both
+    #the child just drops them and builds its own engines on first use, closing them here would end the parent's connections
+    global _engines_lock
+    _inherited_engines.extend(_engines.values())
+    _engines.clear()
+    _session_factories.clear()
+    _engines_lock = threading.Lock()   #another thread could have held it at the moment of the fork
+
+
+os.register_at_fork(after_in_child=_forget_engines_after_fork)
+
+
+def get_engine():
+    with _engines_lock:
+        if "primary" not in _engines:
+            _engines["primary"] = _build_engine("primary", database_url())
+        return _engines["primary"]
+
+
+def get_async_engine():
+    #asyncpg is only imported when this is first called, so sync deployments dont need it installed
+    with _engines_lock:
+        if "primary_async" not in _engines:
+            _engines["primary_async"] = _build_engine("primary_async", database_url(is_async=True), is_async=True)
+        return _engines["primary_async"]
+
+
+def get_replica_engine(index: int):
+    is_async = settings.database_mode == "async"
+    name = f"replica{index}_async" if is_async else f"replica{index}"
+    with _engines_lock:
+        if name not in _engines:
+            _engines[name] = _build_engine(name, replica_url(index, is_async), is_async)
+        return _engines[name]
+
+
+def _sessionmaker_for(bind):
+    if isinstance(bind, AsyncEngine):
+        return sessionmaker(bind, class_=AsyncSession, autocommit=False, autoflush=False, expire_on_commit=False)
+    return sessionmaker(autocommit=False, autoflush=False, bind=bind)
+
+
+def get_replica_sessionmaker(index: int):
+    name = f"replica{index}_{settings.database_mode}"
+    if name not in _session_factories:
+        _session_factories[name] = _sessionmaker_for(get_replica_engine(index))
+    return _session_factories[name]
+
+
+def get_sessionmaker():
+    if "sync" not in _session_factories:
+        _session_factories["sync"] = sessionmaker(autocommit=False, autoflush=False, bind=get_engine())
+    return _session_factories["sync"]
+
+
+def get_async_sessionmaker():
+    if "async" not in _session_factories:
+        #expire_on_commit=False--> objects stay readable after commit, in async mode an expired attribute cant be lazy loaded during serialization
+        _session_factories["async"] = sessionmaker(get_async_engine(), class_=AsyncSession, autocommit=False, autoflush=False, expire_on_commit=False)
+    return _session_factories["async"]
+
+
+def __getattr__(name):
+    #the old module level names(engine, SessionLocal, ...) still work, they are just resolved on first use now
+    if name == "engine":
+        return get_engine()
+    if name == "SessionLocal":
+        return get_sessionmaker()
+    if name == "async_engine":
+        return get_async_engine() if settings.database_mode == "async" else None
+    if name == "AsyncSessionLocal":
+        return get_async_sessionmaker() if settings.database_mode == "async" else None
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+async def dispose_engines():
+    #closes every pooled connection, used on shutdown
+    for built_engine in list(_engines.values()):
+        if isinstance(built_engine, AsyncEngine):
+            await built_engine.dispose()
+        else:
+            await run_in_threadpool(built_engine.dispose)
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
 
 def get_db():
-    db = SessionLocal()    #creates a new session
+    db = get_sessionmaker()()    #creates a new session
     try:
         yield db
     finally:
         db.close()
 
 
+async def get_async_db():
+    async with get_async_sessionmaker()() as db:
+        yield db
+
+
+class ThreadedSession:
+    #gives a normal(sync) Session the same awaitable api as AsyncSession, every blocking call runs on the threadpool
+    #this lets the routers be written once with async def and still run on psycopg2 in sync mode
+    def __init__(self, sync_session):
+        self.sync_session = sync_session
+
+    def add(self, instance):
+        self.sync_session.add(instance)
+
+    def add_all(self, instances):
+        self.sync_session.add_all(instances)
+
+    async def execute(self, statement, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.execute, statement, *args, **kwargs)
+
+    async def scalar(self, statement, *args, **kwargs):
+        return await run_in_threadpool(self.sync_session.scalar, statement, *args, **kwargs)
+
+    async def get(self, entity, ident, **kwargs):
+        return await run_in_threadpool(self.sync_session.get, entity, ident, **kwargs)
+
+    async def refresh(self, instance, attribute_names=None):
+        await run_in_threadpool(self.sync_session.refresh, instance, attribute_names)
+
+    async def delete(self, instance):
+        await run_in_threadpool(self.sync_session.delete, instance)
+
+    async def flush(self):
+        await run_in_threadpool(self.sync_session.flush)
+
+    async def commit(self):
+        await run_in_threadpool(self.sync_session.commit)
+
+    async def rollback(self):
+        await run_in_threadpool(self.sync_session.rollback)
+
+    async def close(self):
+        await run_in_threadpool(self.sync_session.close)
+
+    async def run_sync(self, fn, *args, **kwargs):
+        return await run_in_threadpool(fn, self.sync_session, *args, **kwargs)
+
+
+@asynccontextmanager
+async def open_session(factory):
+    #factory is an async or a sync sessionmaker, sync sessions are wrapped so callers always get the awaitable api
+    if settings.database_mode == "async":
+        async with factory() as db:
+            yield db
+    else:
+        db = ThreadedSession(factory(expire_on_commit=False))
+        try:
+            yield db
+        finally:
+            await db.close()
+
+
+def primary_sessionmaker():
+    return get_async_sessionmaker() if settings.database_mode == "async" else get_sessionmaker()
+
+
+async def get_session():
+    #the dependency used by the routers, DATABASE_MODE picks asyncpg(async) or psycopg2 on the threadpool(sync)
+    async with open_session(primary_sessionmaker()) as db:
+        yield db
+
+
+async def connect_raw(dsn: str = ""):
+    #a plain asyncpg connection outside the pools(and DATABASE_MODE), for COPY and LISTEN which sessions cant do
+    #the caller closes it, no statement_timeout so long running COPYs are not cut off
+    import asyncpg
+
+    if dsn:
+        return await asyncpg.connect(dsn)
+    return await asyncpg.connect(host=settings.database_hostname, port=settings.database_port, user=settings.database_username,
+                                 password=settings.database_password, database=settings.database_name)
+
+
+async def ping():
+    #one round trip to the database, raises when it cant be reached
+    async with asynccontextmanager(get_session)() as db:
+        await db.execute(text("SELECT 1"))
+
+
 # while True:
 #     try:
 #         conn = psycopg2.connect(host='localhost', database='fastapi', user='postgres', password='ayush1106', cursor_factory=RealDictCursor)
@@ -0,0 +1,81 @@
+#response cache for the feed(GET /posts and GET /posts/latest)
+#pages are stored already serialized, writes to posts/votes bump a generation number which makes every cached page unreachable at once
+import asyncio
+import hashlib
+from fastapi import Request, Response, status
+from .config import settings
+from . import cache, serialization
+
+backend = cache.LazyBackend(lambda: cache.create_backend("feed", settings.feed_cache_max_size, settings.feed_cache_ttl_seconds))
+
+_inflight = {}   #key--> future of the query that is already loading it(request coalescing)
+
+
+class _LoadCancelled(Exception):
+    #what waiters get when the request running the query was cancelled(its client went away), they retry instead
+    pass
+
+
+async def _generation():
+    return await backend.incr("generation", 0)
+
+
+async def invalidate():
+    #called by every write path that changes what a feed page shows
+    if settings.feed_cache_enabled:
+        await backend.incr("generation")
+
+
+async def get_or_load(key: str, loader, refresh: bool = False):
+    #loader is an async function returning {"body": json text, "headers": {...}}
+    #post listings return {"items": [post json], "post_ids": [...], "headers": {...}} instead, see respond()
+    #refresh--> skip the cached copy and store a newly loaded one(a user reading their own write from the primary)
+    if not settings.feed_cache_enabled:
+        return await loader()
+
+    full_key = f"{await _generation()}:{key}"
+    if refresh:
+        page = await loader()
+        await backend.set(full_key, page)
+        return page
+
+    page = await backend.get(full_key)
+    if page is not None:
+        return page
+
+    #someone is already running the query for this key, wait for their result instead of querying again
+    #if that request gets cancelled the first waiter to wake up runs the query itself and the others wait for it
+    while full_key in _inflight:
+        try:
+            return await asyncio.shield(_inflight[full_key])
+        except _LoadCancelled:
+            pass
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[full_key] = future
+    try:
+        page = await loader()
+        await backend.set(full_key, page)
+        future.set_result(page)
+        return page
+    except BaseException as error:
+        #a cancelled leader isnt a failed query, passing its CancelledError on would cancel every waiting request with it
+        future.set_exception(_LoadCancelled() if isinstance(error, asyncio.CancelledError) else error)
+        future.exception()   #mark it retrieved so asyncio doesnt warn when nobody else was waiting
+        raise
+    finally:
+        del _inflight[full_key]
+
+
+def respond(request: Request, page: dict, voted=frozenset()):
+    #voted--> post ids the current user voted on, listings get their voted_by_me flags filled in here
+    if "items" in page:
+        body = serialization.join_post_out_items(page["items"], page["post_ids"], voted)
+    else:
+        body = page["body"].encode()
+    #ETag is a hash of the body, a client sending it back in If-None-Match gets an empty 304
+    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+    headers = {**page["headers"], "ETag": etag}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
@@ -0,0 +1,246 @@
+#live vote counts, clients follow a set of posts over a websocket or sse stream instead of polling GET /posts/{id}
+#votes only publish the ids of the posts they changed, each worker collects them for LIVE_FLUSH_MS and then reads the
+#current counts of the ones its subscribers follow in one query and sends every subscriber one frame with its posts
+#new subscriptions get their first counts from the same query, a reconnect storm after a deploy costs one query per flush too
+#counts are always read after the commit, so frames can never go backwards even when votes commit out of order
+import asyncio
+import logging
+from collections import defaultdict
+from functools import lru_cache
+from sqlalchemy import select
+from .config import settings
+from . import database, models
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "post_votes"
+NOTIFY_PAYLOAD_LIMIT = 7900   #postgres refuses payloads of 8000 bytes and more
+
+
+class Subscriber:
+    #one live connection, changes waiting to be sent are merged so a slow client gets the newest counts, never a backlog
+    def __init__(self):
+        self.post_ids = set()
+        self.pending = {}   #post_id--> vote_count
+        self._ready = asyncio.Event()
+
+    def push(self, counts):
+        self.pending.update(counts)
+        self._ready.set()
+
+    async def next_frame(self, timeout=None):
+        #the counts that changed since the last frame, None when nothing changed within timeout
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        self._ready.clear()
+        frame, self.pending = self.pending, {}
+        return frame
+
+
+class Hub:
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        self.subscribers = set()
+        self._by_post = defaultdict(set)   #post_id--> subscribers following it
+        self._changed = set()
+        self._snapshots = defaultdict(set)   #subscriber--> newly followed posts still waiting for their current counts
+        self._wake = asyncio.Event()
+        self.frames_sent = 0
+        self.flushes = 0
+
+    def add(self, subscriber: Subscriber):
+        self.subscribers.add(subscriber)
+
+    def remove(self, subscriber: Subscriber):
+        self.unsubscribe(subscriber, list(subscriber.post_ids))
+        self.subscribers.discard(subscriber)
+        self._snapshots.pop(subscriber, None)
+
+    def subscribe(self, subscriber: Subscriber, post_ids):
+        #the current counts of the newly followed posts are sent with the next flush, a vote in between is not lost
+        new = [post_id for post_id in post_ids if post_id not in subscriber.post_ids][:settings.live_max_posts - len(subscriber.post_ids)]
+        for post_id in new:
+            subscriber.post_ids.add(post_id)
+            self._by_post[post_id].add(subscriber)
+        if new:
+            self._snapshots[subscriber].update(new)
+            self._wake.set()
+        return new
+
+    def unsubscribe(self, subscriber: Subscriber, post_ids):
+        for post_id in post_ids:
+            subscriber.post_ids.discard(post_id)
+            followers = self._by_post.get(post_id)
+            if followers is not None:
+                followers.discard(subscriber)
+                if not followers:
+                    del self._by_post[post_id]
+
+    def changed(self, post_ids):
+        #called by the broker for every published change, posts nobody here follows are dropped right away
+        followed = [post_id for post_id in post_ids if post_id in self._by_post]
+        if followed:
+            self._changed.update(followed)
+            self._wake.set()
+
+    def resync(self):
+        #after missing notifications(lost listen connection) send everything that is followed again
+        self.changed(list(self._by_post))
+
+    async def run(self):
+        #runs for the lifetime of the worker, started from the app lifespan, idle while nothing changes
+        self._wake = asyncio.Event()   #bound to the loop that runs the hub
+        if self._changed or self._snapshots:
+            self._wake.set()
+        while True:
+            await self._wake.wait()
+            await asyncio.sleep(self.flush_interval)   #let the changes of the next few ms join this batch
+            self._wake.clear()
+            changed, self._changed = self._changed, set()
+            snapshots, self._snapshots = self._snapshots, defaultdict(set)
+            try:
+                await self.flush(changed, snapshots)
+            except Exception as error:
+                logger.warning("live flush failed", extra={"posts": len(changed), "error": repr(error)})
+
+    async def flush(self, changed, snapshots):
+        counts = await vote_counts(changed.union(*snapshots.values()))
+        self.fan_out({post_id: counts[post_id] for post_id in changed if post_id in counts})
+        for subscriber, post_ids in snapshots.items():
+            if subscriber in self.subscribers:
+                subscriber.push({post_id: counts[post_id] for post_id in post_ids if post_id in counts})
+        self.flushes += 1
+
+    def fan_out(self, counts):
+        frames = defaultdict(dict)   #subscriber--> its share of this batch
+        for post_id, vote_count in counts.items():
+            for subscriber in self._by_post.get(post_id, ()):
+                frames[subscriber][post_id] = vote_count
+        for subscriber, frame in frames.items():
+            subscriber.push(frame)
+        self.frames_sent += len(frames)
+
+    def snapshot(self):
+        return {"subscribers": len(self.subscribers), "posts_followed": len(self._by_post), "flushes": self.flushes, "frames_sent": self.frames_sent}
+
+
+async def vote_counts(post_ids):
+    #read from the primary, a lagging replica could hand out a count from before the vote that triggered the flush
+    if not post_ids:
+        return {}
+    async with database.open_session(database.primary_sessionmaker()) as db:
+        result = await db.execute(select(models.Post.id, models.Post.vote_count).where(models.Post.id.in_(sorted(post_ids))))
+        return {post_id: vote_count for post_id, vote_count in result.all()}
+
+
+class LocalBroker:
+    #changes go straight to this worker's hub, enough for a single worker(and for tests)
+    def __init__(self, hub: Hub):
+        self.hub = hub
+
+    def publish(self, post_ids):
+        self.hub.changed(post_ids)
+
+    async def run(self):
+        return
+
+
+class PostgresBroker:
+    #NOTIFY post_votes with the changed ids, every worker LISTENs on its own connection and feeds its hub
+    #publish only queues the ids, a sender sends whatever piled up in one NOTIFY so busy vote traffic costs a few round trips a second
+    def __init__(self, hub: Hub):
+        self.hub = hub
+        self._outgoing = set()
+        self._wake = asyncio.Event()
+
+    def publish(self, post_ids):
+        self._outgoing.update(post_ids)
+        if self._outgoing:
+            self._wake.set()
+
+    async def run(self):
+        #keeps one connection open for the lifetime of the worker, reconnecting with backoff like the startup check
+        self._wake = asyncio.Event()   #bound to the loop that runs the broker
+        if self._outgoing:
+            self._wake.set()
+        delay = settings.database_connect_retry_initial_delay
+        while True:
+            try:
+                connection = await _connect()
+            except Exception as error:
+                logger.warning("live listener cant connect", extra={"retry_in": delay, "error": repr(error)})
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, settings.database_connect_retry_max_delay)
+                continue
+            delay = settings.database_connect_retry_initial_delay
+            try:
+                await self._serve(connection)
+            except Exception as error:
+                logger.warning("live listener disconnected", extra={"error": repr(error)})
+            finally:
+                connection.terminate()
+
+    async def _serve(self, connection):
+        closed = asyncio.Event()
+        connection.add_termination_listener(lambda _: closed.set())
+        await connection.add_listener(CHANNEL, self._on_notify)
+        self.hub.resync()   #anything published while we were not listening is lost, send fresh counts for it all
+        while not closed.is_set():
+            waiter = asyncio.create_task(self._wake.wait())
+            closer = asyncio.create_task(closed.wait())
+            try:
+                await asyncio.wait({waiter, closer}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                waiter.cancel()
+                closer.cancel()
+            if closed.is_set():
+                break
+            self._wake.clear()
+            outgoing, self._outgoing = self._outgoing, set()
+            try:
+                for payload in notify_payloads(outgoing):
+                    await connection.execute("SELECT pg_notify($1, $2)", CHANNEL, payload)
+            except Exception:
+                self._outgoing.update(outgoing)   #sent again after the reconnect
+                raise
+        raise ConnectionError("listen connection closed")
+
+    def _on_notify(self, connection, pid, channel, payload):
+        self.hub.changed([int(post_id) for post_id in payload.split(",")])
+
+
+def notify_payloads(post_ids):
+    #comma separated ids, split so no payload goes over the NOTIFY size limit
+    payload = []
+    size = 0
+    for post_id in sorted(post_ids):
+        text = str(post_id)
+        if payload and size + len(text) + 1 > NOTIFY_PAYLOAD_LIMIT:
+            yield ",".join(payload)
+            payload, size = [], 0
+        payload.append(text)
+        size += len(text) + 1
+    if payload:
+        yield ",".join(payload)
+
+
+async def _connect():
+    return await database.connect_raw(settings.live_listen_url)
+
+
+#one hub and one broker per worker, built on first use instead of at import
+@lru_cache
+def get_hub():
+    return Hub(settings.live_flush_ms / 1000)
+
+
+@lru_cache
+def get_broker():
+    return PostgresBroker(get_hub()) if settings.live_backend == "postgres" else LocalBroker(get_hub())
+
+
+def votes_changed(post_ids):
+    #called by voting after a commit that added or removed votes
+    get_broker().publish(set(post_ids))
@@ -0,0 +1,50 @@
+#logging for everything under the "app" logger, uvicorn keeps its own access/error loggers
+#fields passed with extra={...} are kept as structured fields, as json(LOG_JSON=true) or as key=value pairs after the message
+import json
+import logging
+from datetime import datetime, timezone
+from .config import settings
+
+#attributes every LogRecord has, anything else on a record came from extra={...}
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def _fields(record):
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES}
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **_fields(record),
+        }
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class KeyValueFormatter(logging.Formatter):
+    def format(self, record):
+        line = super().format(record)
+        fields = " ".join(f"{key}={value!r}" for key, value in _fields(record).items())
+        return f"{line} {fields}" if fields else line
+
+
+def configure_logging(config=settings):
+    #config--> anything with log_json and log_level, main.py passes ObservabilitySettings so importing the app needs no full environment
+    handler = logging.StreamHandler()
+    if config.log_json:
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(KeyValueFormatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    logger = logging.getLogger("app")
+    logger.handlers = [handler]
+    logger.setLevel(config.log_level.upper())
+    logger.propagate = False   #dont print every line twice when something also configures the root logger
+    #sqlalchemy names pool loggers after the pool class, ours are defined in app.database so keep their debug chatter out
+    logging.getLogger("app.database").setLevel(logging.WARNING)
@@ -1,22 +1,90 @@
-from fastapi import FastAPI
-from . import models
-from .database import engine, Base
-from .routers import post, user, auth, votes
-from .config import settings
+from fastapi import FastAPI, Request, status
+from fastapi.responses import JSONResponse, ORJSONResponse, PlainTextResponse
+from . import database
+from .routers import post, user, auth, votes, admin, live as live_router
+from .config import settings, ObservabilitySettings
+from . import metrics, utils, replicas, ratelimit, live, partitions
+from .logging_config import configure_logging
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
 
-Base.metadata.create_all(bind=engine)
+#only the optional logging/sentry settings are read here, the rest(database, secret key) on first use
+observability = ObservabilitySettings()
+configure_logging(observability)
+logger = logging.getLogger(__name__)
+
+if observability.sentry_dsn:
+    #only imported when configured, sentry picks up the fastapi/sqlalchemy integrations by itself
+    import sentry_sdk
+
+    sentry_sdk.init(dsn=observability.sentry_dsn, traces_sample_rate=observability.sentry_traces_sample_rate)
+
+#tables are created and changed only by alembic migrations(alembic upgrade head), never at import time
 
 origins = ["https://www.google.com"]
 
-app = FastAPI()
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=origins,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+async def _wait_for_database(app: FastAPI):
+    #keeps trying with exponential backoff, a database that is briefly down delays readiness instead of crash looping the worker
+    delay = settings.database_connect_retry_initial_delay
+    attempt = 1
+    while True:
+        try:
+            await asyncio.wait_for(database.ping(), settings.health_check_timeout)
+            await _ensure_partitions()
+            app.state.database_ready = True
+            logger.info("database connected", extra={"attempts": attempt})
+            return
+        except Exception as error:
+            logger.warning("database not reachable yet", extra={"attempt": attempt, "retry_in": delay, "error": repr(error)})
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, settings.database_connect_retry_max_delay)
+        attempt += 1
+
+
+async def _ensure_partitions():
+    #posts has no default partition, without this month's partition every POST /posts/ fails, so a worker doesnt rely on the cron alone
+    #a failure(eg. no CREATE rights) is only logged, the database is still usable for everything else
+    try:
+        async with database.open_session(database.primary_sessionmaker()) as db:
+            created = await db.run_sync(partitions.create_partitions, 1)
+        if created:
+            logger.warning("created missing posts partitions, is the create-partitions cron running?", extra={"partitions": created})
+    except Exception as error:
+        logger.error("could not create posts partitions", extra={"error": repr(error)})
+
+
+async def _keep_partitions():
+    #a worker that lives into the next month creates it too
+    while True:
+        await asyncio.sleep(settings.partition_check_interval_seconds)
+        await _ensure_partitions()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.database_ready = False
+    connector = asyncio.create_task(_wait_for_database(app))   #in the background, the worker starts answering /health/live right away
+    #but give the first attempt a moment, a recycled worker then takes traffic already ready instead of answering 503 on /health/ready
+    await asyncio.wait({connector}, timeout=settings.health_check_timeout)
+    replica_set = replicas.get_replica_set()
+    replica_monitor = asyncio.create_task(replica_set.monitor()) if replica_set.replicas else None
+    live_tasks = [asyncio.create_task(live.get_hub().run()), asyncio.create_task(live.get_broker().run())]
+    partition_keeper = asyncio.create_task(_keep_partitions()) if settings.partition_check_interval_seconds > 0 else None
+    yield
+    connector.cancel()
+    if partition_keeper is not None:
+        partition_keeper.cancel()
+    for task in live_tasks:
+        task.cancel()
+    if replica_monitor is not None:
+        replica_monitor.cancel()
+    await database.dispose_engines()
+
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)   #orjson encodes responses several times faster than the stdlib json module
 # @app.get("/sqlalchemy")
 # def test_posts(db: Session = Depends(get_db)):   #Tells FastAPI to call get_db to create a SQLAlchemy Session, pass it in as db, and then close it when the request finishes
 #     posts = db.query(models.Post).all()              #fetch all the posts from the database
@@ -27,6 +95,126 @@ app.include_router(post.router)
 app.include_router(user.router)
 app.include_router(auth.router)
 app.include_router(votes.router)
+app.include_router(live_router.router)
+app.include_router(admin.router)
+
+#too many logins/signups queued for argon2, shed them instead of letting them pile up
+@app.exception_handler(utils.PasswordHashingBusy)
+async def password_hashing_busy(request: Request, exc: utils.PasswordHashingBusy):
+    return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={"detail": "Server is busy, try again shortly"},
+                        headers={"Retry-After": "1"})
+
+#rate limits and admission control, declared before instrument_requests so rejected requests still show up in its metrics
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    if request.url.path in ratelimit.EXEMPT_PATHS:
+        return await call_next(request)
+
+    rate_limiter = ratelimit.get_rate_limiter()
+    if rate_limiter is not None:
+        rejected = await rate_limiter.check(request)
+        if rejected is not None:
+            rule, retry_after = rejected
+            metrics.http_requests_rejected.inc(reason="rate_limit", rule=rule.route)
+            return JSONResponse(status_code=status.HTTP_429_TOO_MANY_REQUESTS, content={"detail": "Too many requests, slow down"},
+                                headers={"Retry-After": ratelimit.retry_after_header(retry_after)})
+
+    admission = ratelimit.get_admission()
+    if admission is None or request.url.path in ratelimit.STREAMING_PATHS:
+        return await call_next(request)
+    if not await admission.acquire():
+        metrics.http_requests_rejected.inc(reason="overloaded", rule="")
+        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={"detail": "Server is busy, try again shortly"},
+                            headers={"Retry-After": "1"})
+    try:
+        return await call_next(request)
+    finally:
+        admission.release()
+
+#times every request and the sql it runs, feeds /metrics and the Server-Timing header
+#QUERY_BUDGET also catches N+1 queries during development, requests going over it fail with a 500 listing their statements
+@app.middleware("http")
+async def instrument_requests(request: Request, call_next):
+    started = time.perf_counter()
+    with metrics.count_queries() as counter:
+        try:
+            response = await call_next(request)
+        except Exception:
+            metrics.record_request(request.method, _route_name(request), 500, time.perf_counter() - started, counter)
+            raise
+    elapsed = time.perf_counter() - started
+    metrics.record_request(request.method, _route_name(request), response.status_code, elapsed, counter)
+
+    #read your writes--> after a successful write the user's reads go to the primary for a few seconds, before the response leaves
+    if request.method not in ("GET", "HEAD", "OPTIONS") and response.status_code < 400:
+        await replicas.pin_to_primary(request)
+
+    if settings.query_budget and counter.count > settings.query_budget:
+        error = metrics.QueryBudgetExceeded(counter, settings.query_budget)
+        logger.error("query budget exceeded", extra={"path": request.url.path, "queries": counter.count, "budget": settings.query_budget})
+        response = JSONResponse(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, content={"detail": str(error)})
+
+    response.headers["X-Query-Count"] = str(counter.count)
+    if settings.server_timing:
+        response.headers["Server-Timing"] = (f'app;dur={elapsed * 1000:.2f}, db;dur={counter.db_seconds * 1000:.2f};desc="{counter.count} queries", '
+                                             f'pool;dur={counter.pool_wait_seconds * 1000:.2f}')
+    return response
+
+#added last so it is the outermost middleware, the 429/503 and query budget 500 answered above carry the CORS headers too
+#otherwise a browser sees a CORS failure instead of the status and Retry-After
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=origins,
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Server-Timing", "X-Query-Count", "Retry-After"],   #browsers hide custom response headers unless we expose them
+)
+
+
+def _route_name(request: Request):
+    #the route template(/posts/{id}), not the raw path, so every post id doesnt become its own metric
+    route = request.scope.get("route")
+    return route.path if route is not None else "unmatched"
+
+
+#liveness--> the process is up and serving, never touches the database so a database outage doesnt get workers restarted
+@app.get("/health/live")
+async def health_live():
+    return {"status": "ok"}
+
+
+#readiness--> the database answers, load balancers should only send traffic while this is 200
+@app.get("/health/ready")
+async def health_ready():
+    if not getattr(app.state, "database_ready", False):
+        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={"status": "starting"})
+    try:
+        await asyncio.wait_for(database.ping(), settings.health_check_timeout)
+    except Exception:
+        return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={"status": "database unavailable"})
+    return {"status": "ok"}
+
+
+#prometheus scrape endpoint
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+#connection pool usage per engine, lets us tell pool starvation apart from slow queries
+@app.get("/metrics/pool")
+def pool_metrics():
+    return metrics.pool_snapshot()
+
+#health and replication lag of each read replica as of the last check
+@app.get("/metrics/replicas")
+def replica_metrics():
+    return replicas.get_replica_set().snapshot()
+
+#live connections and posts followed on this worker, with the flushes and frames sent so far
+@app.get("/metrics/live")
+def live_metrics():
+    return live.get_hub().snapshot()
 
 @app.get("/")   #decorator- Links the url to the python code below
 async def root():
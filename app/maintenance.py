@@ -0,0 +1,180 @@
+#maintenance commands that we run by hand or from cron, not through the api
+#usage: python -m app.maintenance reconcile-votes [--dry-run]
+#       python -m app.maintenance export TABLE [--format ndjson|csv] [--output FILE]
+#       python -m app.maintenance import TABLE FILE [--format ndjson|csv] [--batch-size N] [--skip-missing] [--restart]
+#       python -m app.maintenance create-partitions [--months-ahead 3]
+#       python -m app.maintenance archive-posts [--older-than-months 12] [--detach-only]
+import argparse
+import asyncio
+import json
+import os
+import sys
+from sqlalchemy import func
+from . import models, bulk, partitions, database
+
+
+def find_vote_drift(db):
+    #real vote totals per post, compared against the denormalized posts.vote_count
+    actual = db.query(models.Votes.post_id, func.count(models.Votes.post_id).label("total"))\
+    .group_by(models.Votes.post_id).subquery()
+    actual_total = func.coalesce(actual.c.total, 0)
+
+    return db.query(models.Post.id, models.Post.vote_count, actual_total.label("actual"))\
+    .outerjoin(actual, actual.c.post_id == models.Post.id)\
+    .filter(models.Post.vote_count != actual_total).all()
+
+
+def reconcile_votes(db, dry_run=False):
+    drifted = find_vote_drift(db)
+    for row in drifted:
+        print(f"post {row.id}: vote_count={row.vote_count} actual={row.actual}")
+
+    if drifted and not dry_run:
+        #recount inside the UPDATE itself so votes that land while this runs are not lost
+        recount = db.query(func.count(models.Votes.post_id))\
+        .filter(models.Votes.post_id == models.Post.id).scalar_subquery()
+        db.query(models.Post).filter(models.Post.id.in_([row.id for row in drifted]))\
+        .update({models.Post.vote_count: recount}, synchronize_session=False)
+        db.commit()
+
+    return drifted
+
+
+async def export_table(table, format, output):
+    #stdout when no file is given, e.g. piped straight into gzip
+    out = open(output, "wb") if output else sys.stdout.buffer
+    rows = 0
+    try:
+        async for chunk in bulk.export_chunks(table, format):
+            out.write(chunk)
+            rows += chunk.count(b"\n")
+    finally:
+        if output:
+            out.close()
+    return rows - (format == "csv")   #csv starts with a header line
+
+
+async def _read_file(f, size=64 * 1024):
+    while True:
+        chunk = f.read(size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def checkpoint_path(path):
+    return f"{path}.checkpoint.json"
+
+
+async def import_table(table, path, format, batch_size=0, skip_missing=False, restart=False):
+    #after every committed batch the byte offset after its last row goes into FILE.checkpoint.json
+    #running the same command again after a crash/failed batch continues from there, the file is removed once everything is in
+    checkpoint_file = checkpoint_path(path)
+    checkpoint = {"table": table, "format": format, "offset": 0, "rows": 0, "header": None}
+    if os.path.exists(checkpoint_file) and not restart:
+        with open(checkpoint_file) as f:
+            saved = json.load(f)
+        if (saved["table"], saved["format"]) != (table, format):
+            raise SystemExit(f"{checkpoint_file} belongs to a {saved['format']} import of {saved['table']}, use --restart to ignore it")
+        checkpoint = saved
+        print(f"resuming after row {checkpoint['rows']}(byte {checkpoint['offset']})", file=sys.stderr)
+    rows_before = checkpoint["rows"]
+
+    async def save(result, offset, header):
+        checkpoint.update(offset=offset, rows=rows_before + result.rows_read, header=header)
+        with open(checkpoint_file + ".tmp", "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(checkpoint_file + ".tmp", checkpoint_file)   #a crash mid write never leaves half a checkpoint
+        print(f"{checkpoint['rows']} rows", file=sys.stderr)
+
+    with open(path, "rb") as f:
+        f.seek(checkpoint["offset"])
+        result = await bulk.import_rows(table, format, _read_file(f), offset=checkpoint["offset"], header=checkpoint["header"],
+                                        skip_missing=skip_missing, batch_size=batch_size, on_batch=save)
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+    return result
+
+
+def _format(path, format):
+    if format:
+        return format
+    extension = os.path.splitext(path)[1].lstrip(".").lower()
+    return extension if extension in bulk.FORMATS else "ndjson"
+
+
+def _print_archived(archived):
+    for name, rows in archived:
+        print(f"detached {name}, it is now a standalone table" if rows is None else f"archived {rows} post(s) from {name}")
+    print(f"{len(archived)} partition(s) done")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.maintenance")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    reconcile = commands.add_parser("reconcile-votes", help="find and repair drift between posts.vote_count and the votes table")
+    reconcile.add_argument("--dry-run", action="store_true", help="only report drifted posts, dont fix them")
+
+    export = commands.add_parser("export", help="write a whole table as ndjson or csv through COPY")
+    export.add_argument("table", choices=tuple(bulk.TABLES))
+    export.add_argument("--format", choices=bulk.FORMATS, help="default from the output file's extension, else ndjson")
+    export.add_argument("--output", help="file to write, default stdout")
+
+    load = commands.add_parser("import", help="load an ndjson/csv file into a table through COPY, import users then posts then votes")
+    load.add_argument("table", choices=tuple(bulk.TABLES))
+    load.add_argument("file")
+    load.add_argument("--format", choices=bulk.FORMATS, help="default from the file's extension, else ndjson")
+    load.add_argument("--batch-size", type=int, default=0, help="rows per batch and commit, default BULK_BATCH_SIZE")
+    load.add_argument("--skip-missing", action="store_true", help="skip rows referencing users/posts that dont exist instead of stopping")
+    load.add_argument("--restart", action="store_true", help="ignore a checkpoint left by an earlier run and start from the top")
+
+    create = commands.add_parser("create-partitions", help="create the monthly posts partitions for this month and the next ones")
+    create.add_argument("--months-ahead", type=int, default=3)
+
+    archive = commands.add_parser("archive-posts", help="move months of posts older than the cutoff into posts_archive")
+    archive.add_argument("--older-than-months", type=int, default=12, help="months that ended more than this many months ago")
+    archive.add_argument("--detach-only", action="store_true",
+                         help="only detach the old partitions as standalone tables(to dump and drop them), their posts become unreadable")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        rows = asyncio.run(export_table(args.table, _format(args.output or "", args.format), args.output))
+        print(f"exported {rows} {args.table} row(s)", file=sys.stderr)
+        return
+    if args.command == "import":
+        try:
+            result = asyncio.run(import_table(args.table, args.file, _format(args.file, args.format), batch_size=args.batch_size,
+                                              skip_missing=args.skip_missing, restart=args.restart))
+        except bulk.BulkImportError as error:
+            raise SystemExit(f"import stopped, {error}\nfix the file or use --skip-missing and run the same command again to continue")
+        except ValueError as error:   #a line that isnt json/csv
+            raise SystemExit(f"import stopped, {error}")
+        print(json.dumps(result.as_dict()))
+        return
+
+    db = database.get_sessionmaker()()
+    try:
+        if args.command == "reconcile-votes":
+            drifted = reconcile_votes(db, dry_run=args.dry_run)
+            action = "found" if args.dry_run else "repaired"
+            print(f"{action} {len(drifted)} drifted post(s)")
+        elif args.command == "create-partitions":
+            created = partitions.create_partitions(db, args.months_ahead)
+            for name in created:
+                print(f"created {name}")
+            print(f"created {len(created)} partition(s)")
+        elif args.command == "archive-posts":
+            try:
+                archived = partitions.archive_partitions(db, args.older_than_months, detach_only=args.detach_only)
+            except partitions.ArchiveConflict as error:
+                _print_archived(error.archived)
+                raise SystemExit(f"archive stopped, {error}")
+            _print_archived(archived)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+#in-process metrics, kept as plain counters so reading them never touches the database
+import contextvars
+import threading
+from contextlib import contextmanager
+
+
+class PoolStats:
+    #filled in by the instrumented pools in database.py and by sqlalchemy pool events
+    def __init__(self):
+        self._lock = threading.Lock()   #sync mode checks out connections from many threadpool threads at once
+        self.checkouts = 0
+        self.connects = 0
+        self.invalidations = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def record_wait(self, seconds: float):
+        with self._lock:
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+    def increment(self, name: str):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+
+_pools = {}   #name--> (engine, PoolStats)
+
+
+def register_pool(name: str, engine, stats: PoolStats):
+    _pools[name] = (engine, stats)
+
+
+def pool_snapshot():
+    snapshot = {}
+    for name, (engine, stats) in _pools.items():
+        pool = engine.pool
+        data = {
+            "checkouts": stats.checkouts,
+            "connects": stats.connects,
+            "invalidations": stats.invalidations,
+            "timeouts": stats.timeouts,
+            "wait_seconds_total": round(stats.wait_seconds_total, 6),
+            "wait_seconds_max": round(stats.wait_seconds_max, 6),
+        }
+        #NullPool(pgbouncer mode) keeps no connections of its own, so it has no size/overflow to report
+        if hasattr(pool, "checkedout"):
+            data.update({
+                "size": pool.size(),
+                "checked_out": pool.checkedout(),
+                "checked_in": pool.checkedin(),
+                "overflow": max(pool.overflow(), 0),   #overflow() is negative while the pool is still filling up
+            })
+        snapshot[name] = data
+    return snapshot
+
+
+#everything we measure for the request being handled, kept in a contextvar
+#threadpool calls in sync mode run in a copy of the request context, they share the same objects so their numbers count too
+#counters nest--> every active one sees each statement, so a query_budget around a request still counts what the
+#request's own counter(instrument_requests) counts
+_query_counters = contextvars.ContextVar("query_counters", default=())
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self.db_seconds = 0.0
+        self.pool_wait_seconds = 0.0
+        self.statements = []   #kept so a budget failure can show which queries ran
+
+
+class QueryBudgetExceeded(Exception):
+    def __init__(self, counter: QueryCounter, budget: int):
+        self.counter = counter
+        self.budget = budget
+        super().__init__(f"{counter.count} queries, budget is {budget}:\n" + "\n".join(counter.statements))
+
+
+def current_counter():
+    #the innermost one
+    counters = _query_counters.get()
+    return counters[-1] if counters else None
+
+
+def record_statement(statement: str, seconds: float):
+    #called by the after_cursor_execute hook on every engine(see database.py)
+    db_query_seconds.observe(seconds)
+    for counter in _query_counters.get():
+        counter.count += 1
+        counter.db_seconds += seconds
+        counter.statements.append(statement)
+
+
+def record_pool_wait(seconds: float):
+    for counter in _query_counters.get():
+        counter.pool_wait_seconds += seconds
+
+
+@contextmanager
+def count_queries():
+    counter = QueryCounter()
+    token = _query_counters.set(_query_counters.get() + (counter,))
+    try:
+        yield counter
+    finally:
+        _query_counters.reset(token)
+
+
+@contextmanager
+def query_budget(budget: int):
+    #fails when the code inside runs more than `budget` statements, eg. `with query_budget(2): await client.get("/posts/?limit=100")`
+    #the app has to run in-process(TestClient or httpx.ASGITransport), it cant count a server in another process, see benchmarks/query_budget.py
+    with count_queries() as counter:
+        yield counter
+    if counter.count > budget:
+        raise QueryBudgetExceeded(counter, budget)
+
+
+#prometheus style metrics, rendered by hand in the text exposition format so we dont need prometheus_client
+def _format_labels(names, values, extra=""):
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}   #label values--> total
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets, labelnames=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labelnames = labelnames
+        self._values = {}   #label values--> [count per bucket..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[index] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, data in sorted(self._values.items()):
+                for bound, count in zip(self.buckets + ("+Inf",), data[:-2] + [data[-1]]):
+                    le = f'le="{bound}"'
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {data[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {data[-1]}")
+        return lines
+
+
+http_request_seconds = Histogram("http_request_duration_seconds", "Request latency by route",
+                                 (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10), ("method", "route", "status"))
+http_request_db_statements = Counter("http_request_db_statements_total", "SQL statements run by requests, by route", ("method", "route"))
+http_request_db_seconds = Counter("http_request_db_seconds_total", "Time spent in SQL statements by requests, by route", ("method", "route"))
+http_request_pool_wait_seconds = Counter("http_request_pool_wait_seconds_total", "Time requests waited for a pooled connection, by route", ("method", "route"))
+http_requests_rejected = Counter("http_requests_rejected_total", "Requests refused before reaching a handler, by reason(rate_limit, overloaded) and rate limit rule",
+                                 ("reason", "rule"))
+db_query_seconds = Histogram("db_query_duration_seconds", "Latency of single SQL statements",
+                             (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+
+
+def record_request(method: str, route: str, status: int, seconds: float, counter: QueryCounter):
+    http_request_seconds.observe(seconds, method=method, route=route, status=status)
+    http_request_db_statements.inc(counter.count, method=method, route=route)
+    http_request_db_seconds.inc(counter.db_seconds, method=method, route=route)
+    http_request_pool_wait_seconds.inc(counter.pool_wait_seconds, method=method, route=route)
+
+
+def render_prometheus():
+    lines = []
+    for metric in (http_request_seconds, http_request_db_statements, http_request_db_seconds, http_request_pool_wait_seconds, http_requests_rejected, db_query_seconds):
+        lines.extend(metric.render())
+
+    #pool numbers come from pool_snapshot, counters and the current size/checked out gauges
+    pools = pool_snapshot()
+    for field, kind, help in (
+        ("checkouts", "counter", "Connections handed out by the pool"),
+        ("connects", "counter", "New database connections opened"),
+        ("invalidations", "counter", "Connections thrown away after an error"),
+        ("timeouts", "counter", "Checkouts that gave up waiting for a free connection"),
+        ("wait_seconds_total", "counter", "Total time spent waiting for a free connection"),
+        ("checked_out", "gauge", "Connections currently in use"),
+        ("overflow", "gauge", "Connections open beyond pool_size"),
+    ):
+        name = f"db_pool_{field}" if field.endswith("_total") or kind == "gauge" else f"db_pool_{field}_total"
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for pool_name, data in sorted(pools.items()):
+            if field in data:
+                lines.append(f'{name}{{pool="{pool_name}"}} {data[field]}')
+    return "\n".join(lines) + "\n"
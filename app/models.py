@@ -1,14 +1,14 @@
 #this is where we create tables for our sql
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Index, Computed, Float
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from .database import Base
 from sqlalchemy.sql.sqltypes import TIMESTAMP
 from sqlalchemy.sql.expression import text
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, deferred
 
 
-print("🔥 models.py is being executed!")
-print(f"📦 Base in models.py: {Base}")
-
+#partitioned by month of created_at(see app/partitions.py), so in the database the primary key is (id, created_at)
+#id alone still identifies a post(it comes from one sequence), which is all the orm needs
 class Post(Base):
     __tablename__ = "posts"
 
@@ -18,9 +18,40 @@ class Post(Base):
     published = Column(Boolean, server_default='TRUE', nullable=False)
     created_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
     owner_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    vote_count = Column(Integer, nullable=False, server_default='0')  #denormalized count of rows in votes, kept in sync by routers/votes.py
+    #full text search document, generated by postgres from title(weight A) and content(weight B)
+    #deferred--> only loaded when a query asks for it, normal post reads dont need it
+    search_vector = deferred(Column(TSVECTOR, Computed(
+        "setweight(to_tsvector('english', coalesce(title, '')), 'A') || setweight(to_tsvector('english', coalesce(content, '')), 'B')",
+        persisted=True)))
     
-    owner = relationship("User")  #this user is the class user which we created below--> Fetches the owner info that is trying to fetch the information
+    owner = relationship("User", lazy="raise")  #this user is the class user which we created below--> Fetches the owner info that is trying to fetch the information
+    #lazy="raise"--> a query that forgets to load the owner fails loudly instead of quietly running one SELECT users per post(N+1)
+
+    #composite index for the feed order(newest first), lets cursor pagination jump straight to the next page
+    __table_args__ = (
+        Index("ix_posts_created_at_id", created_at.desc(), id.desc()),
+        Index("ix_posts_search_vector", "search_vector", postgresql_using="gin"),
+        #trigram index so the old search= substring filter(LIKE '%term%') can use an index too
+        Index("ix_posts_title_trgm", "title", postgresql_using="gin", postgresql_ops={"title": "gin_trgm_ops"}),
+    )
+
+
 
+#trending rank of every post in posts, reddit style "hot" score--> log10 of the votes plus the age bonus, every 45000s(12.5h)
+#newer is worth 10x the votes. written only by triggers on posts(post_hot_score() in the database), in the same transaction
+#as the vote_count change so it is always exact and older posts sink without any periodic job
+#its own table because an indexed score on posts made every vote rewrite all of the posts indexes(no HOT updates)
+class PostScore(Base):
+    __tablename__ = "post_scores"
+
+    post_id = Column(Integer, primary_key=True)   #no foreign key, same as votes.post_id
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False)   #the post's, joins back to posts within one partition
+    hot_score = Column(Float(precision=53), nullable=False)
+
+    __table_args__ = (
+        Index("ix_post_scores_hot_score_post_id", hot_score.desc(), post_id.desc()),   #GET /posts/trending reads a page straight off this index
+    )
 
 
 #this is what will be stored in the database from the backend
@@ -33,8 +64,28 @@ class User(Base):
     created_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
 
 
+#old months of posts moved out of the partitioned table by python -m app.maintenance archive-posts, read only
+class PostArchive(Base):
+    __tablename__ = "posts_archive"
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    title = Column(String, nullable=False)
+    content = Column(String, nullable=False)
+    published = Column(Boolean, nullable=False)
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False)
+    owner_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    vote_count = Column(Integer, nullable=False)
+
+    owner = relationship("User", lazy="raise")
+
+
 class Votes(Base):
     __tablename__ = "votes"
 
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
-    post_id = Column(Integer, ForeignKey("posts.id", ondelete="CASCADE"), primary_key=True)
\ No newline at end of file
+    #no foreign key, posts is partitioned and has no unique key on id alone, the votes_check_post/posts_delete_votes triggers do its job
+    post_id = Column(Integer, primary_key=True)
+
+    __table_args__ = (
+        Index("ix_votes_post_id", post_id),
+    )
\ No newline at end of file
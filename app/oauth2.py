@@ -1,54 +1,121 @@
+import hashlib
+import time
 import jwt
 from jwt.exceptions import PyJWTError
 from datetime import datetime, timedelta
-from . import schemas, database, models
-from sqlalchemy.orm import Session
-from fastapi import Depends, status, HTTPException
+from . import schemas, database, models, cache
+from sqlalchemy import select
+from fastapi import Depends, Request, status, HTTPException
 from fastapi.security import OAuth2PasswordBearer
 from .config import settings 
 
 oauth2scheme = OAuth2PasswordBearer('login')  #we pass in the path operation that is needed 
 
 #we need 3 pieces of info--> SecretKey, Algorithm, expiration time
-SECRET_KEY = settings.secret_key  #RANDOM STRING
-ALGORITHM = settings.algorithm
-ACCESS_TOKEN_EXPIRE_MINUTES = settings.access_token_expire_minutes
+#read from settings on every use, not copied into constants here, so a changed SECRET_KEY/ALGORITHM takes effect(and clears token_cache)
+
+#authenticated users keyed by id, saves a users lookup on every protected request
+#nothing in the app changes or deletes a user's id/email/created_at, so entries are never invalidated, only expire
+#a user changed or deleted straight in the database is still served from here for up to USER_CACHE_TTL_SECONDS
+user_cache = cache.LazyBackend(lambda: cache.create_backend("users", settings.user_cache_max_size, settings.user_cache_ttl_seconds))
+
+#verified tokens keyed by a hash of the token, clients send the same bearer token on every request of a session
+#created by the first verification and replaced whenever the signing key changes
+token_cache = None
+_token_cache_signer = None   #(secret key, algorithm) the cached results were verified with
 
 
 def create_token(data:dict):   
     to_encode = data.copy()   #payload creation
 
     #creating expiration date for token
-    expire = datetime.now() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    expire = datetime.now() + timedelta(minutes=settings.access_token_expire_minutes)
     to_encode.update({"exp": expire})
 
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    encoded_jwt = jwt.encode(to_encode, settings.secret_key, algorithm=settings.algorithm)
 
     return encoded_jwt
 
 
 
 def verify__access_token(token: str, credentials_exception):
+    global token_cache, _token_cache_signer
+
+    #results verified with an old key must not survive a SECRET_KEY rotation
+    signer = (settings.secret_key, settings.algorithm)
+    if _token_cache_signer != signer:
+        token_cache = cache.TTLCache(settings.token_cache_max_size, settings.token_cache_ttl_seconds)
+        _token_cache_signer = signer
+
+    cache_key = hashlib.sha256(token.encode()).hexdigest()   #hash so the cache never holds usable tokens
+    token_data = token_cache.get(cache_key)
+    if token_data is not None:
+        return token_data
 
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, signer[0], algorithms=[signer[1]])
 
         id: str = payload.get("user_id")  #this user_id is from auth.py
         
         if id is None:
             raise credentials_exception
         token_data = schemas.TokenData(id=id)
-        return token_data
     except PyJWTError:
         raise credentials_exception
+
+    #never keep a verified token around past its own expiry
+    ttl = settings.token_cache_ttl_seconds
+    if "exp" in payload:
+        ttl = min(ttl, payload["exp"] - time.time())
+    if ttl > 0:
+        token_cache.set(cache_key, token_data, ttl)
+    return token_data
     
 
 
-def get_current_user(token: str = Depends(oauth2scheme), db: Session = Depends(database.get_db)):
+def user_id_from_request(request: Request):
+    #who is asking according to a valid bearer token, without a database lookup(verified tokens are cached)
+    #for routing and limits only, None for anonymous requests and bad tokens, endpoints still use get_current_user
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        return verify__access_token(token, HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)).id
+    except HTTPException:
+        return None
+
+
+async def get_current_user(token: str = Depends(oauth2scheme), db = Depends(database.get_session)):
     credentials_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials"
                                           , headers={"WWW-Authenticate": "Bearer"})
     
     token = verify__access_token(token, credentials_exception)
 
-    user = db.query(models.User).filter(models.User.id == token.id).first()
-    return user
\ No newline at end of file
+    #hot paths only need the id, so optionally trust the signed token instead of looking the user up
+    if settings.auth_trust_token_claims:
+        return schemas.CurrentUser(id=token.id)
+
+    cached_user = await user_cache.get(str(token.id))
+    if cached_user is not None:
+        return schemas.CurrentUser(**cached_user)
+
+    result = await db.execute(select(models.User).where(models.User.id == token.id))
+    user = result.scalars().first()
+    if user is None:   #token is valid but the user was deleted
+        raise credentials_exception
+
+    current_user = schemas.CurrentUser.model_validate(user)
+    await user_cache.set(str(user.id), current_user.model_dump(mode="json"))
+    return current_user
+
+
+async def get_current_moderator(current_user: schemas.CurrentUser = Depends(get_current_user)):
+    if current_user.id not in settings.moderator_ids:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Moderators only")
+    return current_user
+
+
+async def get_current_admin(current_user: schemas.CurrentUser = Depends(get_current_user)):
+    if current_user.id not in settings.admin_ids:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admins only")
+    return current_user
@@ -0,0 +1,70 @@
+#helpers for keyset(cursor) pagination of the feed
+#the feed cursor is the (created_at, id) of the last post on a page, signed with our SECRET_KEY so clients cant forge or edit it
+import base64
+import hashlib
+import hmac
+import json
+from datetime import datetime
+from fastapi import HTTPException, status
+from .config import settings
+
+
+def _sign(payload: bytes):
+    return hmac.new(settings.secret_key.encode(), payload, hashlib.sha256).digest()
+
+
+def _b64encode(raw: bytes):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def _b64decode(data: str):
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _encode(data: dict):
+    payload = json.dumps(data, separators=(",", ":")).encode()
+    return f"{_b64encode(payload)}.{_b64encode(_sign(payload))}"
+
+
+def _decode(cursor: str):
+    invalid_cursor = HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+    try:
+        payload_part, signature_part = cursor.split(".")
+        payload = _b64decode(payload_part)
+        signature = _b64decode(signature_part)
+    except ValueError:   #covers bad splits and bad base64(binascii.Error is a ValueError)
+        raise invalid_cursor
+
+    #compare_digest so the check does not leak timing info
+    if not hmac.compare_digest(signature, _sign(payload)):
+        raise invalid_cursor
+
+    try:
+        return json.loads(payload)
+    except ValueError:
+        raise invalid_cursor
+
+
+def encode_cursor(created_at: datetime, post_id: int):
+    return _encode({"c": created_at.isoformat(), "i": post_id})
+
+
+def decode_cursor(cursor: str):
+    data = _decode(cursor)
+    try:
+        return datetime.fromisoformat(data["c"]), int(data["i"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+
+#search results(relevance) and the trending feed(hot score) are ordered by a score, so their cursor is (rank, id) instead
+def encode_rank_cursor(rank: float, post_id: int):
+    return _encode({"r": rank, "i": post_id})
+
+
+def decode_rank_cursor(cursor: str):
+    data = _decode(cursor)
+    try:
+        return float(data["r"]), int(data["i"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
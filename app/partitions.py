@@ -0,0 +1,103 @@
+#monthly range partitions of posts(by created_at, utc months) and archival of old months into posts_archive
+#used by python -m app.maintenance create-partitions / archive-posts, run them from cron(e.g. daily)
+#
+#posts_yYYYYmMM--> one partition per month. there is deliberately no default partition: with one postgres cant read the
+#partitions in created_at order and stop early(the feed would touch every partition on every page), and every new partition
+#would have to scan it. so a post can only be written into a month that exists--> create-partitions keeps a few months ready
+#ahead, bulk imports create the months they need(app/bulk.py)
+#posts_archive--> plain table with only a primary key, no generated search/trending columns or their indexes(lz4 toast when available),
+#GET /posts/{id} still finds archived posts there, everything else(feeds, search, votes, edits) only sees posts
+import re
+from datetime import datetime, timezone
+from sqlalchemy import text
+
+ARCHIVE = "posts_archive"
+COLUMNS = "id, title, content, published, created_at, owner_id, vote_count"   #everything except the generated columns
+LOCK_TIMEOUT = "5s"   #DDL on posts waits at most this long for its lock instead of queueing every request behind it
+#room left in every page, a vote rewrites its post's row and with space on the same page that is a HOT update(no index is touched)
+FILLFACTOR = 90
+_PARTITION_NAME = re.compile(r"^posts_y(\d{4})m(\d{2})$")
+
+
+class ArchiveConflict(Exception):
+    #some posts of a month already have their id in posts_archive, the month was left attached and untouched
+    def __init__(self, message: str, archived: list):
+        super().__init__(message)
+        self.archived = archived   #months done before it, those stay archived
+
+
+def month_start(moment: datetime):
+    moment = moment.astimezone(timezone.utc)
+    return datetime(moment.year, moment.month, 1, tzinfo=timezone.utc)
+
+
+def add_months(month: datetime, count: int):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def partition_name(month: datetime):
+    return f"posts_y{month.year}m{month.month:02d}"
+
+
+def create_partition_sql(month: datetime):
+    #IF NOT EXISTS--> a month created meanwhile(by an import or another run) is fine
+    return (f"CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF posts "
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}') WITH (fillfactor = {FILLFACTOR})")
+
+
+def list_partitions(db):
+    #(name, first day of its month) of the attached month partitions, oldest first
+    names = db.execute(text("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                            "WHERE i.inhparent = 'posts'::regclass")).scalars().all()
+    partitions = []
+    for name in names:
+        match = _PARTITION_NAME.match(name)
+        if match:
+            partitions.append((name, datetime(int(match.group(1)), int(match.group(2)), 1, tzinfo=timezone.utc)))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def create_partitions(db, months_ahead: int, now: datetime = None):
+    #this month and the next months_ahead, the ones that already exist are left alone
+    current = month_start(now or datetime.now(timezone.utc))
+    existing = {name for name, _ in list_partitions(db)}
+    created = []
+    for offset in range(months_ahead + 1):
+        month = add_months(current, offset)
+        if partition_name(month) not in existing:
+            db.execute(text(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'"))
+            db.execute(text(create_partition_sql(month)))
+            db.commit()
+            created.append(partition_name(month))
+    return created
+
+
+def archive_partitions(db, older_than_months: int, detach_only: bool = False, now: datetime = None):
+    #months that ended more than older_than_months ago leave posts, returns (partition, rows archived)
+    #detach_only--> the month becomes a standalone table(dump it, then drop it), its posts are no longer readable through the api
+    if older_than_months < 1:
+        raise ValueError("older_than_months must be at least 1, the current month is never archived")
+    cutoff = add_months(month_start(now or datetime.now(timezone.utc)), -older_than_months)
+    archived = []
+    for name, month in list_partitions(db):
+        if add_months(month, 1) > cutoff:
+            break
+        db.execute(text(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'"))
+        #detaching is catalog only, no trigger sees the rows leave so their votes stay for voted_by_me on the archived post
+        #and their trending scores are deleted here, archived posts arent in trending
+        db.execute(text(f"ALTER TABLE posts DETACH PARTITION {name}"))
+        db.execute(text(f"DELETE FROM post_scores WHERE post_id IN (SELECT id FROM {name})"))
+        rows = None
+        if not detach_only:
+            total = db.execute(text(f"SELECT count(*) FROM {name}")).scalar()
+            rows = db.execute(text(f"INSERT INTO {ARCHIVE} ({COLUMNS}) SELECT {COLUMNS} FROM {name} ON CONFLICT (id) DO NOTHING")).rowcount
+            if rows != total:
+                #dropping the partition now would lose the posts that were skipped, undo the detach instead
+                db.rollback()
+                raise ArchiveConflict(f"{name}: {total - rows} of its {total} post(s) already have their id in {ARCHIVE}, "
+                                      f"nothing was archived from it", archived)
+            db.execute(text(f"DROP TABLE {name}"))
+        db.commit()   #one month per transaction, a failure leaves the months before it done
+        archived.append((name, rows))
+    return archived
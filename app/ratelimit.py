@@ -0,0 +1,243 @@
+#rate limiting and admission control, both run in a middleware before any endpoint code(so before argon2 or the pool)
+#rate limits--> per route rules from RATE_LIMIT_RULES, keyed by user or ip, answered with 429 + Retry-After
+#admission--> caps the requests one worker handles at once, the rest wait briefly and are then shed with 503 + Retry-After
+import asyncio
+import logging
+import math
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from fastapi import Request
+from .config import settings
+from . import cache, oauth2
+
+logger = logging.getLogger(__name__)
+
+PERIODS = {"second": 1, "minute": 60, "hour": 3600}
+ALGORITHMS = ("token_bucket", "sliding_window")
+
+#never limited, probes and scrapers must keep working while the app sheds load
+EXEMPT_PATHS = {"/health/live", "/health/ready", "/metrics", "/metrics/pool", "/metrics/replicas", "/metrics/live"}
+#rate limited but never admission controlled, a stream would hold its slot for as long as the client stays connected
+STREAMING_PATHS = {"/live/votes"}
+
+
+class Rule:
+    def __init__(self, route: str, spec: str):
+        #spec--> "20/minute ip sliding_window"
+        try:
+            rate, key_by, algorithm = spec.split()
+            count, period = rate.split("/")
+            self.limit = int(count)
+            self.period = PERIODS[period]
+        except (ValueError, KeyError):
+            raise ValueError(f"invalid rate limit for {route!r}: {spec!r}, expected '<count>/<second|minute|hour> <user|ip> <algorithm>'")
+        if key_by not in ("user", "ip") or algorithm not in ALGORITHMS or self.limit < 1:
+            raise ValueError(f"invalid rate limit for {route!r}: {spec!r}")
+        self.route = route
+        self.key_by = key_by
+        self.algorithm = algorithm
+
+
+def parse_rules(rules: dict):
+    return {route: Rule(route, spec) for route, spec in rules.items()}
+
+
+class MemoryLimiterStore:
+    #per worker, a client spread over several workers gets up to workers x the limit
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self._state = OrderedDict()   #key--> algorithm state, least recently used first
+
+    def _get(self, key, default):
+        state = self._state.pop(key, None)
+        self._state[key] = state if state is not None else default
+        while len(self._state) > self.max_keys:
+            self._state.popitem(last=False)
+        return self._state[key]
+
+    async def token_bucket(self, key: str, capacity: int, rate: float):
+        #capacity tokens, refilled at rate per second, a request takes one
+        now = time.monotonic()
+        state = self._get(key, [float(capacity), now])
+        tokens = min(capacity, state[0] + (now - state[1]) * rate)
+        state[1] = now
+        if tokens >= 1:
+            state[0] = tokens - 1
+            return True, 0.0
+        state[0] = tokens
+        return False, (1 - tokens) / rate
+
+    async def sliding_window(self, key: str, limit: int, window: float):
+        #sliding window counter--> this window's count plus the previous window's, weighted by how much of it still overlaps
+        now = time.time()
+        current = int(now // window)
+        state = self._get(key, [current, 0, 0])   #[window number, count in it, count in the one before]
+        if state[0] != current:
+            state[2] = state[1] if state[0] == current - 1 else 0
+            state[0], state[1] = current, 0
+        allowed, retry_after = _window_decision(state[1], state[2], limit, window, now - current * window)
+        if allowed:
+            state[1] += 1
+        return allowed, retry_after
+
+
+def _window_decision(current_count, previous_count, limit, window, elapsed):
+    weight = 1 - elapsed / window
+    if previous_count * weight + current_count + 1 <= limit:
+        return True, 0.0
+    if current_count + 1 > limit:
+        return False, window - elapsed   #full even without the previous window, wait for the next one
+    #wait until enough of the previous window has slid out
+    needed_weight = (limit - current_count - 1) / previous_count
+    return False, (1 - needed_weight) * window - elapsed
+
+
+#the same algorithms as MemoryLimiterStore as lua scripts, each decision is one atomic round trip and uses the redis clock
+#so every worker(and host) agrees on time
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    retry_after = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000))
+return {allowed, tostring(retry_after)}
+"""
+
+SLIDING_WINDOW_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local current = math.floor(now / window)
+local elapsed = now - current * window
+local current_key = KEYS[1] .. ':' .. current
+local current_count = tonumber(redis.call('GET', current_key)) or 0
+local previous_count = tonumber(redis.call('GET', KEYS[1] .. ':' .. (current - 1))) or 0
+local weight = 1 - elapsed / window
+if previous_count * weight + current_count + 1 <= limit then
+    redis.call('INCR', current_key)
+    redis.call('PEXPIRE', current_key, math.ceil(window * 2000))
+    return {1, '0'}
+end
+if current_count + 1 > limit then
+    return {0, tostring(window - elapsed)}
+end
+return {0, tostring((1 - (limit - current_count - 1) / previous_count) * window - elapsed)}
+"""
+
+
+class RedisLimiterStore:
+    #shared by all workers, works with anything speaking the redis protocol and running lua(redis, valkey, fakeredis[lua])
+    def __init__(self, client, namespace: str = "ratelimit"):
+        self.namespace = namespace
+        self._token_bucket = client.register_script(TOKEN_BUCKET_SCRIPT)
+        self._sliding_window = client.register_script(SLIDING_WINDOW_SCRIPT)
+
+    async def token_bucket(self, key: str, capacity: int, rate: float):
+        allowed, retry_after = await self._token_bucket(keys=[f"{self.namespace}:tb:{key}"], args=[capacity, rate])
+        return bool(allowed), float(retry_after)
+
+    async def sliding_window(self, key: str, limit: int, window: float):
+        allowed, retry_after = await self._sliding_window(keys=[f"{self.namespace}:sw:{key}"], args=[limit, window])
+        return bool(allowed), float(retry_after)
+
+
+def create_store():
+    if settings.cache_backend == "redis":
+        return RedisLimiterStore(cache.get_redis_client())
+    return MemoryLimiterStore(settings.rate_limit_max_keys)
+
+
+class RateLimiter:
+    def __init__(self, rules: dict, store):
+        self.rules = parse_rules(rules)
+        self.store = store
+
+    def client_key(self, request: Request, rule: Rule):
+        if rule.key_by == "user":
+            user_id = oauth2.user_id_from_request(request)
+            if user_id is not None:
+                return f"user:{user_id}"
+        #behind a proxy listed in FORWARDED_ALLOW_IPS the server already replaced client with the address from X-Forwarded-For
+        return f"ip:{request.client.host if request.client else 'unknown'}"
+
+    async def check(self, request: Request):
+        #returns None when the request may go on, otherwise the rule it broke and the seconds until it may retry
+        rule = self.rules.get(f"{request.method} {request.url.path}")
+        if rule is None:
+            return None
+        key = f"{rule.route}:{self.client_key(request, rule)}"
+        try:
+            if rule.algorithm == "token_bucket":
+                allowed, retry_after = await self.store.token_bucket(key, rule.limit, rule.limit / rule.period)
+            else:
+                allowed, retry_after = await self.store.sliding_window(key, rule.limit, rule.period)
+        except Exception as error:
+            #a broken limiter backend must not take the whole api down with it, let the request through
+            logger.warning("rate limiter unavailable", extra={"error": repr(error)})
+            return None
+        return None if allowed else (rule, retry_after)
+
+
+class AdmissionControl:
+    #at most `limit` requests inside the app per worker, a request over it waits up to queue_timeout for a slot
+    #keeps the queue in front of the database pool short, a request that would only time out in the pool is refused right away
+    def __init__(self, limit: int, queue_timeout: float):
+        self.limit = limit
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._semaphore = None   #created on first use, inside the running event loop
+
+    async def acquire(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        if not self._semaphore.locked():
+            await self._semaphore.acquire()   #a free slot, returns without waiting
+        elif self.queue_timeout <= 0:
+            return False   #no queue, shed right away(wait_for with 0 times out even when a slot is free)
+        else:
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                return False
+        self.in_flight += 1
+        return True
+
+    def release(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+
+def retry_after_header(seconds: float):
+    return str(max(1, math.ceil(seconds)))
+
+
+def _admission_limit():
+    if settings.admission_max_concurrent:
+        return settings.admission_max_concurrent
+    return 2 * (settings.database_pool_size + settings.database_max_overflow)
+
+
+#one of each per worker, built by the first request instead of at import
+@lru_cache
+def get_rate_limiter():
+    return RateLimiter(settings.rate_limit_rules, create_store()) if settings.rate_limit_enabled else None
+
+
+@lru_cache
+def get_admission():
+    return AdmissionControl(_admission_limit(), settings.admission_queue_timeout) if _admission_limit() > 0 else None
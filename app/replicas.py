@@ -0,0 +1,130 @@
+#read replica routing
+#read only GET handlers take their session from get_read_session, it hands out a replica session(round robin over the
+#healthy ones) and falls back to the primary when there are no replicas, none is healthy or the user has just written
+import asyncio
+import itertools
+import logging
+from functools import lru_cache
+from fastapi import Depends, Request
+from sqlalchemy import event, text
+from .config import settings
+from . import cache, database, oauth2
+
+logger = logging.getLogger(__name__)
+
+#users who wrote recently, shared by all workers when CACHE_BACKEND=redis
+pins = cache.LazyBackend(lambda: cache.create_backend("primary-pins", settings.user_cache_max_size, settings.read_your_writes_seconds))
+
+#0 when the replica has replayed everything it received(an idle primary sends nothing, so replay time alone would look like lag)
+LAG_QUERY = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+
+class Replica:
+    def __init__(self, index: int):
+        self.index = index
+        self.healthy = False   #no reads until the first health check passed
+        self.lag_seconds = None
+        self.watched_engine = None
+
+    @property
+    def name(self):
+        return f"replica{self.index}"
+
+    def session_factory(self):
+        engine = database.get_replica_engine(self.index)
+        if engine is not self.watched_engine:   #first use, or a new engine after a fork
+            #a replica that drops connections mid request gets no more reads until the next health check passes
+            event.listen(getattr(engine, "sync_engine", engine), "handle_error", self._on_error)
+            self.watched_engine = engine
+        return database.get_replica_sessionmaker(self.index)
+
+    def _on_error(self, context):
+        if context.is_disconnect and self.healthy:
+            self.healthy = False
+            logger.warning("replica disconnected", extra={"replica": self.name})
+
+    async def check(self):
+        try:
+            async with database.open_session(self.session_factory()) as db:
+                lag = (await asyncio.wait_for(db.execute(LAG_QUERY), settings.health_check_timeout)).scalar()
+        except Exception as error:
+            if self.healthy:
+                logger.warning("replica unhealthy", extra={"replica": self.name, "error": repr(error)})
+            self.healthy = False
+            return
+
+        self.lag_seconds = float(lag)
+        max_lag = settings.database_replica_max_lag_seconds
+        healthy = not max_lag or self.lag_seconds <= max_lag
+        if healthy != self.healthy:
+            logger.info("replica healthy" if healthy else "replica lagging", extra={"replica": self.name, "lag_seconds": self.lag_seconds})
+        self.healthy = healthy
+
+
+class ReplicaSet:
+    def __init__(self, count: int):
+        self.replicas = [Replica(index) for index in range(count)]
+        self._turn = itertools.count()
+
+    def choose(self):
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        return healthy[next(self._turn) % len(healthy)]
+
+    async def monitor(self):
+        #runs for the lifetime of the worker, started from the app lifespan
+        while True:
+            await asyncio.gather(*[replica.check() for replica in self.replicas])
+            await asyncio.sleep(settings.database_replica_check_interval)
+
+    def snapshot(self):
+        return {replica.name: {"healthy": replica.healthy, "lag_seconds": replica.lag_seconds} for replica in self.replicas}
+
+
+@lru_cache
+def get_replica_set():
+    #built on first use, like the engines
+    return ReplicaSet(len(settings.database_replica_urls))
+
+
+async def pin_to_primary(request: Request):
+    #called after a successful write, the user's next reads must see it even if the replicas havent replayed it yet
+    if not settings.read_your_writes_seconds or not get_replica_set().replicas:
+        return
+    user_id = oauth2.user_id_from_request(request)   #anonymous requests are never pinned
+    if user_id is not None:
+        await pins.set(str(user_id), True)
+
+
+async def _pinned(request: Request):
+    if not settings.read_your_writes_seconds:
+        return False
+    user_id = oauth2.user_id_from_request(request)
+    return user_id is not None and await pins.get(str(user_id)) is not None
+
+
+def read_from_primary(request: Request):
+    #true when this request's read session is the primary because the user just wrote(fresh data was asked for)
+    return getattr(request.state, "read_from", None) == "primary-pinned"
+
+
+async def get_read_session(request: Request, primary=Depends(database.get_session)):
+    #dependency for read only handlers, never use it for anything that writes
+    #primary is the request's get_session(the one get_current_user uses too), reads that stay on the primary share it
+    #a second primary session would hold a second pooled connection per request and concurrent requests could
+    #deadlock the pool, each holding one connection and waiting for another
+    replica = get_replica_set().choose()
+    request.state.read_from = replica.name if replica is not None else "primary"
+    if replica is not None and await _pinned(request):
+        request.state.read_from = "primary-pinned"
+        replica = None
+
+    if replica is None:
+        yield primary
+        return
+    async with database.open_session(replica.session_factory()) as db:
+        yield db
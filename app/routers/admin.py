@@ -0,0 +1,48 @@
+from fastapi import APIRouter, Request, status, HTTPException, Depends
+from fastapi.responses import StreamingResponse
+from typing import Literal
+from .. import oauth2, bulk, feed_cache
+
+router = APIRouter(
+    prefix="/admin",
+    tags=["Admin"],
+    dependencies=[Depends(oauth2.get_current_admin)]
+)
+
+#whole tables in and out through postgres COPY, see app/bulk.py, the maintenance cli does the same from files
+#GET /admin/export/posts?format=csv > posts.csv
+#POST /admin/import/posts?format=csv --data-binary @posts.csv
+#import order matters--> users, then posts, then votes, rows pointing at users/posts that dont exist fail their batch
+#unless skip_missing=true. a failed import answers 422 with rows_done, send the same file again with skip_rows=rows_done to go on from there
+
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+Format = Literal["ndjson", "csv"]
+
+
+def _table(table: str):
+    try:
+        return bulk.get_table(table)
+    except ValueError as error:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(error))
+
+
+@router.get("/export/{table}")
+async def export_table(table: str, format: Format = "ndjson"):
+    _table(table)
+    return StreamingResponse(bulk.export_chunks(table, format), media_type=MEDIA_TYPES[format],
+                             headers={"Content-Disposition": f'attachment; filename="{table}.{format}"'})
+
+
+@router.post("/import/{table}")
+async def import_table(request: Request, table: str, format: Format = "ndjson", skip_rows: int = 0, skip_missing: bool = False):
+    _table(table)
+    try:
+        result = await bulk.import_rows(table, format, request.stream(), skip_rows=skip_rows, skip_missing=skip_missing)
+    except bulk.BulkImportError as error:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail={"error": str(error), "rows_done": skip_rows + error.rows_done})
+    except ValueError as error:   #a line that isnt json/csv, nothing after the last committed batch was written
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail={"error": str(error)})
+    finally:
+        if table in ("posts", "votes"):
+            await feed_cache.invalidate()   #even a failed import may have committed some batches
+    return result.as_dict()
@@ -1,7 +1,8 @@
 from fastapi import APIRouter, Response, status, HTTPException, Depends
 from fastapi.security.oauth2 import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
-from ..database import get_db
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from ..database import get_session
 from .. import schemas, models, utils, oauth2
 
 
@@ -9,15 +10,22 @@ from .. import schemas, models, utils, oauth2
 router = APIRouter(tags=['Authentication'])
 
 @router.post('/login', response_model=schemas.Token)
-def login_user(user_credentials: OAuth2PasswordRequestForm = Depends(), db:Session = Depends(get_db)):
+async def login_user(user_credentials: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_session)):
     
-    user = db.query(models.User).filter(models.User.email == user_credentials.username).first()  #searches by email from the database and stores the entire row in user variable
+    user = (await db.execute(select(models.User).where(models.User.email == user_credentials.username))).scalars().first()  #searches by email from the database and stores the entire row in user variable
     if not user:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid Credentials")
     
-    if not utils.verify(user_credentials.password, user.password):  #database pswd contains hashed pswd(user.password), user_credentials is basically input user pswd
+    #argon2 runs on its own bounded executor so it doesnt block the event loop
+    valid, new_hash = await utils.verify_and_update_async(user_credentials.password, user.password)  #database pswd contains hashed pswd(user.password), user_credentials is basically input user pswd
+    if not valid:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid Credentials")
 
+    #the hash was made with old argon2 settings, now that we know the password store a hash with the current ones
+    if new_hash:
+        await db.execute(update(models.User).where(models.User.id == user.id).values(password=new_hash))
+        await db.commit()
+
     #once both are verified--> create JWT token containing the user id
     user_token = oauth2.create_token(data={"user_id": user.id})  #user.id grabs id from user row which we extracted above
     #return token
@@ -0,0 +1,127 @@
+from fastapi import APIRouter, Request, WebSocket, WebSocketDisconnect, status, HTTPException
+from fastapi.responses import StreamingResponse
+from typing import Optional
+import asyncio
+import orjson
+from .. import oauth2, live, serialization
+from ..config import settings
+
+router = APIRouter(
+    prefix="/live",
+    tags=["Live"]
+)
+
+#GET /live/votes?posts=1,2,3--> server sent events, WS /live/votes?posts=1,2,3--> websocket
+#both send {"votes": {"<post id>": <vote count>}} with the current counts first and then whenever they change
+#over the websocket the followed posts can be changed with {"subscribe": [ids]} and {"unsubscribe": [ids]}
+#browsers cant set headers on EventSource/WebSocket. a WebSocket sends the token as a subprotocol instead,
+#new WebSocket(url, ["bearer", token]), a query string would end up in proxy and access logs
+#EventSource cant send that either, so only the sse stream still takes ?access_token=
+BEARER_SUBPROTOCOL = "bearer"
+
+
+def _authenticate(authorization: Optional[str], access_token: Optional[str]):
+    scheme, _, token = (authorization or "").partition(" ")
+    token = token if scheme.lower() == "bearer" and token else access_token
+    if not token:
+        return None
+    try:
+        return oauth2.verify__access_token(token, HTTPException(status_code=status.HTTP_401_UNAUTHORIZED)).id
+    except HTTPException:
+        return None
+
+
+def _subprotocol_token(websocket: WebSocket):
+    #Sec-WebSocket-Protocol: bearer, <token>--> <token>
+    offered = [value.strip() for value in websocket.headers.get("sec-websocket-protocol", "").split(",")]
+    if BEARER_SUBPROTOCOL in offered[:-1]:
+        return offered[offered.index(BEARER_SUBPROTOCOL) + 1]
+    return None
+
+
+def _post_ids(value):
+    #"1,2,3"--> [1, 2, 3], ValueError for anything else
+    return [int(post_id) for post_id in value.split(",") if post_id.strip()]
+
+
+@router.get("/votes")
+async def live_votes_stream(request: Request, posts: str, access_token: Optional[str] = None):
+    hub = live.get_hub()
+    if _authenticate(request.headers.get("authorization"), access_token) is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials", headers={"WWW-Authenticate": "Bearer"})
+    try:
+        post_ids = _post_ids(posts)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="posts must be a comma separated list of post ids")
+    if len(hub.subscribers) >= settings.live_max_subscribers:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Too many live connections, try again shortly", headers={"Retry-After": "5"})
+
+    async def events():
+        subscriber = live.Subscriber()
+        hub.add(subscriber)
+        try:
+            hub.subscribe(subscriber, post_ids)
+            while True:
+                frame = await subscriber.next_frame(settings.live_heartbeat_seconds)
+                if frame is None:
+                    yield b": keepalive\n\n"   #also how we find out the client went away on a quiet stream
+                elif frame:
+                    yield b"event: votes\ndata: " + serialization.dump_vote_counts(frame) + b"\n\n"
+        finally:
+            hub.remove(subscriber)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@router.websocket("/votes")
+async def live_votes_socket(websocket: WebSocket, posts: str = ""):
+    hub = live.get_hub()
+    subprotocol_token = _subprotocol_token(websocket)
+    if _authenticate(websocket.headers.get("authorization"), subprotocol_token) is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    if len(hub.subscribers) >= settings.live_max_subscribers:
+        await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER)
+        return
+    try:
+        post_ids = _post_ids(posts)
+    except ValueError:
+        await websocket.close(code=status.WS_1003_UNSUPPORTED_DATA)
+        return
+
+    #a browser fails the handshake unless we pick one of the subprotocols it offered
+    await websocket.accept(subprotocol=BEARER_SUBPROTOCOL if subprotocol_token else None)
+    subscriber = live.Subscriber()
+    hub.add(subscriber)
+    #one send at a time, the frame sender and the replies below would otherwise write to the socket concurrently
+    send_lock = asyncio.Lock()
+    sender = asyncio.create_task(_send_frames(websocket, subscriber, send_lock))
+    try:
+        hub.subscribe(subscriber, post_ids)
+        while True:
+            text = await websocket.receive_text()
+            try:
+                message = orjson.loads(text)
+                if "subscribe" in message:
+                    hub.subscribe(subscriber, [int(post_id) for post_id in message["subscribe"]])
+                if "unsubscribe" in message:
+                    hub.unsubscribe(subscriber, [int(post_id) for post_id in message["unsubscribe"]])
+            except (TypeError, ValueError):   #orjson.JSONDecodeError is a ValueError too
+                async with send_lock:
+                    await websocket.send_json({"detail": 'send {"subscribe": [post ids]} or {"unsubscribe": [post ids]}'})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
+        hub.remove(subscriber)
+
+
+async def _send_frames(websocket: WebSocket, subscriber: live.Subscriber, send_lock: asyncio.Lock):
+    try:
+        while True:
+            frame = await subscriber.next_frame()
+            if frame:
+                async with send_lock:
+                    await websocket.send_text(serialization.dump_vote_counts(frame).decode())
+    except (WebSocketDisconnect, RuntimeError):
+        pass   #the client is gone, the receive loop sees it too and cleans up
@@ -1,40 +1,76 @@
-from fastapi import FastAPI, Response, status, HTTPException, Depends, APIRouter, Depends
-from .. import models, schemas, oauth2  #singledot--> main dir, doubledot--> parent directory, dir k andhar dir
-from sqlalchemy.orm import Session
+from fastapi import FastAPI, Request, Response, status, HTTPException, Depends, APIRouter, Depends
+from .. import models, schemas, oauth2, pagination, feed_cache, serialization, replicas, voting  #singledot--> main dir, doubledot--> parent directory, dir k andhar dir
+from sqlalchemy.orm import joinedload, aliased, contains_eager
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional
-from ..database import get_db
-from sqlalchemy import func
+from ..database import get_session
+from ..replicas import get_read_session   #read only handlers, may be served by a replica
+from sqlalchemy import select, update, delete, exists, and_, tuple_, func, cast, Float, literal, literal_column
+import logging
 
+logger = logging.getLogger(__name__)
 
 router = APIRouter(
     prefix='/posts',
     tags=['Posts']   #used for grouping API endpoints in automatically generated documentation(SwaggerUI)
 )
 
+#the owner is always fetched in the same query as its posts, and only with the columns UserResponse shows(no password hash)
+owner_columns = (models.User.id, models.User.email, models.User.created_at)
+owner_loader = joinedload(models.Post.owner, innerjoin=True).load_only(*owner_columns)
+
+#every column except the generated search_vector, used for RETURNING so writes dont send it back
+post_columns = [column for column in models.Post.__table__.c if column.key != "search_vector"]
+
+
 
 
 
 @router.get('/', response_model=List[schemas.PostOut])     #to retrieve data, we usually use GET http method
-def get_posts(db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user), limit: int = 10, skip: int = 0,
-              search: Optional[str] = ""):
+async def get_posts(request: Request, db: AsyncSession = Depends(get_read_session), current_user: int = Depends(oauth2.get_current_user), limit: int = 10, skip: int = 0,
+              search: Optional[str] = "", cursor: Optional[str] = None):
     # cursor.execute("""SELECT * FROM posts""")
     # posts = cursor.fetchall()
-    print(search)
-    print(limit)
+    logger.debug("feed requested", extra={"search": search, "limit": limit, "skip": skip, "cursor": bool(cursor)})
     #retrieve_posts = db.query(models.Post).filter(models.Post.title.contains(search)).limit(limit).offset(skip).all()  #this returns list of all the post objects, hence we used List above
     #by addind owner_id we are explicitly only returning posts made by the current user
-    results = db.query(models.Post, func.count(models.Votes.post_id).label("votes"))\
-    .join(models.Votes, models.Votes.post_id == models.Post.id, isouter=True)\
-    .group_by(models.Post.id)\
-    .filter(models.Post.title.contains(search))\
-    .limit(limit)\
-    .offset(skip).all()
+    #votes come from the denormalized vote_count column, so no join/group by over the whole votes table
+    #newest first, id breaks ties so the order is stable between pages(matches ix_posts_created_at_id)
+    async def load_page():
+        query = select(models.Post, models.Post.vote_count.label("votes"))\
+        .options(owner_loader)\
+        .where(models.Post.title.contains(search))\
+        .order_by(models.Post.created_at.desc(), models.Post.id.desc())
+
+        #keyset pagination--> continue right after the last post of the previous page instead of making postgres read and throw away `skip` rows
+        #skip is still supported for old clients that dont send a cursor
+        if cursor:
+            cursor_created_at, cursor_id = pagination.decode_cursor(cursor)
+            #the column's type on the value, an untyped datetime is sent as timestamp without time zone in async mode and asyncpg rejects it
+            cursor_value = literal(cursor_created_at, models.Post.created_at.type)
+            query = query.where(tuple_(models.Post.created_at, models.Post.id) < tuple_(cursor_value, cursor_id))\
+            .where(models.Post.created_at <= cursor_created_at)   #same rows, but postgres only prunes partitions on a plain comparison
+        else:
+            query = query.offset(skip)
+
+        results = (await db.execute(query.limit(limit))).all()
 
-    return results
+        #a full page means there might be more, so hand the client a cursor for the next one
+        headers = {}
+        if limit > 0 and len(results) == limit:
+            last_post = results[-1].Post
+            headers["X-Next-Cursor"] = pagination.encode_cursor(last_post.created_at, last_post.id)
+
+        return {"items": serialization.dump_post_out_items(results), "post_ids": [row.Post.id for row in results], "headers": headers}
+
+    #the page doesnt depend on who is asking, so every user shares the same cached copy, only voted_by_me is filled in per user
+    page = await feed_cache.get_or_load(f"posts:{limit}:{skip if not cursor else ''}:{search}:{cursor or ''}", load_page,
+                                        refresh=replicas.read_from_primary(request))
+    return feed_cache.respond(request, page, await voting.voted_post_ids(db, current_user.id, page["post_ids"]))
 
 
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=schemas.ResponsePost)
-def create_posts(new_post:schemas.CreatePost, db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):          #it automatically checks the parameters of the class Post(defines schema)
+async def create_posts(new_post:schemas.CreatePost, db: AsyncSession = Depends(get_session), current_user: int = Depends(oauth2.get_current_user)):          #it automatically checks the parameters of the class Post(defines schema)
     #NOTE:cursor.execute("""INSERT INTO posts (title, content, published) VALUES({posts.title}, {posts.content}, {posts.published})""")--> should be avoided to prevent SQL injection
     # cursor.execute("""INSERT INTO posts (title, content, published) VALUES (%s, %s, %s) RETURNING *""",
     #                 (new_post.title, new_post.content, new_post.published))
@@ -45,32 +81,133 @@ def create_posts(new_post:schemas.CreatePost, db: Session = Depends(get_db), cur
  
     new_posts = models.Post(owner_id=current_user.id,**new_post.model_dump())
     db.add(new_posts)   #adds the new post to the database
-    db.commit()   #commits to the database
-    db.refresh(new_posts)   #shows the new post in the database(RETURNING * IN THE SQL QUERY)
+    await db.commit()   #commits to the database
+    await feed_cache.invalidate()   #cached feed pages dont have the new post yet
+    #shows the new post in the database(RETURNING * IN THE SQL QUERY), owner is loaded here too since it cant be lazy loaded later in async mode
+    result = await db.execute(select(models.Post).options(owner_loader)\
+    .where(models.Post.id == new_posts.id).execution_options(populate_existing=True))
+    new_posts = result.scalars().first()
     return new_posts    #this prints it to postman(frontend/client)
 
 
-@router.get("/latest")
-def latest_posts(db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
+@router.get("/latest", response_model=schemas.LatestPost)
+async def latest_posts(request: Request, db: AsyncSession = Depends(get_read_session), current_user: int = Depends(oauth2.get_current_user)):
     # cursor.execute("""SELECT * FROM posts ORDER BY id DESC LIMIT 1""")
     # latest = cursor.fetchone()
-    latestpost = db.query(models.Post).order_by(models.Post.created_at.desc()).first()
-    return {"latestposts": latestpost}
+    async def load_page():
+        result = await db.execute(select(models.Post).order_by(models.Post.created_at.desc()).limit(1))
+        latestpost = result.scalars().first()
+        body = schemas.LatestPost(latestposts=schemas.Post.model_validate(latestpost) if latestpost else None)
+        return {"body": body.model_dump_json(), "headers": {}}
+
+    page = await feed_cache.get_or_load("latest", load_page, refresh=replicas.read_from_primary(request))
+    return feed_cache.respond(request, page)
 #NOTE:APi structuring is very imp, if we had placed this below the id func, it would have failed because fastapi works from top down and would get the
 #id first, hence try to convert 'latest' into an int
 
 
+#full text search over title and content, best matches first
+@router.get("/search", response_model=List[schemas.PostOut])
+async def search_posts(q: str, db: AsyncSession = Depends(get_read_session), current_user: int = Depends(oauth2.get_current_user),
+                       limit: int = 10, cursor: Optional[str] = None):
+    #websearch syntax--> "quoted phrases", or, -excluded words, the same things people type into search boxes
+    #the config is a literal regconfig, asyncpg sends bound params as varchar and postgres wont cast those to regconfig
+    ts_query = func.websearch_to_tsquery(literal_column("'english'::regconfig"), q)
+    #ts_rank_cd returns a float4, cast it so the rank in the cursor round trips exactly
+    rank = cast(func.ts_rank_cd(models.Post.search_vector, ts_query), Float(precision=53)).label("rank")
+
+    #the @@ match uses the GIN index on search_vector, only matching posts get ranked
+    query = select(models.Post, models.Post.vote_count.label("votes"), rank)\
+    .options(owner_loader)\
+    .where(models.Post.search_vector.op("@@")(ts_query))\
+    .order_by(rank.desc(), models.Post.id.desc())
+
+    if cursor:
+        cursor_rank, cursor_id = pagination.decode_rank_cursor(cursor)
+        query = query.where(tuple_(rank, models.Post.id) < tuple_(cursor_rank, cursor_id))
+
+    results = (await db.execute(query.limit(limit))).all()
+
+    headers = {}
+    if limit > 0 and len(results) == limit:
+        last_row = results[-1]
+        headers["X-Next-Cursor"] = pagination.encode_rank_cursor(last_row.rank, last_row.Post.id)
+
+    voted = await voting.voted_post_ids(db, current_user.id, [row.Post.id for row in results])
+    #response_model above is only for the docs, the rows are dumped directly(see serialization.py)
+    return Response(content=serialization.dump_post_out_list(results, voted), media_type="application/json", headers=headers)
+
+
+#posts ranked by hot score(votes, decayed by age), see models.PostScore
+@router.get("/trending", response_model=List[schemas.PostOut])
+async def trending_posts(request: Request, db: AsyncSession = Depends(get_read_session), current_user: int = Depends(oauth2.get_current_user),
+                         limit: int = 10, cursor: Optional[str] = None):
+    async def load_page():
+        #the page is taken off ix_post_scores_hot_score_post_id first, `limit` index entries however many posts there are
+        #and only those posts are joined, on created_at too so each is one primary key lookup in its own partition
+        #(joined before the limit, postgres misjudges the id + created_at join as almost empty and sorts every post instead)
+        top = select(models.PostScore).order_by(models.PostScore.hot_score.desc(), models.PostScore.post_id.desc())
+        if cursor:
+            cursor_score, cursor_id = pagination.decode_rank_cursor(cursor)
+            top = top.where(tuple_(models.PostScore.hot_score, models.PostScore.post_id) < tuple_(cursor_score, cursor_id))
+        top = top.limit(limit).subquery()
+
+        query = select(models.Post, models.Post.vote_count.label("votes"), top.c.hot_score)\
+        .join(top, and_(top.c.post_id == models.Post.id, top.c.created_at == models.Post.created_at))\
+        .options(owner_loader)\
+        .order_by(top.c.hot_score.desc(), top.c.post_id.desc())
+
+        results = (await db.execute(query)).all()
+
+        headers = {}
+        if limit > 0 and len(results) == limit:
+            last_row = results[-1]
+            headers["X-Next-Cursor"] = pagination.encode_rank_cursor(last_row.hot_score, last_row.Post.id)
+
+        return {"items": serialization.dump_post_out_items(results), "post_ids": [row.Post.id for row in results], "headers": headers}
+
+    #scores only move with votes and every vote invalidates the feed cache, so the shared cached pages are never stale
+    page = await feed_cache.get_or_load(f"trending:{limit}:{cursor or ''}", load_page, refresh=replicas.read_from_primary(request))
+    return feed_cache.respond(request, page, await voting.voted_post_ids(db, current_user.id, page["post_ids"]))
+
+
+#moderator endpoints, change or remove many posts(of any owner) with one statement
+@router.post("/bulk/delete", response_model=schemas.BulkPostResult)
+async def bulk_delete_posts(bulk: schemas.BulkPostIds, db: AsyncSession = Depends(get_session), moderator = Depends(oauth2.get_current_moderator)):
+    result = await db.execute(delete(models.Post).where(models.Post.id.in_(bulk.ids))\
+    .returning(models.Post.id).execution_options(synchronize_session=False))
+    deleted = set(result.scalars().all())
+    await db.commit()
+    if deleted:
+        await feed_cache.invalidate()
+    return {"deleted": sorted(deleted), "not_found": sorted(set(bulk.ids) - deleted)}
+
+
+@router.post("/bulk/update", response_model=schemas.BulkPostResult)
+async def bulk_update_posts(bulk: schemas.BulkPostUpdate, db: AsyncSession = Depends(get_session), moderator = Depends(oauth2.get_current_moderator)):
+    changes = bulk.model_dump(exclude_none=True, exclude={"ids"})
+    if not changes:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Nothing to update")
+
+    result = await db.execute(update(models.Post).where(models.Post.id.in_(bulk.ids)).values(**changes)\
+    .returning(models.Post.id).execution_options(synchronize_session=False))
+    updated = set(result.scalars().all())
+    await db.commit()
+    if updated:
+        await feed_cache.invalidate()
+    return {"updated": sorted(updated), "not_found": sorted(set(bulk.ids) - updated)}
+
+
 #to get a single post
 @router.get("/{id}", response_model=schemas.PostOut)   #NOTE: this is a path parameter(will be returned as a str)
-def get_singlepost(id: int, db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
+async def get_singlepost(id: int, db: AsyncSession = Depends(get_read_session), current_user: int = Depends(oauth2.get_current_user)):
     # cursor.execute("""SELECT * from posts WHERE id= %s""", (id,))   #added a comma after id so it can be taken as tuple and not an int(throws an error)
     # singleposts = cursor.fetchone()
     # print(singleposts)
     #singleposts = db.query(models.Post).filter(models.Post.id == id).first() #finds the first matching post with the id
 
-    singleposts = db.query(models.Post, func.count(models.Votes.post_id).label("votes"))\
-    .join(models.Votes, models.Votes.post_id == models.Post.id, isouter=True)\
-    .group_by(models.Post.id).first()
+    result = await db.execute(single_post_query(id, current_user.id))
+    singleposts = result.first() or await _archived_post(db, id, current_user.id)
 
     if not singleposts:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Post with {id} not found")
@@ -83,41 +220,71 @@ def get_singlepost(id: int, db: Session = Depends(get_db), current_user: int = D
 
 
 @router.delete("/{id}", status_code=status.HTTP_200_OK)  #using 204 no content will not return any body if successfully deletion, hence 200 is best practice
-def delete_posts(id: int, db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
+async def delete_posts(id: int, db: AsyncSession = Depends(get_session), current_user: int = Depends(oauth2.get_current_user)):
     # cursor.execute("""DELETE FROM posts WHERE id = %s RETURNING *""", (id,))
     # deleted_posts = cursor.fetchone()
     # if deleted_posts==None:
     #     raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Post with id {id} not found")
     # conn.commit()
-    deleteposts = db.query(models.Post).filter(models.Post.id == id)  #query based deletion
-    if deleteposts.first()==None:   #query object can never be None, hence we use .first()  
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Post with id {id} not found")
-    
-    #creating if operation such that user can only delete his specific posts and not others
-    if deleteposts.first().owner_id != current_user.id:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You are not allowed to delete this post")
 
-    deleteposts.delete(synchronize_session=False)   #synchronize session basically tells to not save in-memory
-    db.commit()
-    return {"data": deleteposts, "detail": f"Post with id: {id} has been successfully deleted"}
+    #the ownership check is part of the DELETE itself, so nobody can change the post between the check and the write
+    result = await db.execute(delete(models.Post).where(models.Post.id == id, models.Post.owner_id == current_user.id)\
+    .returning(*post_columns).execution_options(synchronize_session=False))   #synchronize session basically tells to not save in-memory
+    deleteposts = result.first()
+    if deleteposts is None:
+        await _raise_missing_or_forbidden(db, id, "You are not allowed to delete this post")
+
+    await db.commit()
+    await feed_cache.invalidate()
+    return {"data": dict(deleteposts._mapping), "detail": f"Post with id: {id} has been successfully deleted"}
 
 
 @router.put("/{id}", response_model=schemas.ResponsePost)
-def update_posts(id: int, update_post: schemas.CreatePost, db:Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
+async def update_posts(id: int, update_post: schemas.CreatePost, db: AsyncSession = Depends(get_session), current_user: int = Depends(oauth2.get_current_user)):
     # cursor.execute("""UPDATE posts SET title = %s, content = %s, published =%s WHERE id = %s RETURNING *""", (update_post.title, update_post.content, update_post.published, id))
     # updated_posts = cursor.fetchone()
-    post_query = db.query(models.Post).filter(models.Post.id == id)  
 
-    updatepost = post_query.first()   #we are storing it here because we cannot update if we add the .first() in post_query, hence we separated it
+    #UPDATE ... RETURNING inside a CTE, joined to users so the response(with its owner) comes back in the same round trip
+    updated = update(models.Post).where(models.Post.id == id, models.Post.owner_id == current_user.id)\
+    .values(**update_post.model_dump()).returning(*post_columns).cte("updated")
+    updated_post = aliased(models.Post, updated)
+    result = await db.execute(select(updated_post).join(updated_post.owner).options(contains_eager(updated_post.owner).load_only(*owner_columns)))
+    updatepost = result.scalars().first()
+    if updatepost is None:
+        await _raise_missing_or_forbidden(db, id, "You are not allowed to update this post")
 
-    if updatepost==None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Post with id {id} not found")
-    
-    #creating if statement so the user with specific id can only update his specific posts
-    if updatepost.owner_id != current_user.id:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="You are not allowed to update this post")
-    
-    post_query.update(update_post.model_dump(), synchronize_session=False)
+    await db.commit()
+    await feed_cache.invalidate()
+    return updatepost
+
+
+def single_post_query(id: int, user_id: int):
+    #primary key lookup, the owner is joined in the same query so serializing PostOut does not lazy load it in a second round trip
+    #only the id is known, so postgres probes the primary key of every attached month partition(see benchmarks/partitioned_lookup.py)
+    #and it cant know the id is unique across them, it expects a row per partition and may hash join the whole users table for them
+    #LIMIT 1(there is only one) makes it probe users by primary key for the row it finds instead
+    #voted_by_me is one more primary key probe(votes(user_id, post_id)) inside the same query
+    #benchmarks/single_post_plan.py checks the plan stays index lookups as the tables grow
+    voted_by_me = exists().where(and_(models.Votes.user_id == user_id, models.Votes.post_id == models.Post.id)).label("voted_by_me")
+    return select(models.Post, models.Post.vote_count.label("votes"), voted_by_me)\
+    .options(owner_loader)\
+    .where(models.Post.id == id)\
+    .limit(1)
 
-    db.commit()
-    return post_query.first()
\ No newline at end of file
+
+async def _archived_post(db, id: int, user_id: int):
+    #old months are moved to posts_archive(python -m app.maintenance archive-posts), they stay readable here and nowhere else
+    voted_by_me = exists().where(and_(models.Votes.user_id == user_id, models.Votes.post_id == models.PostArchive.id)).label("voted_by_me")
+    result = await db.execute(select(models.PostArchive, models.PostArchive.vote_count.label("votes"), voted_by_me)\
+    .options(joinedload(models.PostArchive.owner, innerjoin=True).load_only(*owner_columns))\
+    .where(models.PostArchive.id == id))
+    row = result.first()
+    return {"Post": row.PostArchive, "votes": row.votes, "voted_by_me": row.voted_by_me} if row else None
+
+
+async def _raise_missing_or_forbidden(db, id: int, forbidden_detail: str):
+    #the write matched no row, one cheap lookup tells apart a post that doesnt exist from one owned by someone else
+    exists = (await db.execute(select(models.Post.id).where(models.Post.id == id))).first()
+    if exists is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Post with id {id} not found")
+    raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=forbidden_detail)
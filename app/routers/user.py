@@ -1,7 +1,9 @@
 from fastapi import FastAPI, Response, status, HTTPException, Depends, APIRouter
 from .. import models, schemas, utils  #singledot--> main dir, doubledot--> parent directory, dir k andhar dir
-from sqlalchemy.orm import Session
-from ..database import get_db
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from ..database import get_session
+from ..replicas import get_read_session
 
 router=APIRouter(
     prefix='/users',
@@ -9,23 +11,23 @@ router=APIRouter(
 )
 
 @router.post('/', status_code=status.HTTP_201_CREATED, response_model=schemas.UserResponse)
-def create_users(user: schemas.UserCreate, db: Session = Depends(get_db)):
+async def create_users(user: schemas.UserCreate, db: AsyncSession = Depends(get_session)):
     
     #hashing the password from users--> user.password
-    hashed_password = utils.hashing(user.password)
+    hashed_password = await utils.hashing_async(user.password)   #bounded argon2 executor, doesnt block the event loop
     user.password = hashed_password
 
     new_user = models.User(**user.model_dump())
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
+    await db.refresh(new_user)
 
     return new_user
 
 
 @router.get('/{id}', response_model=schemas.UserResponse)
-def get_users(id: int, db:Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.id == id).first()
+async def get_users(id: int, db: AsyncSession = Depends(get_read_session)):
+    user = (await db.execute(select(models.User).where(models.User.id == id))).scalars().first()
     if user==None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"User with id:{id} not found")
 
@@ -1,6 +1,7 @@
-from pydantic import BaseModel, EmailStr, Field
+from pydantic import BaseModel, ConfigDict, EmailStr, Field, field_validator
 from datetime import datetime
-from typing import Optional 
+from .config import settings
+from typing import List, Literal, Optional 
 
 
 class PostBase(BaseModel):
@@ -13,31 +14,70 @@ class UserResponse(BaseModel):
     id: int
     created_at: datetime
     
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 #inheriting class
 class CreatePost(PostBase):
     pass   #inherits as-it-is\
 
 
+#the feed and search build this shape by hand, keep app/serialization.py in step when these fields change
 class ResponsePost(PostBase):    #deriving from above pydantic base model
     id: int
     created_at: datetime
     owner_id: int
     owner: UserResponse
 
-    class Config:    #since pydantic models only run dictionaries, this method will tell fastAPI to run it even if its ORM
-        orm_mode=True
+    model_config = ConfigDict(from_attributes=True)   #since pydantic models only run dictionaries, this tells it to read attributes of ORM objects too
 
 
 
 class PostOut(BaseModel):
     Post: ResponsePost  # Capital P se "Post" rakho (singular, not "Posts")
     votes: int
+    voted_by_me: bool = False   #the current user has a vote on this post
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
+
+
+#a post row without the owner, used by /posts/latest
+class Post(PostBase):
+    id: int
+    created_at: datetime
+    owner_id: int
+    vote_count: int
+
+    model_config = ConfigDict(from_attributes=True)
+
+
+class LatestPost(BaseModel):
+    latestposts: Optional[Post] = None
+
+
+#moderator bulk endpoints
+class BulkPostIds(BaseModel):
+    ids: List[int] = Field(min_length=1)
+
+    #the limit is checked per request instead of a max_length fixed when this module is imported
+    @field_validator("ids")
+    @classmethod
+    def at_most_bulk_max_size(cls, ids):
+        if len(ids) > settings.post_bulk_max_size:
+            raise ValueError(f"List should have at most {settings.post_bulk_max_size} items")
+        return ids
+
+
+class BulkPostUpdate(BulkPostIds):
+    #only the fields that are sent get changed
+    title: Optional[str] = None
+    content: Optional[str] = None
+    published: Optional[bool] = None
+
+
+class BulkPostResult(BaseModel):
+    updated: List[int] = []
+    deleted: List[int] = []
+    not_found: List[int] = []
 
 
 
@@ -67,6 +107,15 @@ class TokenData(BaseModel):
     id: Optional[int] = None
 
 
+#the authenticated user handed to the routers, small enough to be cached
+class CurrentUser(BaseModel):
+    id: int
+    email: Optional[EmailStr] = None   #None when we trust the token claims and skip the lookup
+    created_at: Optional[datetime] = None
+
+    model_config = ConfigDict(from_attributes=True)
+
+
 
 #creating voting schemas
 class Vote(BaseModel):
@@ -74,3 +123,22 @@ class Vote(BaseModel):
     dir: int = Field(ge=0, le=1)  #less than 1
 
 
+class VoteBatch(BaseModel):
+    votes: List[Vote] = Field(min_length=1)
+
+    @field_validator("votes")
+    @classmethod
+    def at_most_batch_max_size(cls, votes):
+        if len(votes) > settings.vote_batch_max_size:
+            raise ValueError(f"List should have at most {settings.vote_batch_max_size} items")
+        return votes
+
+
+class VoteResult(BaseModel):
+    posts_id: int
+    dir: int
+    status: Literal["added", "removed", "already_voted", "not_voted", "post_not_found"]
+
+
+class VoteBatchOut(BaseModel):
+    results: List[VoteResult]   #same order as the request
@@ -0,0 +1,130 @@
+#production entry point--> python -m app.server
+#gunicorn supervises one uvicorn worker per cpu(restarts crashed/stuck ones, recycles them after SERVER_MAX_REQUESTS)
+#where gunicorn cant run(windows) it falls back to uvicorn's own multi process mode with the same settings
+import importlib.util
+import logging
+import os
+from .config import settings
+
+try:
+    from uvicorn_worker import UvicornWorker   #pulls in gunicorn, which needs fcntl and so doesnt import on windows
+except ImportError:
+    UvicornWorker = None
+
+logger = logging.getLogger("app.server")
+
+APP = "app.main:app"
+
+
+def cpu_count():
+    #cpus this process may actually use, a container limited with --cpus or a cpuset sees fewer than the host has
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:   #not available on windows/macos
+        count = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:   #cgroup v2 quota, "max 100000" when unlimited
+            quota, period = f.read().split()
+        if quota != "max":
+            count = min(count, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return count
+
+
+def worker_count():
+    #the app is async so one worker per core keeps every core busy, more just adds database pools
+    return settings.web_concurrency or cpu_count()
+
+
+def event_loop():
+    return "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+
+
+def http_parser():
+    return "httptools" if importlib.util.find_spec("httptools") else "h11"
+
+
+#websockets' sans-io protocol, about half the memory per open connection of the default one(live vote counts keep thousands open)
+WEBSOCKETS = "websockets-sansio"
+
+
+if UvicornWorker is not None:
+    class Worker(UvicornWorker):
+        CONFIG_KWARGS = {"loop": event_loop(), "http": http_parser(), "ws": WEBSOCKETS, "server_header": False}
+
+
+def _log_startup(workers, server):
+    per_worker = settings.database_pool_size + settings.database_max_overflow
+    logger.info("starting server", extra={
+        "server": server, "workers": workers, "bind": settings.server_bind, "loop": event_loop(), "http": http_parser(),
+        "max_database_connections": workers * per_worker,   #every worker has its own pool
+    })
+
+
+def run_gunicorn(workers):
+    from gunicorn.app.base import BaseApplication
+
+    class Application(BaseApplication):
+        def load_config(self):
+            options = {
+                "bind": settings.server_bind,
+                "workers": workers,
+                "worker_class": f"{__name__}.Worker",   #gunicorn imports the worker class by path
+                "keepalive": settings.server_keepalive,
+                "timeout": settings.server_timeout,
+                "graceful_timeout": settings.server_graceful_timeout,
+                "max_requests": settings.server_max_requests,
+                "max_requests_jitter": settings.server_max_requests_jitter,
+                "preload_app": settings.server_preload,
+                "forwarded_allow_ips": settings.forwarded_allow_ips,   #UvicornWorker hands it to uvicorn's proxy headers middleware
+                "accesslog": None,   #request logging and metrics come from the app middleware
+                "loglevel": settings.log_level.lower(),
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            from .main import app
+            return app
+
+    Application().run()
+
+
+def run_uvicorn(workers):
+    import uvicorn
+
+    host, _, port = settings.server_bind.rpartition(":")
+    uvicorn.run(
+        APP,
+        host=host or "0.0.0.0",
+        port=int(port),
+        workers=workers,
+        loop=event_loop(),
+        http=http_parser(),
+        ws=WEBSOCKETS,
+        timeout_keep_alive=settings.server_keepalive,
+        timeout_graceful_shutdown=settings.server_graceful_timeout,
+        limit_max_requests=settings.server_max_requests or None,
+        proxy_headers=True,
+        forwarded_allow_ips=settings.forwarded_allow_ips,
+        server_header=False,
+        access_log=False,
+    )
+
+
+def main():
+    from .logging_config import configure_logging
+
+    configure_logging()
+    workers = worker_count()
+    if UvicornWorker is not None:
+        _log_startup(workers, "gunicorn")
+        run_gunicorn(workers)
+    else:
+        _log_startup(workers, "uvicorn")
+        run_uvicorn(workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,59 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pwdlib import PasswordHash
-hashpassword = PasswordHash.recommended()  
+from pwdlib.hashers.argon2 import Argon2Hasher
+from .config import settings
+
+#argon2 cost comes from settings so every deployment can tune cpu/memory per hash, the defaults are pwdlib's recommended ones
+#built on first use, not at import
+@lru_cache
+def password_hash():
+    return PasswordHash((
+        Argon2Hasher(time_cost=settings.argon2_time_cost, memory_cost=settings.argon2_memory_cost, parallelism=settings.argon2_parallelism),
+    ))
 
 #hash a password
 def hashing(password: str):
-    return hashpassword.hash(password)
+    return password_hash().hash(password)
 
 
 #creating a function for comparing user password with our hashed database password
 def verify(user_password, hashed_password):
-    return hashpassword.verify(user_password, hashed_password)
\ No newline at end of file
+    return password_hash().verify(user_password, hashed_password)
+
+
+#argon2 is slow and memory hungry on purpose, so it gets its own small pool instead of the shared threadpool
+#peak memory is roughly password_hash_workers * argon2_memory_cost
+@lru_cache
+def _hash_executor():
+    return ThreadPoolExecutor(max_workers=settings.password_hash_workers, thread_name_prefix="password-hash")
+
+
+_pending_hashes = 0   #running + queued, only touched from the event loop
+
+
+class PasswordHashingBusy(Exception):
+    #raised when the hash queue is full, main.py turns it into a 503 so a login burst cant starve other endpoints
+    pass
+
+
+async def _run_hasher(fn, *args):
+    global _pending_hashes
+    if _pending_hashes >= settings.password_hash_workers + settings.password_hash_queue_size:
+        raise PasswordHashingBusy()
+
+    _pending_hashes += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_hash_executor(), fn, *args)
+    finally:
+        _pending_hashes -= 1
+
+
+async def hashing_async(password: str):
+    return await _run_hasher(hashing, password)
+
+
+async def verify_and_update_async(user_password, hashed_password):
+    #returns (valid, new_hash), new_hash is set when the stored hash was made with older argon2 parameters
+    return await _run_hasher(password_hash().verify_and_update, user_password, hashed_password)
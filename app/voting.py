@@ -0,0 +1,213 @@
+#set based vote writes, shared by POST /votes/, POST /votes/batch and the vote buffer
+#a whole batch costs one post lookup, one insert, one delete and one counter update no matter how many votes are in it
+import asyncio
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from sqlalchemy import select, update, delete, tuple_, case, exc
+from sqlalchemy.dialects.postgresql import insert
+from . import cache, database, models, feed_cache, live
+from .config import settings
+
+#result of a single vote
+ADDED = "added"
+REMOVED = "removed"
+ALREADY_VOTED = "already_voted"   #dir=1 but the vote exists
+NOT_VOTED = "not_voted"           #dir=0 but there is no vote to remove
+POST_NOT_FOUND = "post_not_found"
+
+FOREIGN_KEY_VIOLATION = "23503"   #what the votes_check_post trigger raises for a post deleted after apply_votes looked it up
+
+
+def sqlstate(error):
+    #the postgres error code of a failed statement, None when the server never answered(connection errors)
+    #psycopg2 puts it on the dbapi error, asyncpg on the error the dbapi error was raised from
+    orig = getattr(error, "orig", None)
+    return getattr(orig, "pgcode", None) or getattr(getattr(orig, "__cause__", None), "sqlstate", None)
+
+
+async def apply_votes(db, votes):
+    #votes--> list of (user_id, post_id, dir), returns one status per vote in the same order
+    #the caller commits, nothing here is visible to anyone else until then
+    statuses = [None] * len(votes)
+    if not votes:
+        return statuses
+
+    post_ids = {post_id for _, post_id, _ in votes}
+    #post_id--> created_at, posts is partitioned by month and the counter update below names the months so it only plans/locks those
+    existing_posts = dict((await db.execute(select(models.Post.id, models.Post.created_at).where(models.Post.id.in_(post_ids)))).all())
+
+    #the same user can vote and unvote the same post inside one batch, those have to be applied in order
+    #so round 0 gets the first vote of every (user, post), round 1 the second one and so on, usually there is only one round
+    rounds = []
+    seen = defaultdict(int)
+    for index, (user_id, post_id, direction) in enumerate(votes):
+        if post_id not in existing_posts:
+            statuses[index] = POST_NOT_FOUND
+            continue
+        key = (user_id, post_id)
+        if seen[key] == len(rounds):
+            rounds.append([])
+        rounds[seen[key]].append((index, key, direction))
+        seen[key] += 1
+
+    deltas = defaultdict(int)   #post_id--> change of vote_count
+    for round_votes in rounds:
+        #sorted so concurrent batches take the row locks in the same order and dont deadlock each other
+        to_add = sorted({key for _, key, direction in round_votes if direction == 1})
+        to_remove = sorted({key for _, key, direction in round_votes if direction == 0})
+
+        added = set()
+        if to_add:
+            #ON CONFLICT DO NOTHING--> votes that already exist are skipped instead of failing the whole statement
+            result = await db.execute(insert(models.Votes)\
+            .values([{"user_id": user_id, "post_id": post_id} for user_id, post_id in to_add])\
+            .on_conflict_do_nothing(index_elements=["user_id", "post_id"])\
+            .returning(models.Votes.user_id, models.Votes.post_id))
+            added = {tuple(row) for row in result.all()}
+
+        removed = set()
+        if to_remove:
+            result = await db.execute(delete(models.Votes)\
+            .where(tuple_(models.Votes.user_id, models.Votes.post_id).in_(to_remove))\
+            .returning(models.Votes.user_id, models.Votes.post_id)\
+            .execution_options(synchronize_session=False))
+            removed = {tuple(row) for row in result.all()}
+
+        for index, key, direction in round_votes:
+            if direction == 1:
+                statuses[index] = ADDED if key in added else ALREADY_VOTED
+            else:
+                statuses[index] = REMOVED if key in removed else NOT_VOTED
+        for _, post_id in added:
+            deltas[post_id] += 1
+        for _, post_id in removed:
+            deltas[post_id] -= 1
+
+    deltas = {post_id: delta for post_id, delta in deltas.items() if delta}
+    if deltas:
+        #one UPDATE for every touched post, vote_count + CASE id WHEN .. THEN delta
+        await db.execute(update(models.Post).where(models.Post.id.in_(sorted(deltas)), models.Post.created_at.in_(sorted({existing_posts[post_id] for post_id in deltas})))\
+        .values(vote_count=models.Post.vote_count + case(*deltas.items(), value=models.Post.id, else_=0))\
+        .execution_options(synchronize_session=False))
+
+    return statuses
+
+
+def changed(statuses):
+    return any(status in (ADDED, REMOVED) for status in statuses)
+
+
+#post ids each user has voted on(VOTED_CACHE_ENABLED), lets a feed page fill voted_by_me without a lookup
+voted_cache = cache.LazyBackend(lambda: cache.create_backend("voted", settings.voted_cache_max_size, settings.voted_cache_ttl_seconds))
+
+
+async def voted_post_ids(db, user_id: int, post_ids):
+    #which of post_ids the user has voted on, one query against the votes primary key(user_id, post_id) for a whole page
+    if not post_ids:
+        return set()
+
+    if settings.voted_cache_enabled:
+        voted = await voted_cache.get(str(user_id))
+        if voted is None:
+            limit = settings.voted_cache_max_votes
+            everything = (await db.execute(select(models.Votes.post_id).where(models.Votes.user_id == user_id).limit(limit + 1))).scalars().all()
+            voted = everything if len(everything) <= limit else False   #False--> too many to keep, look them up per page
+            await voted_cache.set(str(user_id), voted)
+        if voted is not False:
+            return set(voted).intersection(post_ids)
+
+    result = await db.execute(select(models.Votes.post_id).where(models.Votes.user_id == user_id, models.Votes.post_id.in_(post_ids)))
+    return set(result.scalars().all())
+
+
+async def forget_voted(user_ids):
+    #after a commit that changed these users' votes, a load racing with the commit can still store an old set until the ttl ends
+    if settings.voted_cache_enabled:
+        for user_id in set(user_ids):
+            await voted_cache.delete(str(user_id))
+
+
+async def votes_committed(votes, statuses):
+    #everything cached from votes, called after the commit
+    if changed(statuses):
+        await feed_cache.invalidate()
+        await forget_voted(user_id for (user_id, _, _), status in zip(votes, statuses) if status in (ADDED, REMOVED))
+        live.votes_changed(post_id for (_, post_id, _), status in zip(votes, statuses) if status in (ADDED, REMOVED))
+
+
+class VoteBuffer:
+    #groups single votes from many requests into one apply_votes call and one commit
+    #every caller still waits for its own status, so the http response is the same as without the buffer
+    def __init__(self, max_size: int, flush_interval: float):
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self._pending = []   #(user_id, post_id, dir, future)
+        self._flush_task = None   #timer for the current partial batch
+        self._running = set()
+
+    async def submit(self, user_id: int, post_id: int, direction: int):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((user_id, post_id, direction, future))
+        if len(self._pending) >= self.max_size:
+            self._flush_now()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+        return await future
+
+    def _flush_now(self):
+        #a full buffer doesnt wait for the timer
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        pending, self._pending = self._pending, []
+        task = asyncio.create_task(self._flush(pending))
+        self._running.add(task)   #keep a reference, the event loop only holds weak ones
+        task.add_done_callback(self._running.discard)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self._flush_task = None
+        pending, self._pending = self._pending, []
+        await self._flush(pending)
+
+    async def _flush(self, pending):
+        if not pending:
+            return
+        votes = [(user_id, post_id, direction) for user_id, post_id, direction, _ in pending]
+        try:
+            results = await self._commit(votes)
+            await votes_committed(votes, results)
+        except Exception as error:
+            results = [error] * len(pending)
+        for (*_, future), result in zip(pending, results):
+            if future.done():   #the caller may have gone away(client disconnect cancels its request)
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def _commit(self, votes):
+        #one status per vote, or the exception that vote failed with
+        try:
+            async with asynccontextmanager(database.get_session)() as db:
+                statuses = await apply_votes(db, votes)
+                await db.commit()
+            return statuses
+        except exc.DBAPIError as error:
+            if sqlstate(error) is None:
+                raise   #not the votes(database unreachable...), every vote would fail the same way
+            if len(votes) == 1:
+                #the unbuffered path answers 404 for a missing post, a post deleted between the lookup and the insert is the same thing
+                return [POST_NOT_FOUND if sqlstate(error) == FOREIGN_KEY_VIOLATION else error]
+            #one bad vote rolled back the whole batch--> retry the halves so only the votes that fail again get the error
+            #the halves commit one after the other, a user's vote and unvote of the same post stay in order
+            middle = len(votes) // 2
+            return await self._commit(votes[:middle]) + await self._commit(votes[middle:])
+
+
+@lru_cache
+def get_vote_buffer():
+    #one per worker, built by the first buffered vote
+    return VoteBuffer(settings.vote_buffer_max_size, settings.vote_buffer_flush_ms / 1000)
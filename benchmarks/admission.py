@@ -0,0 +1,100 @@
+#CI check for admission control--> ratelimit.AdmissionControl on its own, then a burst through the app in-process
+#every ADMISSION_QUEUE_TIMEOUT has to admit requests while slots are free and shed the rest, 0 included(no queue at all)
+#the shed request has to carry the CORS headers, a browser cant read its status or Retry-After otherwise
+#usage: python -m benchmarks.admission [--limit 5]
+#exits 1 when a check fails, needs no database
+import argparse
+import asyncio
+
+import httpx
+
+from app import ratelimit
+
+
+async def check_control(limit: int, queue_timeout: float):
+    #returns the problems found, empty when the control behaves
+    admission = ratelimit.AdmissionControl(limit, queue_timeout)
+    problems = []
+    admitted = [await admission.acquire() for _ in range(limit)]
+    if not all(admitted):
+        problems.append(f"timeout {queue_timeout}: {admitted.count(False)} of {limit} refused while slots were free")
+    if await admission.acquire():
+        problems.append(f"timeout {queue_timeout}: admitted over the limit of {limit}")
+    if admission.in_flight != admitted.count(True):
+        problems.append(f"timeout {queue_timeout}: in_flight is {admission.in_flight}, {admitted.count(True)} were admitted")
+
+    if queue_timeout > 0:
+        #a slot freed while a request waits goes to that request
+        waiting = asyncio.create_task(admission.acquire())
+        await asyncio.sleep(queue_timeout / 10)
+        admission.release()
+        if not await waiting:
+            problems.append(f"timeout {queue_timeout}: a waiting request didnt get the slot released for it")
+    else:
+        admission.release()
+        if not await admission.acquire():
+            problems.append(f"timeout {queue_timeout}: a released slot was not reused")
+    return problems
+
+
+async def check_app(limit: int, queue_timeout: float):
+    #`limit` slow requests at once are all admitted, the one after them is shed with a 503
+    from app import main
+    from app.config import settings
+
+    settings.admission_max_concurrent = limit
+    settings.admission_queue_timeout = queue_timeout
+    settings.rate_limit_enabled = False
+    ratelimit.get_admission.cache_clear()
+    ratelimit.get_rate_limiter.cache_clear()
+
+    release = asyncio.Event()
+
+    @main.app.get("/_admission_check")
+    async def hold():
+        await release.wait()
+        return {"status": "ok"}
+
+    problems = []
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://admission") as client:
+        held = [asyncio.create_task(client.get("/_admission_check")) for _ in range(limit)]
+        for _ in range(100):   #up to a second for all of them to be admitted, refused ones never will be
+            if ratelimit.get_admission().in_flight == limit or any(request.done() for request in held):
+                break
+            await asyncio.sleep(0.01)
+        shed = await client.get("/_admission_check", headers={"Origin": main.origins[0]})
+        release.set()
+        statuses = [response.status_code for response in await asyncio.gather(*held)]
+        if statuses != [200] * limit:
+            problems.append(f"app, timeout {queue_timeout}: requests within the limit answered {statuses}")
+        if shed.status_code != 503 or shed.headers.get("retry-after") != "1":
+            problems.append(f"app, timeout {queue_timeout}: request over the limit answered {shed.status_code}, expected 503 with Retry-After")
+        if shed.headers.get("access-control-allow-origin") != main.origins[0] or "retry-after" not in shed.headers.get("access-control-expose-headers", "").lower():
+            problems.append(f"app, timeout {queue_timeout}: the 503 has no CORS headers, browsers cant read it")
+        after = await client.get("/_admission_check")
+        if after.status_code != 200:
+            problems.append(f"app, timeout {queue_timeout}: request after the burst answered {after.status_code}")
+    main.app.router.routes.pop()
+    return problems
+
+
+async def run(args):
+    failures = []
+    for queue_timeout in (0, 0.05):
+        for name, check in (("control", check_control), ("app", check_app)):
+            problems = await check(args.limit, queue_timeout)
+            print(f"{name:<8} queue_timeout={queue_timeout:<5} {'ok' if not problems else 'FAILED'}")
+            failures.extend(problems)
+    return failures
+
+
+def main(args):
+    failures = asyncio.run(run(args))
+    if failures:
+        raise SystemExit("\n".join(failures))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.admission")
+    parser.add_argument("--limit", type=int, default=5)
+    main(parser.parse_args())
@@ -0,0 +1,176 @@
+#rows/sec loading posts and votes through COPY(python -m app.maintenance import) against doing it row by row through the api
+#(POST /posts/ and POST /votes/ in-process, --concurrency requests at a time), plus export rows/sec and the peak memory of the cli
+#runs in a new database that is dropped at the end
+#usage: python -m benchmarks.bulk_import [--rows 200000] [--api-rows 2000] [--concurrency 20] [--batch-size 5000]
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import orjson
+
+#row by row numbers are about the write path, not the limits in front of it
+os.environ.setdefault("ADMISSION_MAX_CONCURRENT", "-1")
+from benchmarks.harness import ROOT, PASSWORD, create_database, drop_database
+
+
+def seed_users(users):
+    from sqlalchemy import insert, select
+    from app import models, utils
+    from app.database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        password = utils.hashing(PASSWORD)
+        db.execute(insert(models.User), [{"email": f"user{i}@bench.example.com", "password": password} for i in range(users)])
+        db.commit()
+        return db.execute(select(models.User.id)).scalars().all()
+    finally:
+        db.close()
+
+
+def write_files(directory, rows, user_ids):
+    #the shape an export produces, ids included, so every format loads the same rows
+    paths = {name: os.path.join(directory, name) for name in ("posts.ndjson", "posts.csv", "votes.ndjson", "votes.csv")}
+    with open(paths["posts.ndjson"], "wb") as ndjson, open(paths["posts.csv"], "w") as csv:
+        csv.write("id,title,content,published,created_at,owner_id\n")
+        for i in range(1, rows + 1):
+            post = {"id": i, "title": f"post {i}", "content": "bulk loaded, with a comma and \"quotes\"", "published": True,
+                    "created_at": "2026-01-01T00:00:00+00:00", "owner_id": user_ids[i % len(user_ids)]}
+            ndjson.write(orjson.dumps(post) + b"\n")
+            csv.write(f'{i},post {i},"bulk loaded, with a comma and ""quotes""",t,2026-01-01 00:00:00+00,{post["owner_id"]}\n')
+    with open(paths["votes.ndjson"], "wb") as ndjson, open(paths["votes.csv"], "w") as csv:
+        csv.write("user_id,post_id\n")
+        for i in range(1, rows + 1):
+            vote = {"user_id": user_ids[i % len(user_ids)], "post_id": i}
+            ndjson.write(orjson.dumps(vote) + b"\n")
+            csv.write(f"{vote['user_id']},{i}\n")
+    return paths
+
+
+def run_cli(*args):
+    #seconds and peak rss(MB) of one maintenance command, memory read from /proc while it runs
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-m", "app.maintenance", *args], cwd=ROOT, env=os.environ,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    peak = 0
+    while process.poll() is None:
+        try:
+            with open(f"/proc/{process.pid}/status") as f:
+                peak = max([peak] + [int(line.split()[1]) for line in f if line.startswith("VmHWM:")])
+        except OSError:
+            pass
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    if process.returncode:
+        raise SystemExit(f"{' '.join(args)} failed: {process.stderr.read().decode()}")
+    return elapsed, peak / 1024
+
+
+def truncate():
+    from sqlalchemy import text
+    from app.database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        db.execute(text("TRUNCATE posts, votes"))   #votes have no foreign key to posts(partitioned), CASCADE wouldnt reach them
+        db.commit()
+    finally:
+        db.close()
+
+
+async def through_api(rows, concurrency, user_ids, post_ids=None):
+    #post_ids--> vote on them, None--> create posts, every request as its own user like real traffic
+    import httpx
+    from app.main import app
+    from app import oauth2
+
+    headers = [{"Authorization": f"Bearer {oauth2.create_token({'user_id': user_id})}"} for user_id in user_ids]
+    queue = asyncio.Queue()
+    for i in range(rows):
+        queue.put_nowait(i)
+    failed = [0]
+
+    async def worker(client):
+        while not queue.empty():
+            i = queue.get_nowait()
+            if post_ids is None:
+                response = await client.post("/posts/", json={"title": f"api post {i}", "content": "row by row"},
+                                             headers=headers[i % len(headers)])
+            else:
+                response = await client.post("/votes/", json={"posts_id": post_ids[i], "dir": 1}, headers=headers[i % len(headers)])
+            failed[0] += response.status_code != 201
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    if failed[0]:
+        print(f"warning: {failed[0]} api request(s) failed")
+    return elapsed
+
+
+def main(args):
+    from sqlalchemy import text
+    from app.config import settings
+
+    admin_database = settings.database_name
+    database = create_database()
+    from app.database import SessionLocal   #only now, the engine has to point at the new database
+
+    results = []
+    try:
+        user_ids = seed_users(args.users)
+        with tempfile.TemporaryDirectory() as directory:
+            paths = write_files(directory, args.rows, user_ids)
+            batch = ["--batch-size", str(args.batch_size)] if args.batch_size else []
+
+            for format in ("ndjson", "csv"):
+                truncate()
+                seconds, peak = run_cli("import", "posts", paths[f"posts.{format}"], *batch)
+                results.append((f"COPY import posts({format})", args.rows, seconds, peak))
+                seconds, peak = run_cli("import", "votes", paths[f"votes.{format}"], *batch)
+                results.append((f"COPY import votes({format})", args.rows, seconds, peak))
+                output = os.path.join(directory, f"export.{format}")
+                seconds, peak = run_cli("export", "posts", "--output", output)
+                results.append((f"COPY export posts({format})", args.rows, seconds, peak))
+
+            db = SessionLocal()
+            try:
+                drift = db.execute(text("SELECT count(*) FROM posts WHERE vote_count <> 1")).scalar()
+            finally:
+                db.close()
+            if drift:
+                print(f"warning: {drift} post(s) without exactly one vote after the import")
+
+            truncate()
+            seconds = asyncio.run(through_api(args.api_rows, args.concurrency, user_ids))
+            results.append(("POST /posts/ row by row", args.api_rows, seconds, None))
+            db = SessionLocal()
+            try:
+                post_ids = db.execute(text("SELECT id FROM posts ORDER BY id")).scalars().all()
+            finally:
+                db.close()
+            seconds = asyncio.run(through_api(len(post_ids), args.concurrency, user_ids, post_ids))
+            results.append(("POST /votes/ row by row", len(post_ids), seconds, None))
+    finally:
+        drop_database(database, admin_database)
+
+    print(f"rows={args.rows} api_rows={args.api_rows} concurrency={args.concurrency} batch_size={args.batch_size or settings.bulk_batch_size} "
+          f"database_mode={settings.database_mode} cpus={os.cpu_count()}")
+    for name, rows, seconds, peak in results:
+        memory = f"  peak rss {peak:.0f} MB" if peak else ""
+        print(f"{name:<28} {rows:>8} rows  {seconds:7.2f}s  {rows / seconds:9.0f} rows/s{memory}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.bulk_import")
+    parser.add_argument("--rows", type=int, default=200000, help="posts(and as many votes) in the generated files")
+    parser.add_argument("--api-rows", type=int, default=2000, help="posts created through the api, votes are cast on each of them")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=0, help="rows per COPY batch, default BULK_BATCH_SIZE")
+    main(parser.parse_args())
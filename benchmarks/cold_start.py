@@ -0,0 +1,79 @@
+#how long a fresh worker takes before it can serve traffic
+#  import     --> `import app.main` in a new interpreter
+#  live/ready --> uvicorn started until /health/live and /health/ready first answer 200
+#usage: python -m benchmarks.cold_start [--runs 5] [--database-down]
+#--database-down points the app at a closed port: the import and /health/live must still work, /health/ready stays 503
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def time_import(env):
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "import app.main"], cwd=ROOT, env=env, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - started
+
+
+def time_server(env, timeout: float):
+    #returns (seconds until live, seconds until ready or None)
+    port = _free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "error"],
+                              cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    live = ready = None
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=1) as client:
+            while time.perf_counter() - started < timeout and ready is None:
+                try:
+                    if live is None and client.get("/health/live").status_code == 200:
+                        live = time.perf_counter() - started
+                    if live is not None and client.get("/health/ready").status_code == 200:
+                        ready = time.perf_counter() - started
+                except httpx.HTTPError:
+                    pass
+                time.sleep(0.01)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+    return live, ready
+
+
+def _median_ms(values):
+    values = [value for value in values if value is not None]
+    return f"{statistics.median(values) * 1000:8.1f} ms" if values else "   never"
+
+
+def main(args):
+    env = dict(os.environ)
+    if args.database_down:
+        env["DATABASE_PORT"] = "1"
+
+    imports = [time_import(env) for _ in range(args.runs)]
+    servers = [time_server(env, args.timeout) for _ in range(args.runs)]
+    print(f"runs={args.runs} database_down={args.database_down}")
+    print(f"import app.main   {_median_ms(imports)}")
+    print(f"/health/live      {_median_ms([live for live, _ in servers])}")
+    print(f"/health/ready     {_median_ms([ready for _, ready in servers])}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.cold_start")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=5, help="seconds to wait for /health/ready per run")
+    parser.add_argument("--database-down", action="store_true")
+    main(parser.parse_args())
@@ -0,0 +1,109 @@
+#GET /posts/ deep in the feed, ?skip= (OFFSET, postgres reads and throws away every row before the page) against ?cursor=
+#(keyset, starts right after the last post of the previous page) for the same page at several depths
+#both requests return the same posts, the script checks that before timing them
+#usage: python -m benchmarks.feed_pagination [--posts 200000] [--depths 0,1000,10000,100000] [--months 12] [--rounds 30]
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+from benchmarks.harness import create_database, drop_database, create_partitions
+
+
+def seed(posts: int, months: int):
+    from sqlalchemy import text
+    from app.database import SessionLocal
+
+    create_partitions(months)   #`months` times 30 days back reaches into one more calendar month
+    db = SessionLocal()
+    try:
+        db.execute(text("INSERT INTO users (email, password) SELECT 'user' || i || '@bench.example.com', 'x' FROM generate_series(1, 100) i"))
+        #spread over the months like a real feed, the deep pages are in the older partitions
+        db.execute(text(
+            "INSERT INTO posts (title, content, owner_id, created_at) "
+            "SELECT 'post ' || i, 'benchmark post ' || i, (SELECT min(id) FROM users) + i % 100, "
+            "now() - make_interval(secs => i * (:months * 30 * 86400.0 / :posts)) "
+            "FROM generate_series(1, :posts) i"), {"posts": posts, "months": months})
+        db.commit()
+        db.execute(text("ANALYZE"))
+        return db.execute(text("SELECT min(id) FROM users")).scalar()
+    finally:
+        db.close()
+
+
+def cursor_at(depth: int):
+    #the cursor a client holds after reading `depth` posts, the (created_at, id) of the last one
+    from sqlalchemy import text
+    from app import pagination
+    from app.database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        created_at, post_id = db.execute(text("SELECT created_at, id FROM posts ORDER BY created_at DESC, id DESC OFFSET :skip LIMIT 1"),
+                                         {"skip": depth - 1}).one()
+        return pagination.encode_cursor(created_at, post_id)
+    finally:
+        db.close()
+
+
+async def median_ms(client, path, headers, rounds: int):
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        response = await client.get(path, headers=headers)
+        timings.append(time.perf_counter() - started)
+        assert response.status_code == 200, response.text
+    return statistics.median(timings) * 1000, [post["Post"]["id"] for post in response.json()]
+
+
+async def measure(args, user_id, depths):
+    from app import oauth2
+    from app.main import app
+
+    headers = {"Authorization": f"Bearer {oauth2.create_token({'user_id': user_id})}"}
+    results = []
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark") as client:
+        await client.get(f"/posts/?limit={args.limit}", headers=headers)   #fills the user cache and the connection pool
+        for depth in depths:
+            offset, offset_ids = await median_ms(client, f"/posts/?limit={args.limit}&skip={depth}", headers, args.rounds)
+            if depth:
+                keyset, keyset_ids = await median_ms(client, f"/posts/?limit={args.limit}&cursor={cursor_at(depth)}", headers, args.rounds)
+            else:
+                keyset, keyset_ids = offset, offset_ids   #the first page has no cursor, both are the same request
+            if offset_ids != keyset_ids:
+                raise SystemExit(f"depth {depth}: skip and cursor returned different posts {offset_ids} vs {keyset_ids}")
+            results.append((depth, offset, keyset))
+    return results
+
+
+def main(args):
+    from app.config import settings
+
+    depths = sorted({int(depth) for depth in args.depths.split(",") if int(depth) < args.posts})
+    admin_database = settings.database_name
+    database = create_database()
+    try:
+        started = time.perf_counter()
+        user_id = seed(args.posts, args.months)
+        print(f"seeded {args.posts} posts in {time.perf_counter() - started:.1f}s")
+        settings.feed_cache_enabled = False   #measure the query, not the response cache
+        results = asyncio.run(measure(args, user_id, depths))
+    finally:
+        drop_database(database, admin_database)
+
+    print(f"posts={args.posts} months={args.months} limit={args.limit} rounds={args.rounds} database_mode={settings.database_mode}, median ms per request")
+    print(f"{'depth':>8} {'skip':>10} {'cursor':>10} {'speedup':>8}")
+    for depth, offset, keyset in results:
+        print(f"{depth:>8} {offset:>10.2f} {keyset:>10.2f} {offset / keyset:>7.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.feed_pagination")
+    parser.add_argument("--posts", type=int, default=200000)
+    parser.add_argument("--depths", default="0,1000,10000,100000", help="posts before the measured page")
+    parser.add_argument("--months", type=int, default=12, help="months the posts are spread over(one partition each)")
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=30)
+    main(parser.parse_args())
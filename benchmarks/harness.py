@@ -0,0 +1,443 @@
+#load test harness: seeds a throwaway postgres database, replays a weighted traffic mix against the app and
+#reports throughput and p50/p95/p99 latency per endpoint, results are saved as json so two runs can be compared
+#
+#usage:
+#  python -m benchmarks.harness run [--mode inprocess|uvicorn|server] [--users 50] [--posts 2000] [--votes 10000]
+#                                   [--requests 3000] [--concurrency 20] [--traffic benchmarks/traffic.jsonl] [--output FILE]
+#  python -m benchmarks.harness compare OLD.json NEW.json [--threshold 0.1]
+#  python -m benchmarks.harness scale [--workers-list 1,2,4] [run options]   throughput of the production server per worker count
+#
+#the database server comes from the usual DATABASE_* settings(.env), a new database is created on it for every run
+#and dropped at the end(--keep-database to look at it afterwards). postgres only, the schema needs tsvector, GIN and ON CONFLICT
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime, timezone
+from pathlib import Path
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+DEFAULT_TRAFFIC = Path(__file__).resolve().parent / "traffic.jsonl"
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+PASSWORD = "benchmark-password"
+WORDS = ["python", "fastapi", "postgres", "cache", "votes", "feed", "search", "latency", "index", "async"]
+
+#the replayed traffic logs in and writes far faster than the per client rate limits allow, the app and the servers it
+#starts run without them(admission control stays on, it is part of how the server behaves under load)
+os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+
+
+#disposable database
+def _admin_connection():
+    import psycopg2
+    from app.config import settings
+
+    connection = psycopg2.connect(host=settings.database_hostname, port=settings.database_port, user=settings.database_username,
+                                  password=settings.database_password, dbname=settings.database_name)
+    connection.autocommit = True   #CREATE/DROP DATABASE cant run inside a transaction
+    return connection
+
+
+def create_database():
+    from app.config import settings
+
+    name = f"bench_{uuid.uuid4().hex[:10]}"
+    connection = _admin_connection()
+    with connection.cursor() as cursor:
+        cursor.execute(f'CREATE DATABASE "{name}"')
+    connection.close()
+    #engines are built from settings when app.database is first imported, that happens after this point so they use the new database
+    #the environment variable is for the subprocesses(alembic, uvicorn)
+    settings.database_name = name
+    os.environ["DATABASE_NAME"] = name
+    subprocess.run([sys.executable, "-m", "alembic", "upgrade", "head"], cwd=ROOT, env=os.environ, check=True,
+                   stdout=subprocess.DEVNULL)
+    return name
+
+
+def drop_database(name: str, admin_database: str):
+    from app.config import settings
+
+    settings.database_name = admin_database
+    os.environ["DATABASE_NAME"] = admin_database
+    connection = _admin_connection()
+    with connection.cursor() as cursor:
+        cursor.execute(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE)')
+    connection.close()
+
+
+def create_partitions(months_back: int):
+    #a new database only has posts partitions from this month on(app/partitions.py), seeds going further back need their months first
+    from sqlalchemy import text
+    from app import partitions
+    from app.database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        this_month = partitions.month_start(datetime.now(timezone.utc))
+        for offset in range(months_back, 0, -1):
+            db.execute(text(partitions.create_partition_sql(partitions.add_months(this_month, -offset))))
+        db.commit()
+    finally:
+        db.close()
+
+
+def seed(users: int, posts: int, votes: int, rng: random.Random):
+    from sqlalchemy import insert, select, text
+    from app import models, utils
+    from app.database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        password = utils.hashing(PASSWORD)   #one hash shared by everyone, hashing per user would dominate the setup
+        db.execute(insert(models.User), [{"email": f"user{i}@bench.example.com", "password": password} for i in range(users)])
+        user_ids = db.execute(select(models.User.id)).scalars().all()
+
+        rows = []
+        for i in range(posts):
+            words = rng.sample(WORDS, 3)
+            rows.append({"title": f"post {i} about {words[0]}", "content": " ".join(words) * 10, "owner_id": rng.choice(user_ids)})
+        db.execute(insert(models.Post), rows)
+        post_ids = db.execute(select(models.Post.id)).scalars().all()
+
+        pairs = set()
+        votes = min(votes, len(user_ids) * len(post_ids))
+        while len(pairs) < votes:
+            pairs.add((rng.choice(user_ids), rng.choice(post_ids)))
+        if pairs:
+            db.execute(insert(models.Votes), [{"user_id": user_id, "post_id": post_id} for user_id, post_id in pairs])
+        #fill the denormalized counter in one statement
+        db.execute(text("UPDATE posts SET vote_count = counts.n FROM (SELECT post_id, count(*) AS n FROM votes GROUP BY post_id) counts "
+                        "WHERE posts.id = counts.post_id"))
+        db.commit()
+        return user_ids, post_ids
+    finally:
+        db.close()
+
+
+#traffic
+def load_traffic(path):
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def _fill(template, values):
+    #"{post_id}" on its own keeps the value's type(ints stay ints in json bodies), anything else is string formatting
+    if isinstance(template, dict):
+        return {key: _fill(value, values) for key, value in template.items()}
+    if isinstance(template, str):
+        if template.startswith("{") and template.endswith("}") and template[1:-1] in values:
+            return values[template[1:-1]]
+        return template.format(**values)
+    return template
+
+
+def build_plan(traffic, count: int, user_count: int, post_ids, rng: random.Random):
+    names = [entry["name"] for entry in traffic]
+    weights = [entry.get("weight", 1) for entry in traffic]
+    by_name = {entry["name"]: entry for entry in traffic}
+    plan = []
+    for name in rng.choices(names, weights=weights, k=count):
+        entry = by_name[name]
+        user = rng.randrange(user_count)
+        values = {"email": f"user{user}@bench.example.com", "password": PASSWORD, "post_id": rng.choice(post_ids),
+                  "word": rng.choice(WORDS), "dir": rng.randint(0, 1)}
+        plan.append({
+            "name": name,
+            "method": entry.get("method", "GET"),
+            "path": _fill(entry["path"], values),
+            "json": _fill(entry["json"], values) if "json" in entry else None,
+            "form": _fill(entry["form"], values) if "form" in entry else None,
+            "user": user if entry.get("auth", True) else None,
+        })
+    return plan
+
+
+async def replay(client, plan, tokens, concurrency: int):
+    samples = defaultdict(list)   #name--> [(seconds, status)]
+    queue = asyncio.Queue()
+    for request in plan:
+        queue.put_nowait(request)
+
+    async def worker():
+        while not queue.empty():
+            request = queue.get_nowait()
+            headers = {"Authorization": f"Bearer {tokens[request['user']]}"} if request["user"] is not None else {}
+            started = time.perf_counter()
+            try:
+                response = await client.request(request["method"], request["path"], json=request["json"], data=request["form"], headers=headers)
+                status = response.status_code
+            except httpx.HTTPError:
+                status = 0   #connection level failure
+            samples[request["name"]].append((time.perf_counter() - started, status))
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return samples, time.perf_counter() - started
+
+
+#reporting
+def _percentile(sorted_values, fraction):
+    #nearest rank
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples, elapsed: float):
+    def stats(entries):
+        latencies = sorted(seconds for seconds, _ in entries)
+        statuses = defaultdict(int)
+        for _, status in entries:
+            statuses[str(status)] += 1
+        return {
+            "count": len(entries),
+            "errors": sum(1 for _, status in entries if status == 0 or status >= 500),
+            "statuses": dict(sorted(statuses.items())),
+            "throughput_rps": round(len(entries) / elapsed, 2),
+            "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+            "p50_ms": round(_percentile(latencies, 0.50) * 1000, 3),
+            "p95_ms": round(_percentile(latencies, 0.95) * 1000, 3),
+            "p99_ms": round(_percentile(latencies, 0.99) * 1000, 3),
+        }
+
+    endpoints = {name: stats(entries) for name, entries in sorted(samples.items())}
+    everything = [entry for entries in samples.values() for entry in entries]
+    return endpoints, stats(everything)
+
+
+def print_report(result):
+    print(f"mode={result['meta']['mode']} database_mode={result['meta']['database_mode']} "
+          f"requests={result['total']['count']} elapsed={result['meta']['elapsed_seconds']}s")
+    print(f"{'endpoint':<14} {'count':>6} {'errors':>6} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}  statuses")
+    for name, data in list(result["endpoints"].items()) + [("TOTAL", result["total"])]:
+        print(f"{name:<14} {data['count']:>6} {data['errors']:>6} {data['throughput_rps']:>9.1f} {data['p50_ms']:>9.2f} "
+              f"{data['p95_ms']:>9.2f} {data['p99_ms']:>9.2f}  {data['statuses']}")
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+#runners
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def run_inprocess(plan, tokens, concurrency):
+    from app.main import app
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        return await replay(client, plan, tokens, concurrency)
+
+
+def _server_command(mode, port, workers):
+    #uvicorn--> plain uvicorn cli, server--> the production entry point(python -m app.server, gunicorn + uvicorn workers)
+    if mode == "server":
+        env = dict(os.environ, WEB_CONCURRENCY=str(workers), SERVER_BIND=f"127.0.0.1:{port}", LOG_LEVEL="WARNING")
+        return [sys.executable, "-m", "app.server"], env
+    return [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port),
+            "--workers", str(workers), "--log-level", "warning", "--no-access-log"], os.environ
+
+
+async def run_server(plan, tokens, concurrency, workers, mode="uvicorn"):
+    port = _free_port()
+    command, env = _server_command(mode, port, workers)
+    server = subprocess.Popen(command, cwd=ROOT, env=env)
+    try:
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=30) as client:
+            deadline = time.monotonic() + 60
+            while True:
+                try:
+                    if (await client.get("/health/ready")).status_code == 200:
+                        break
+                except httpx.HTTPError:
+                    pass
+                if time.monotonic() > deadline or server.poll() is not None:
+                    raise RuntimeError(f"{mode} did not start")
+                await asyncio.sleep(0.2)
+            return await replay(client, plan, tokens, concurrency)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def _prepare(args, rng):
+    #seeds the current(throwaway) database and builds the warmup and measured request plans
+    user_ids, post_ids = seed(args.users, args.posts, args.votes, rng)
+    from app import oauth2
+
+    tokens = [oauth2.create_token({"user_id": user_id}) for user_id in user_ids]
+    traffic = load_traffic(args.traffic)
+    warmup = build_plan(traffic, args.warmup, len(user_ids), post_ids, rng)
+    plan = build_plan(traffic, args.requests, len(user_ids), post_ids, rng)
+    return tokens, warmup, plan
+
+
+def _measure(args, mode, workers, tokens, warmup, plan):
+    if mode == "inprocess":
+        async def both():
+            await run_inprocess(warmup, tokens, args.concurrency)
+            return await run_inprocess(plan, tokens, args.concurrency)
+    else:
+        async def both():
+            await run_server(warmup, tokens, args.concurrency, workers, mode)
+            return await run_server(plan, tokens, args.concurrency, workers, mode)
+    return asyncio.run(both())
+
+
+def _result(args, mode, samples, elapsed):
+    from app.config import settings
+
+    endpoints, total = summarize(samples, elapsed)
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "time": datetime.now(timezone.utc).isoformat(),
+            "mode": mode,
+            "database_mode": settings.database_mode,
+            "elapsed_seconds": round(elapsed, 3),
+            "args": {key: str(value) for key, value in vars(args).items() if key != "func"},
+        },
+        "endpoints": endpoints,
+        "total": total,
+    }
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    from app.config import settings
+
+    admin_database = settings.database_name
+    database = create_database()
+    try:
+        tokens, warmup, plan = _prepare(args, rng)
+        samples, elapsed = _measure(args, args.mode, args.workers, tokens, warmup, plan)
+    finally:
+        if not args.keep_database:
+            drop_database(database, admin_database)
+
+    result = _result(args, args.mode, samples, elapsed)
+    print_report(result)
+
+    output = Path(args.output) if args.output else RESULTS_DIR / f"{result['meta']['commit']}-{args.mode}-{int(time.time())}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(result, indent=2))
+    print(f"saved {output}")
+
+
+def scale(args):
+    #same data and request plan for every worker count, so the only thing that changes is the number of processes
+    #the load generator runs on the same machine and needs cpu too, scaling flattens out before the last core
+    rng = random.Random(args.seed)
+    from app.config import settings
+
+    admin_database = settings.database_name
+    database = create_database()
+    rows = []
+    try:
+        tokens, warmup, plan = _prepare(args, rng)
+        for workers in args.workers_list:
+            samples, elapsed = _measure(args, "server", workers, tokens, warmup, plan)
+            rows.append((workers, _result(args, "server", samples, elapsed)["total"]))
+    finally:
+        if not args.keep_database:
+            drop_database(database, admin_database)
+
+    print(f"database_mode={settings.database_mode} requests={args.requests} concurrency={args.concurrency} cpus={os.cpu_count()}")
+    print(f"{'workers':>7} {'req/s':>9} {'speedup':>8} {'per worker':>10} {'p95 ms':>9} {'errors':>6}")
+    baseline = rows[0][1]["throughput_rps"] / rows[0][0]
+    for workers, total in rows:
+        speedup = total["throughput_rps"] / baseline
+        print(f"{workers:>7} {total['throughput_rps']:>9.1f} {speedup:>7.2f}x {speedup / workers:>9.0%} {total['p95_ms']:>9.2f} {total['errors']:>6}")
+    return 0
+
+
+def compare(args):
+    #a regression is p95 getting slower or throughput dropping by more than the threshold, exit code 1 so CI can fail on it
+    old = json.loads(Path(args.old).read_text())
+    new = json.loads(Path(args.new).read_text())
+    regressions = 0
+    print(f"{old['meta']['commit']} -> {new['meta']['commit']}")
+    for key in ("mode", "database_mode"):
+        if old["meta"][key] != new["meta"][key]:
+            print(f"warning: {key} differs ({old['meta'][key]} vs {new['meta'][key]}), the numbers are not comparable")
+    print(f"{'endpoint':<14} {'p95 old':>9} {'p95 new':>9} {'change':>8} {'rps old':>9} {'rps new':>9} {'change':>8}")
+    names = sorted(set(old["endpoints"]) & set(new["endpoints"])) + ["TOTAL"]
+    for name in names:
+        before = old["total"] if name == "TOTAL" else old["endpoints"][name]
+        after = new["total"] if name == "TOTAL" else new["endpoints"][name]
+        p95_change = after["p95_ms"] / before["p95_ms"] - 1 if before["p95_ms"] else 0
+        rps_change = after["throughput_rps"] / before["throughput_rps"] - 1 if before["throughput_rps"] else 0
+        flag = ""
+        if p95_change > args.threshold or rps_change < -args.threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{name:<14} {before['p95_ms']:>9.2f} {after['p95_ms']:>9.2f} {p95_change:>+8.1%} "
+              f"{before['throughput_rps']:>9.1f} {after['throughput_rps']:>9.1f} {rps_change:>+8.1%}{flag}")
+    return 1 if regressions else 0
+
+
+def _default_workers_list():
+    counts = [1]
+    while counts[-1] * 2 <= (os.cpu_count() or 1):
+        counts.append(counts[-1] * 2)
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.harness")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    #data and traffic options shared by run and scale
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument("--users", type=int, default=50)
+    options.add_argument("--posts", type=int, default=2000)
+    options.add_argument("--votes", type=int, default=10000)
+    options.add_argument("--requests", type=int, default=3000)
+    options.add_argument("--warmup", type=int, default=200, help="requests sent first and left out of the results")
+    options.add_argument("--concurrency", type=int, default=20)
+    options.add_argument("--traffic", default=str(DEFAULT_TRAFFIC), help="jsonl file with one weighted request template per line")
+    options.add_argument("--seed", type=int, default=1)
+    options.add_argument("--keep-database", action="store_true")
+
+    run_parser = commands.add_parser("run", parents=[options], help="seed a throwaway database and replay the traffic mix")
+    run_parser.add_argument("--mode", choices=["inprocess", "uvicorn", "server"], default="inprocess")
+    run_parser.add_argument("--workers", type=int, default=1, help="worker processes(uvicorn and server modes)")
+    run_parser.add_argument("--output", help="where to write the json results(default benchmarks/results/)")
+
+    scale_parser = commands.add_parser("scale", parents=[options], help="production server throughput for several worker counts")
+    scale_parser.add_argument("--workers-list", type=lambda value: [int(part) for part in value.split(",")],
+                              default=_default_workers_list(), help="comma separated worker counts(default 1,2,4.. up to the cpu count)")
+
+    compare_parser = commands.add_parser("compare", help="compare two saved runs")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.10, help="allowed relative change before flagging(0.10 = 10%%)")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        run(args)
+        return 0
+    if args.command == "scale":
+        return scale(args)
+    return compare(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,241 @@
+#soak test for live vote counts: many subscribers each follow a few posts while votes keep coming in, reports the time from
+#a vote's commit to the frame with its count reaching every follower(p50/p95/p99/max) and memory at the start and the end
+#  --transport hub       subscribers inside this process on the hub itself, measures the fan-out without any sockets
+#  --transport websocket a real server(uvicorn --workers N with the production server's websocket protocol, LIVE_BACKEND=postgres)
+#                        and one websocket client per subscriber
+#usage: python -m benchmarks.live_fanout [--transport hub|websocket] [--subscribers 10000] [--seconds 60] [--rate 200]
+#                                        [--posts 1000] [--follow 5] [--workers 2]
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import time
+from collections import Counter
+
+import httpx
+import orjson
+
+from benchmarks.harness import ROOT, create_database, drop_database, _free_port
+from app.server import WEBSOCKETS
+
+
+def seed(posts: int):
+    from sqlalchemy import text
+    from app import utils
+    from app.database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        user_id = db.execute(text("INSERT INTO users (email, password) VALUES ('live@bench.example.com', :password) RETURNING id"),
+                             {"password": utils.hashing("benchmark")}).scalar()
+        post_ids = db.execute(text("INSERT INTO posts (title, content, owner_id) SELECT 'post ' || i, 'live benchmark', :user_id "
+                                   "FROM generate_series(1, :posts) i RETURNING id"), {"posts": posts, "user_id": user_id}).scalars().all()
+        db.commit()
+        return user_id, post_ids
+    finally:
+        db.close()
+
+
+def rss_mb(pid="self"):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+
+
+def _command_line(pid):
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            return f.read().decode(errors="replace")
+    except OSError:
+        return ""
+
+
+class Recorder:
+    #commit time of every (post, count) the publisher wrote, and how long each follower took to see it
+    #latencies are counted in 0.1 ms buckets so a long soak doesnt grow the benchmark's own memory
+    def __init__(self):
+        self.published = {}
+        self.latencies = Counter()
+        self.frames = 0
+
+    def received(self, counts):
+        now = time.perf_counter()
+        self.frames += 1
+        for post_id, vote_count in counts.items():
+            started = self.published.get((int(post_id), vote_count))
+            if started is not None:
+                self.latencies[int((now - started) * 10000)] += 1
+
+    def percentile(self, fraction):
+        #in ms
+        rank = fraction * (sum(self.latencies.values()) - 1)
+        seen = 0
+        for bucket, count in sorted(self.latencies.items()):
+            seen += count
+            if seen > rank:
+                return bucket / 10
+
+
+async def publish(connection, recorder, post_ids, rate, seconds, rng, notify):
+    #one vote at a time at `rate` per second, hot posts(the start of post_ids) get most of them
+    weights = [1 / (rank + 1) for rank in range(len(post_ids))]
+    started = time.perf_counter()
+    published = 0
+    while time.perf_counter() - started < seconds:
+        post_id = rng.choices(post_ids, weights=weights)[0]
+        vote_count = await connection.fetchval("UPDATE posts SET vote_count = vote_count + 1 WHERE id = $1 RETURNING vote_count", post_id)
+        recorder.published[(post_id, vote_count)] = time.perf_counter()
+        await notify(post_id)
+        published += 1
+        await asyncio.sleep(max(0.0, started + published / rate - time.perf_counter()))
+    return published
+
+
+def follow_lists(subscribers, post_ids, follow, rng):
+    #everyone follows a few posts, skewed like the votes so hot posts have thousands of followers
+    weights = [1 / (rank + 1) for rank in range(len(post_ids))]
+    return [sorted(set(rng.choices(post_ids, weights=weights, k=follow))) for _ in range(subscribers)]
+
+
+async def run_hub(args, post_ids, rng, connection):
+    from app import live
+
+    recorder = Recorder()
+    hub = live.get_hub()
+    tasks = [asyncio.create_task(hub.run()), asyncio.create_task(live.get_broker().run())]
+
+    async def consume(subscriber):
+        while True:
+            recorder.received(await subscriber.next_frame())
+
+    for follows in follow_lists(args.subscribers, post_ids, args.follow, rng):
+        subscriber = live.Subscriber()
+        hub.add(subscriber)
+        hub.subscribe(subscriber, follows)
+        tasks.append(asyncio.create_task(consume(subscriber)))
+
+    async def notify(post_id):
+        live.votes_changed([post_id])
+
+    memory_before = rss_mb()
+    published = await publish(connection, recorder, post_ids, args.rate, args.seconds, rng, notify)
+    await asyncio.sleep(1)   #let the last flush arrive
+    for task in tasks:
+        task.cancel()
+    return recorder, published, {"benchmark": (memory_before, rss_mb())}
+
+
+async def run_websocket(args, post_ids, rng, connection, token):
+    import websockets
+
+    port = _free_port()
+    env = dict(os.environ, LIVE_BACKEND="postgres", RATE_LIMIT_ENABLED="false", LIVE_MAX_SUBSCRIBERS=str(args.subscribers))
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port),
+                               "--workers", str(args.workers), "--ws", WEBSOCKETS, "--log-level", "warning", "--no-access-log"], cwd=ROOT, env=env)
+    recorder = Recorder()
+    clients = []
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}") as http:
+            for _ in range(300):
+                try:
+                    if (await http.get("/health/ready")).status_code == 200:
+                        break
+                except httpx.HTTPError:
+                    pass
+                await asyncio.sleep(0.1)
+
+        connected = asyncio.Event()
+        pending = [args.subscribers]
+        limit = asyncio.Semaphore(200)   #connect a few hundred at a time, not all 10k at once
+
+        async def subscribe(follows):
+            async with limit:
+                socket = await websockets.connect(f"ws://127.0.0.1:{port}/live/votes?posts={','.join(map(str, follows))}",
+                                                  subprotocols=["bearer", token], open_timeout=60, max_queue=None)
+                await socket.recv()   #current counts
+            pending[0] -= 1
+            if not pending[0]:
+                connected.set()
+            async for message in socket:
+                recorder.received(orjson.loads(message)["votes"])
+
+        started = time.perf_counter()
+        clients = [asyncio.create_task(subscribe(follows)) for follows in follow_lists(args.subscribers, post_ids, args.follow, rng)]
+        await asyncio.wait_for(connected.wait(), 600)
+        print(f"connected {args.subscribers} websockets in {time.perf_counter() - started:.1f}s")
+
+        async def notify(post_id):
+            await connection.execute("SELECT pg_notify('post_votes', $1)", str(post_id))
+
+        workers = [pid for pid in subprocess.run(["pgrep", "-P", str(server.pid)], capture_output=True, text=True).stdout.split()
+                   if "resource_tracker" not in _command_line(pid)] or [server.pid]
+        memory_before = {pid: rss_mb(pid) for pid in workers}
+        published = await publish(connection, recorder, post_ids, args.rate, args.seconds, rng, notify)
+        await asyncio.sleep(1)
+        memory = {f"worker {pid}": (memory_before[pid], rss_mb(pid)) for pid in workers}
+        return recorder, published, memory
+    finally:
+        for client in clients:
+            client.cancel()
+        server.terminate()
+        server.wait(timeout=30)
+
+
+async def measure(args, post_ids, token):
+    import asyncpg
+    from app.config import settings
+
+    rng = random.Random(args.seed)
+    connection = await asyncpg.connect(host=settings.database_hostname, port=settings.database_port, user=settings.database_username,
+                                       password=settings.database_password, database=settings.database_name)
+    try:
+        if args.transport == "hub":
+            return await run_hub(args, post_ids, rng, connection)
+        return await run_websocket(args, post_ids, rng, connection, token)
+    finally:
+        await connection.close()
+
+
+def main(args):
+    from app import oauth2
+    from app.config import settings
+
+    admin_database = settings.database_name
+    database = create_database()
+    try:
+        user_id, post_ids = seed(args.posts)
+        token = oauth2.create_token({"user_id": user_id})
+        recorder, published, memory = asyncio.run(measure(args, post_ids, token))
+    finally:
+        drop_database(database, admin_database)
+
+    delivered = sum(recorder.latencies.values())
+    print(f"transport={args.transport} subscribers={args.subscribers} follow={args.follow} posts={args.posts} seconds={args.seconds} "
+          f"flush_ms={settings.live_flush_ms} cpus={os.cpu_count()}")
+    print(f"votes published {published} ({published / args.seconds:.0f}/s), frames received {recorder.frames} "
+          f"({recorder.frames / args.seconds:.0f}/s), counts delivered {delivered}")
+    if delivered:
+        print(f"commit to follower  p50 {recorder.percentile(0.5):.1f} ms  p95 {recorder.percentile(0.95):.1f} ms  "
+              f"p99 {recorder.percentile(0.99):.1f} ms  max {max(recorder.latencies) / 10:.1f} ms")
+    for name, (before, after) in memory.items():
+        if before is not None and after is not None:
+            print(f"rss {name}: {before:.0f} MB -> {after:.0f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.live_fanout")
+    parser.add_argument("--transport", choices=("hub", "websocket"), default="hub")
+    parser.add_argument("--subscribers", type=int, default=10000)
+    parser.add_argument("--follow", type=int, default=5, help="posts each subscriber follows")
+    parser.add_argument("--posts", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=200, help="votes per second")
+    parser.add_argument("--seconds", type=float, default=60)
+    parser.add_argument("--workers", type=int, default=2, help="server workers for --transport websocket")
+    parser.add_argument("--seed", type=int, default=1)
+    main(parser.parse_args())
@@ -0,0 +1,130 @@
+#cost of looking posts up by id alone now that posts is partitioned by month(app/partitions.py)
+#GET /posts/{id}, PUT/DELETE /posts/{id}, the vote_count update and the votes_check_post trigger only know the id, postgres cant
+#tell which month it is in and probes the primary key of every attached partition. compared against the same rows in a plain
+#table and against the lookups that also name created_at(pruned to one partition)
+#the older months are detached step by step, so one seeded database gives the numbers for every partition count
+#usage: python -m benchmarks.partitioned_lookup [--posts 200000] [--months 48,24,12,6,1] [--rounds 200]
+import argparse
+import random
+import statistics
+
+from benchmarks.harness import create_database, drop_database, create_partitions
+
+#{table} is posts or posts_plain, the statements are the ones the app runs, cut down to what matters for the plan
+STATEMENTS = {
+    "GET /posts/{id}": "SELECT p.id, p.title, p.vote_count, u.email, EXISTS (SELECT 1 FROM votes v WHERE v.user_id = p.owner_id AND v.post_id = p.id) "
+                       "FROM {table} p JOIN users u ON u.id = p.owner_id WHERE p.id = :id{created_at}",
+    "vote trigger check": "SELECT 1 FROM {table} p WHERE p.id = :id{created_at} FOR KEY SHARE",
+    "vote_count update": "UPDATE {table} p SET vote_count = p.vote_count WHERE p.id = :id{created_at}",
+}
+
+
+def seed(posts: int, months: int):
+    from sqlalchemy import text
+    from app.database import SessionLocal
+
+    create_partitions(months - 1)
+    db = SessionLocal()
+    try:
+        db.execute(text("INSERT INTO users (email, password) VALUES ('owner@bench.example.com', 'x')"))
+        #spread evenly over the months, newest month included
+        db.execute(text(
+            "INSERT INTO posts (title, content, owner_id, created_at) "
+            "SELECT 'post ' || i, 'benchmark post ' || i, (SELECT min(id) FROM users), "
+            "date_trunc('month', now()) - make_interval(months => (i % :months)) + make_interval(secs => i % 86400) "
+            "FROM generate_series(1, :posts) i"), {"posts": posts, "months": months})
+        #the baseline, the same rows in an unpartitioned table with a primary key on id alone
+        db.execute(text("CREATE TABLE posts_plain AS SELECT id, title, content, owner_id, published, created_at, vote_count FROM posts"))
+        db.execute(text("ALTER TABLE posts_plain ADD PRIMARY KEY (id)"))
+        db.commit()
+        db.execute(text("ANALYZE"))
+        return [tuple(row) for row in db.execute(text("SELECT id, created_at FROM posts ORDER BY created_at DESC LIMIT 1000"))]
+    finally:
+        db.close()
+
+
+def explain(db, statement: str, params: dict, rounds: int):
+    #median planning and execution time in ms, as postgres measures them(no network or driver in it)
+    from sqlalchemy import text
+
+    planning, execution = [], []
+    for _ in range(rounds):
+        plan = db.execute(text(f"EXPLAIN (ANALYZE, FORMAT JSON) {statement}"), params).scalar()[0]
+        db.rollback()   #the UPDATE is really run by EXPLAIN ANALYZE, nothing is kept
+        planning.append(plan["Planning Time"])
+        execution.append(plan["Execution Time"])
+    return statistics.median(planning), statistics.median(execution)
+
+
+def measure(rows, rounds: int, rng: random.Random):
+    from app.database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        results = {}
+        for name, template in STATEMENTS.items():
+            variants = {
+                "plain table": template.format(table="posts_plain", created_at=""),
+                "id only": template.format(table="posts", created_at=""),
+                "id + created_at": template.format(table="posts", created_at=" AND p.created_at = :created_at"),
+            }
+            for variant, statement in variants.items():
+                post_id, created_at = rng.choice(rows)
+                results[name, variant] = explain(db, statement, {"id": post_id, "created_at": created_at}, rounds)
+        return results
+    finally:
+        db.close()
+
+
+def detach_oldest(keep: int):
+    #keeps the last `keep` months up to this one(where the looked up posts are) attached, the months ahead stay like in production
+    from datetime import datetime, timezone
+    from sqlalchemy import text
+    from app import partitions
+    from app.database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        this_month = partitions.month_start(datetime.now(timezone.utc))
+        past = [name for name, month in partitions.list_partitions(db) if month <= this_month]
+        for name in past[:max(len(past) - keep, 0)]:
+            db.execute(text(f"ALTER TABLE posts DETACH PARTITION {name}"))
+        db.commit()
+        return len(partitions.list_partitions(db))
+    finally:
+        db.close()
+
+
+def main(args):
+    from app.config import settings
+
+    rng = random.Random(args.seed)
+    month_counts = sorted({int(months) for months in args.months.split(",")}, reverse=True)
+    admin_database = settings.database_name
+    database = create_database()
+    results = {}
+    try:
+        rows = seed(args.posts, month_counts[0])
+        for months in month_counts:
+            attached = detach_oldest(months)
+            results[attached] = measure(rows, args.rounds, rng)
+    finally:
+        drop_database(database, admin_database)
+
+    print(f"posts={args.posts} rounds={args.rounds}, median planning + execution ms per statement, partitions include the months ahead")
+    for attached, measured in results.items():
+        print(f"\n{attached} partitions attached")
+        print(f"{'':<22} {'plain table':>20} {'id only':>20} {'id + created_at':>20}")
+        for name in STATEMENTS:
+            cells = [f"{planning:.3f} + {execution:.3f}" for planning, execution in
+                     (measured[name, variant] for variant in ("plain table", "id only", "id + created_at"))]
+            print(f"{name:<22} " + " ".join(f"{cell:>20}" for cell in cells))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.partitioned_lookup")
+    parser.add_argument("--posts", type=int, default=200000)
+    parser.add_argument("--months", default="48,24,12,6,1", help="past months kept attached(this month included), measured in this order")
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    main(parser.parse_args())
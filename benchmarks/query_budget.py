@@ -0,0 +1,77 @@
+#CI check for N+1 queries--> every listing is requested with 100 posts(each from a different owner) inside
+#metrics.query_budget, a page that needs more statements than its budget fails the run and prints them
+#usage: python -m benchmarks.query_budget [--posts 500] [--users 200]
+#exits 1 when a budget is exceeded, or when a budget of 0 doesnt fail(then counting is broken and every check would pass)
+import argparse
+import asyncio
+import random
+
+import httpx
+
+from benchmarks.harness import create_database, drop_database, seed
+
+#statements one request may run once the user is cached, the page itself and the voted_by_me lookup
+BUDGETS = {
+    "GET /posts/?limit=100": 2,
+    "GET /posts/?limit=100&cursor={cursor}": 2,
+    "GET /posts/trending?limit=100": 2,
+    "GET /posts/search?q=python&limit=100": 2,
+    "GET /posts/latest": 1,
+    "GET /posts/{post_id}": 1,
+}
+
+
+async def check(user_id, post_ids):
+    from app import metrics, oauth2
+    from app.main import app
+
+    headers = {"Authorization": f"Bearer {oauth2.create_token({'user_id': user_id})}"}
+    failures = []
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://budget") as client:
+        first = await client.get("/posts/?limit=100", headers=headers)   #fills the user cache, logins are not what we measure
+        values = {"cursor": first.headers["X-Next-Cursor"], "post_id": random.choice(post_ids)}
+
+        try:
+            with metrics.query_budget(0):
+                await client.get("/posts/?limit=100", headers=headers)
+            failures.append("a budget of 0 did not fail, the statements of the requests are not being counted")
+        except metrics.QueryBudgetExceeded:
+            pass
+
+        for request, budget in BUDGETS.items():
+            method, path = request.split(" ", 1)
+            try:
+                with metrics.query_budget(budget) as counter:
+                    response = await client.request(method, path.format(**values), headers=headers)
+                status = f"{counter.count} <= {budget}"
+            except metrics.QueryBudgetExceeded as error:
+                failures.append(f"{request}: {error}")
+                status = f"{error.counter.count} >  {budget}  FAILED"
+            if response.status_code != 200:
+                failures.append(f"{request}: status {response.status_code}")
+            print(f"{request:<42} {status}")
+    return failures
+
+
+def main(args):
+    from app.config import settings
+
+    admin_database = settings.database_name
+    database = create_database()
+    try:
+        user_ids, post_ids = seed(args.users, args.posts, args.votes, random.Random(1))
+        settings.feed_cache_enabled = False   #a cached page runs no statements at all
+        failures = asyncio.run(check(user_ids[0], post_ids))
+    finally:
+        drop_database(database, admin_database)
+
+    if failures:
+        raise SystemExit("\n\n".join(failures))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.query_budget")
+    parser.add_argument("--posts", type=int, default=500)
+    parser.add_argument("--users", type=int, default=200, help="post owners, so a page has up to 100 different owners to load")
+    parser.add_argument("--votes", type=int, default=2000)
+    main(parser.parse_args())
@@ -0,0 +1,96 @@
+#full text search on a large table, the websearch_to_tsquery match on the GIN indexed search_vector(GET /posts/search)
+#against the substring scan it replaced(title or content ILIKE '%word%', every row read and pattern matched)
+#queried for a common word(a quarter of the posts), a rare one(0.1%), one in a handful of posts and one no post has,
+#with the owner joined like the route
+#usage: python -m benchmarks.search [--posts 1000000] [--rounds 5]
+import argparse
+import statistics
+import time
+
+from benchmarks.harness import create_database, drop_database, create_partitions
+
+WORDS = "python fastapi postgres cache votes feed search latency index async"
+TOPICS = 1000   #rare words topic1..topic1000, each post gets one(topic999 is no other topic's prefix, so ILIKE finds the same posts)
+
+#the statements the app runs(full text) and ran(ILIKE), cut down to what matters for the plan
+STATEMENTS = {
+    "GIN tsvector": "SELECT p.id, p.title, u.email, ts_rank_cd(p.search_vector, q) AS rank "
+                    "FROM posts p JOIN users u ON u.id = p.owner_id, websearch_to_tsquery('english', :word) q "
+                    "WHERE p.search_vector @@ q ORDER BY rank DESC, p.id DESC LIMIT :limit",
+    "ILIKE scan": "SELECT p.id, p.title, u.email FROM posts p JOIN users u ON u.id = p.owner_id "
+                  "WHERE p.title ILIKE :pattern OR p.content ILIKE :pattern ORDER BY p.created_at DESC, p.id DESC LIMIT :limit",
+}
+
+
+def seed(posts: int):
+    from sqlalchemy import text
+    from app.database import SessionLocal
+
+    create_partitions(1)   #the last 30 days reach into last month
+    db = SessionLocal()
+    try:
+        db.execute(text("INSERT INTO users (email, password) SELECT 'user' || i || '@bench.example.com', 'x' FROM generate_series(1, 1000) i"))
+        #three common words per post(each word in about a quarter of the posts), one rare topic word and a zeppelin in every 200000th
+        db.execute(text(
+            "INSERT INTO posts (title, content, owner_id, created_at) "
+            "SELECT 'post ' || i || ' about ' || w[1 + i % 10], "
+            "repeat(w[1 + (i / 10) % 10] || ' ' || w[1 + (i / 100) % 10] || ' topic' || (1 + (i::bigint * 7919) % :topics) || ' ', 5) "
+            "|| CASE WHEN i % 200000 = 0 THEN 'zeppelin' ELSE '' END, "
+            "(SELECT min(id) FROM users) + i % 1000, now() - random() * interval '30 days' "
+            "FROM generate_series(1, :posts) i, string_to_array(:words, ' ') w"),
+            {"posts": posts, "words": WORDS, "topics": TOPICS})
+        db.commit()
+        db.execute(text("ANALYZE"))
+    finally:
+        db.close()
+
+
+def measure(word: str, rounds: int, limit: int):
+    #median wall time of the statement in ms, and how many posts match at all
+    from sqlalchemy import text
+    from app.database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        params = {"word": word, "pattern": f"%{word}%", "limit": limit}
+        matches = db.execute(text("SELECT count(*) FROM posts WHERE search_vector @@ websearch_to_tsquery('english', :word)"), params).scalar()
+        results = {}
+        for name, statement in STATEMENTS.items():
+            db.execute(text(statement), params).all()   #warm the cache, the first read of a cold table is the disk, not the plan
+            timings = []
+            for _ in range(rounds):
+                started = time.perf_counter()
+                db.execute(text(statement), params).all()
+                timings.append(time.perf_counter() - started)
+            results[name] = statistics.median(timings) * 1000
+        return matches, results
+    finally:
+        db.close()
+
+
+def main(args):
+    from app.config import settings
+
+    admin_database = settings.database_name
+    database = create_database()
+    try:
+        started = time.perf_counter()
+        seed(args.posts)
+        print(f"seeded {args.posts} posts in {time.perf_counter() - started:.1f}s")
+        results = {word: measure(word, args.rounds, args.limit) for word in ("python", "topic999", "zeppelin", "quixotic")}
+    finally:
+        drop_database(database, admin_database)
+
+    print(f"posts={args.posts} limit={args.limit} rounds={args.rounds}, median ms per query")
+    print(f"{'word':<10} {'matches':>8} " + " ".join(f"{name:>13}" for name in STATEMENTS) + f" {'speedup':>8}")
+    for word, (matches, timings) in results.items():
+        cells = " ".join(f"{timings[name]:>13.2f}" for name in STATEMENTS)
+        print(f"{word:<10} {matches:>8} {cells} {timings['ILIKE scan'] / timings['GIN tsvector']:>7.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.search")
+    parser.add_argument("--posts", type=int, default=1_000_000)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=5)
+    main(parser.parse_args())
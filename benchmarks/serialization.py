@@ -0,0 +1,90 @@
+#cost of turning one feed page(PostOut rows) into response bytes, no database or http involved
+#usage: python -m benchmarks.serialization [--page-size 100] [--rounds 2000]
+import argparse
+import asyncio
+import time
+from datetime import datetime, timezone
+from typing import List
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_model_field
+from pydantic import TypeAdapter
+from app import models, schemas, serialization
+
+
+class Row:
+    #stands in for a sqlalchemy result row of select(Post, votes)
+    def __init__(self, post, votes):
+        self.Post = post
+        self.votes = votes
+
+
+def make_page(page_size: int):
+    owner = models.User(id=1, email="owner@example.com", password="x", created_at=datetime.now(timezone.utc))
+    rows = []
+    for i in range(page_size):
+        post = models.Post(id=i, title=f"post {i}", content="lorem ipsum " * 20, published=True,
+                           created_at=datetime.now(timezone.utc), owner_id=owner.id, vote_count=i)
+        post.owner = owner
+        rows.append(Row(post, i))
+    return rows
+
+
+async def fastapi_response_model(rows, field):
+    #what a route with response_model=List[PostOut] did before: validate, dump to python, then the stdlib json encoder
+    content = await serialize_response(field=field, response_content=rows, is_coroutine=True)
+    return JSONResponse(content).body
+
+
+def pydantic_json(rows, adapter):
+    #validate, then let pydantic write the json(the first feed cache version)
+    return adapter.dump_json(adapter.validate_python(rows))
+
+
+def direct(rows):
+    return serialization.dump_post_out_list(rows)
+
+
+def cached_overlay(items, post_ids, voted):
+    #a cached feed page answered for one user, only voted_by_me gets added
+    return serialization.join_post_out_items(items, post_ids, voted)
+
+
+def measure(fn, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - started) / rounds
+
+
+def main(args):
+    rows = make_page(args.page_size)
+    field = create_model_field(name="Response", type_=List[schemas.PostOut], mode="serialization")
+    adapter = TypeAdapter(List[schemas.PostOut])
+    loop = asyncio.new_event_loop()
+
+    assert direct(rows) == pydantic_json(rows, adapter)   #the fast path has to produce the same bytes
+    items, post_ids = serialization.dump_post_out_items(rows), [row.Post.id for row in rows]
+    voted = set(post_ids[::3])
+    assert cached_overlay(items, post_ids, voted) == serialization.dump_post_out_list(rows, voted)
+
+    cases = [
+        ("response_model + json", lambda: loop.run_until_complete(fastapi_response_model(rows, field))),
+        ("pydantic validate + dump_json", lambda: pydantic_json(rows, adapter)),
+        ("direct rows + orjson", lambda: direct(rows)),
+        ("cached page + voted_by_me", lambda: cached_overlay(items, post_ids, voted)),
+    ]
+    baseline = None
+    print(f"page_size={args.page_size} rounds={args.rounds}")
+    for name, fn in cases:
+        fn()   #warm up
+        seconds = measure(fn, args.rounds)
+        baseline = baseline or seconds
+        print(f"{name:<32} {seconds * 1e6:>9.1f} us/page {baseline / seconds:>6.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.serialization")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=2000)
+    main(parser.parse_args())
@@ -0,0 +1,107 @@
+#query plan regression check for GET /posts/{id}--> the exact statement the route runs(post.single_post_query) is EXPLAINed
+#while the tables grow, every scan of posts, users and votes in the plan has to go through their primary key
+#a sequential scan(a dropped index, a filter that stopped using the key) fails the run
+#usage: python -m benchmarks.single_post_plan [--sizes 10000,100000,1000000] [--months 12]
+#exits 1 when a plan at any size isnt index lookups only
+import argparse
+
+from benchmarks.harness import create_database, drop_database, create_partitions
+
+#relation--> the index its scans must use, posts partitions are named posts_yYYYYmMM with their own primary key each
+PRIMARY_KEYS = {"users": "users_pkey", "votes": "votes_pkey"}
+INDEX_SCANS = ("Index Scan", "Index Only Scan", "Bitmap Heap Scan")
+
+
+def grow(db, total: int, months: int):
+    #users and votes grow with the posts(one user per 10 posts, one vote per post), with a handful of users any plan is cheap
+    from sqlalchemy import text
+
+    current = db.execute(text("SELECT count(*) FROM posts")).scalar()
+    users = db.execute(text("SELECT count(*) FROM users")).scalar()
+    db.execute(text("INSERT INTO users (email, password) SELECT 'user' || i || '@bench.example.com', 'x' FROM generate_series(:start, :end) i"),
+               {"start": users + 1, "end": max(total // 10, users)})
+    #spread over the months, a lookup has to find its post whichever partition it is in
+    db.execute(text(
+        "INSERT INTO posts (title, content, owner_id, created_at) "
+        "SELECT 'post ' || i, 'plan check post ' || i, u.first + i % u.total, "
+        "date_trunc('month', now()) - make_interval(months => (i % :months)) + make_interval(secs => i % 86400) "
+        "FROM generate_series(:start, :end) i, (SELECT min(id) AS first, count(*) AS total FROM users) u"),
+        {"start": current + 1, "end": total, "months": months})
+    db.execute(text("SET session_replication_role = replica"))   #skips the votes_check_post trigger, the posts are there
+    db.execute(text("INSERT INTO votes (user_id, post_id) SELECT owner_id, id FROM posts ON CONFLICT DO NOTHING"))
+    db.execute(text("RESET session_replication_role"))
+    db.commit()
+    db.execute(text("ANALYZE"))
+
+
+def scans(node):
+    #(node, index it reads through) for every node of the plan that reads a table
+    if "Relation Name" in node:
+        index = node.get("Index Name")
+        if node["Node Type"] == "Bitmap Heap Scan":   #the index is on its Bitmap Index Scan child
+            index = node["Plans"][0].get("Index Name")
+        yield node, index
+    for child in node.get("Plans", []):
+        yield from scans(child)
+
+
+def check_plan(db, post_id: int, user_id: int):
+    #returns the problems found in the plan, empty when it only does primary key lookups
+    from sqlalchemy import text
+    from sqlalchemy.dialects import postgresql
+    from app.routers.post import single_post_query
+
+    compiled = single_post_query(post_id, user_id).compile(dialect=postgresql.psycopg2.dialect())
+    cursor = db.connection().connection.cursor()
+    cursor.execute(f"EXPLAIN (FORMAT JSON) {compiled.string}", compiled.params)
+    plan = cursor.fetchone()[0][0]["Plan"]
+    db.rollback()
+
+    #empty tables(the months ahead) are read with a sequential scan of nothing, that is fine
+    empty = set(db.execute(text("SELECT relname FROM pg_class WHERE relkind = 'r' AND reltuples < 1")).scalars())
+    problems = []
+    for node, index in scans(plan):
+        relation = node["Relation Name"]
+        expected = f"{relation}_pkey" if relation.startswith("posts_y") else PRIMARY_KEYS.get(relation)
+        if relation not in empty and (node["Node Type"] not in INDEX_SCANS or index != expected):
+            problems.append(f"{node['Node Type']} on {relation}({index or 'no index'}), expected an index scan on {expected}")
+    if not any(node["Relation Name"].startswith("posts_y") for node, _ in scans(plan)):
+        problems.append("the plan doesnt read posts at all")
+    return problems
+
+
+def main(args):
+    from sqlalchemy import text
+    from app.config import settings
+
+    admin_database = settings.database_name
+    database = create_database()
+    failures = []
+    try:
+        from app.database import SessionLocal
+
+        create_partitions(args.months - 1)
+        db = SessionLocal()
+        try:
+            for size in sorted(int(size) for size in args.sizes.split(",")):
+                grow(db, size, args.months)
+                user_id = db.execute(text("SELECT min(id) FROM users")).scalar()
+                #the newest and the oldest post, the first and the last partition
+                for post_id in db.execute(text("SELECT max(id), min(id) FROM posts")).one():
+                    problems = check_plan(db, post_id, user_id)
+                    print(f"{size:>9} posts  post {post_id:<9} {'ok' if not problems else 'FAILED'}")
+                    failures.extend(f"{size} posts, post {post_id}: {problem}" for problem in problems)
+        finally:
+            db.close()
+    finally:
+        drop_database(database, admin_database)
+
+    if failures:
+        raise SystemExit("\n".join(failures))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.single_post_plan")
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="posts in the table at each check")
+    parser.add_argument("--months", type=int, default=12, help="months the posts are spread over(one partition each)")
+    main(parser.parse_args())
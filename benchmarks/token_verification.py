@@ -0,0 +1,59 @@
+#cost of checking a bearer token, what every protected request pays, with and without oauth2.token_cache
+#uncached--> what verify__access_token runs on a miss(signature check, claims, TokenData), cached--> the real function on a hit
+#the app signs with SECRET_KEY(HS256 by default), RS256 and ES256 are here for deployments that would verify with a public key,
+#a cache hit costs the same whatever the algorithm
+#usage: python -m benchmarks.token_verification [--rounds 20000]
+import argparse
+import hashlib
+import time
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from fastapi import HTTPException
+
+from app import oauth2, schemas
+
+
+def keys():
+    #algorithm--> (signing key, verification key)
+    rsa_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    ec_key = ec.generate_private_key(ec.SECP256R1())
+    return {
+        "HS256": ("benchmark-secret-" * 4, "benchmark-secret-" * 4),
+        "RS256": (rsa_key, rsa_key.public_key()),
+        "ES256": (ec_key, ec_key.public_key()),
+    }
+
+
+def uncached(token, key, algorithm):
+    payload = jwt.decode(token, key, algorithms=[algorithm])
+    return schemas.TokenData(id=payload.get("user_id"))
+
+
+def measure(fn, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - started) / rounds
+
+
+def main(args):
+    invalid = HTTPException(status_code=401)
+    oauth2.verify__access_token(oauth2.create_token({"user_id": 1}), invalid)   #token_cache is created by the first verification
+    print(f"rounds={args.rounds}, microseconds per verification")
+    print(f"{'algorithm':<10} {'uncached':>9} {'cached':>9} {'speedup':>8}")
+    for algorithm, (signing_key, verification_key) in keys().items():
+        token = jwt.encode({"user_id": 1, "exp": time.time() + 3600}, signing_key, algorithm=algorithm)
+        token_data = uncached(token, verification_key, algorithm)
+        #the entry verify__access_token stores after a successful decode
+        oauth2.token_cache.set(hashlib.sha256(token.encode()).hexdigest(), token_data)
+
+        miss = measure(lambda: uncached(token, verification_key, algorithm), args.rounds)
+        hit = measure(lambda: oauth2.verify__access_token(token, invalid), args.rounds)
+        print(f"{algorithm:<10} {miss * 1e6:>9.1f} {hit * 1e6:>9.1f} {miss / hit:>7.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.token_verification")
+    parser.add_argument("--rounds", type=int, default=20000)
+    main(parser.parse_args())
@@ -0,0 +1,159 @@
+#GET /posts/trending on a large table with skewed votes(a few posts get most of them), with and without ix_post_scores_hot_score_post_id
+#without the index every page is the old way of ranking: score every post, sort, keep the top `limit`
+#also measures vote writes--> votes/s, WAL records per vote and the share of posts updates that were HOT(touched no index),
+#the post_scores row is updated by a trigger in the same transaction as vote_count
+#usage: python -m benchmarks.trending [--posts 1000000] [--users 1000] [--rounds 50] [--votes 2000]
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+import httpx
+
+from benchmarks.harness import create_database, drop_database, create_partitions
+
+
+def seed(posts: int, users: int):
+    from sqlalchemy import text
+    from app import utils
+    from app.database import SessionLocal
+
+    create_partitions(1)   #the last 30 days reach into last month
+    db = SessionLocal()
+    try:
+        db.execute(text("INSERT INTO users (email, password) SELECT 'user' || i || '@bench.example.com', :password FROM generate_series(1, :users) i"),
+                   {"password": utils.hashing("benchmark"), "users": users})
+        #posts spread over the last 30 days, votes follow a power law: most posts have 0-1 votes, a handful have thousands
+        #about 80 words each, the search and trigram indexes get as many entries per post as real posts give them
+        db.execute(text(
+            "INSERT INTO posts (title, content, owner_id, created_at, vote_count) "
+            "SELECT 'post ' || i || ' about ' || substr(md5(i::text), 1, 8), "
+            "(SELECT string_agg(substr(md5((i * 100 + j)::text), 1, 7), ' ') FROM generate_series(1, 80) j), "
+            "(SELECT min(id) FROM users) + i % :users, now() - random() * interval '30 days', "
+            "floor(power(random(), 12) * 5000) FROM generate_series(1, :posts) i"), {"posts": posts, "users": users})
+        db.commit()
+        db.execute(text("ANALYZE"))
+        user_id = db.execute(text("SELECT min(id) FROM users")).scalar()
+        post_ids = db.execute(text("SELECT id FROM posts ORDER BY vote_count DESC")).scalars().all()
+        return user_id, post_ids
+    finally:
+        db.close()
+
+
+def set_index(enabled: bool):
+    from sqlalchemy import text
+    from app.database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        if enabled:
+            db.execute(text("CREATE INDEX IF NOT EXISTS ix_post_scores_hot_score_post_id ON post_scores (hot_score DESC, post_id DESC)"))
+        else:
+            db.execute(text("DROP INDEX IF EXISTS ix_post_scores_hot_score_post_id"))
+        db.commit()
+        db.execute(text("ANALYZE post_scores"))
+    finally:
+        db.close()
+
+
+async def time_pages(client, headers, rounds: int, limit: int, depth: int):
+    #first page, and the page `depth` pages down reached by following the cursors
+    first, deep = [], []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        response = await client.get(f"/posts/trending?limit={limit}", headers=headers)
+        first.append(time.perf_counter() - started)
+        assert response.status_code == 200, response.text
+
+    cursor = response.headers["X-Next-Cursor"]
+    for _ in range(depth - 2):
+        cursor = (await client.get(f"/posts/trending?limit={limit}&cursor={cursor}", headers=headers)).headers["X-Next-Cursor"]
+    for _ in range(rounds):
+        started = time.perf_counter()
+        response = await client.get(f"/posts/trending?limit={limit}&cursor={cursor}", headers=headers)
+        deep.append(time.perf_counter() - started)
+        assert response.status_code == 200, response.text
+    return statistics.median(first), statistics.median(deep)
+
+
+def write_stats():
+    #(WAL records written by the server so far, updates of posts rows, HOT ones among them)
+    #a record is one change to one page, a heap row or an index entry, so unlike WAL bytes it doesnt depend on where checkpoints fall
+    from sqlalchemy import text
+    from app.database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        return db.execute(text("SELECT (SELECT wal_records FROM pg_stat_wal), coalesce(sum(n_tup_upd), 0), coalesce(sum(n_tup_hot_upd), 0) "
+                               "FROM pg_stat_user_tables WHERE relname LIKE 'posts_y%'")).one()
+    finally:
+        db.close()
+
+
+async def time_votes(user_count: int, post_ids, votes: int, rng: random.Random):
+    #single vote transactions through the same code as POST /votes/, hot posts(the start of post_ids) get most of them
+    #returns votes/s, WAL records per vote and the share of HOT posts updates
+    from app import database, voting
+
+    weights = [1 / (rank + 1) for rank in range(len(post_ids))]
+    targets = rng.choices(post_ids, weights=weights, k=votes)
+    wal_before, updates_before, hot_before = write_stats()
+    started = time.perf_counter()
+    async with database.open_session(database.primary_sessionmaker()) as db:
+        for post_id in targets:
+            await voting.apply_votes(db, [(rng.randint(1, user_count), post_id, 1)])
+            await db.commit()
+    elapsed = time.perf_counter() - started
+    await database.dispose_engines()   #an idle backend may hold back its statistics for a while, one that exits reports them
+    await asyncio.sleep(0.5)
+    wal_after, updates_after, hot_after = write_stats()
+    return votes / elapsed, (wal_after - wal_before) / votes, (hot_after - hot_before) / max(updates_after - updates_before, 1)
+
+
+async def measure(args, user_id, post_ids, rng):
+    from app import oauth2
+    from app.main import app
+
+    headers = {"Authorization": f"Bearer {oauth2.create_token({'user_id': user_id})}"}
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark") as client:
+        first, deep = await time_pages(client, headers, args.rounds, args.limit, args.depth)
+    return (first, deep, *await time_votes(args.users, post_ids, args.votes, rng))
+
+
+def main(args):
+    from app.config import settings
+
+    rng = random.Random(args.seed)
+    admin_database = settings.database_name
+    database = create_database()
+    try:
+        started = time.perf_counter()
+        user_id, post_ids = seed(args.posts, args.users)
+        print(f"seeded {args.posts} posts in {time.perf_counter() - started:.1f}s")
+        settings.feed_cache_enabled = False   #measure the query, not the response cache
+
+        results = {}
+        for indexed in (True, False):
+            set_index(indexed)
+            results[indexed] = asyncio.run(measure(args, user_id, post_ids, rng))
+    finally:
+        drop_database(database, admin_database)
+
+    print(f"posts={args.posts} limit={args.limit} rounds={args.rounds} database_mode={settings.database_mode}")
+    print(f"{'':<33} {'page 1':>10} {f'page {args.depth}':>10} {'votes/s':>9} {'WAL records/vote':>17} {'HOT':>5}")
+    for indexed, label in ((False, "sort every post"), (True, "ix_post_scores_hot_score_post_id")):
+        first, deep, votes_per_second, wal_per_vote, hot = results[indexed]
+        print(f"{label:<33} {first * 1000:>7.2f} ms {deep * 1000:>7.2f} ms {votes_per_second:>9.1f} {wal_per_vote:>17.1f} {hot:>5.0%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.trending")
+    parser.add_argument("--posts", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--depth", type=int, default=50, help="page number of the deep page, reached by following cursors")
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--votes", type=int, default=2000, help="single vote transactions for the write measurement")
+    parser.add_argument("--seed", type=int, default=1)
+    main(parser.parse_args())
@@ -0,0 +1,111 @@
+#votes/sec through POST /votes/ (one vote per request, with and without the vote buffer) and POST /votes/batch
+#runs the app in-process against the database from .env, the rows it creates are deleted at the end
+#usage: python -m benchmarks.vote_throughput [--users 100] [--posts 20] [--concurrency 50] [--batch-size 20]
+import argparse
+import asyncio
+import os
+import time
+import uuid
+import httpx
+
+#one user votes far faster than POST /votes/ allows and --concurrency may be above the admission limit, measure the vote path itself
+os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+os.environ.setdefault("ADMISSION_MAX_CONCURRENT", "-1")
+from app.main import app
+from app import models, oauth2, utils
+from app.config import settings
+from app.database import SessionLocal
+
+
+def seed(users: int, posts: int):
+    db = SessionLocal()
+    try:
+        password = utils.hashing("benchmark")   #hashed once, argon2 for every user would dominate the setup time
+        run = uuid.uuid4().hex[:8]
+        user_rows = [models.User(email=f"bench-{run}-{i}@example.com", password=password) for i in range(users)]
+        db.add_all(user_rows)
+        db.flush()
+        #a few hot posts, the case where every vote contends on the same posts rows
+        post_rows = [models.Post(title=f"benchmark {i}", content="benchmark", owner_id=user_rows[0].id) for i in range(posts)]
+        db.add_all(post_rows)
+        db.commit()
+        return [user.id for user in user_rows], [post.id for post in post_rows]
+    finally:
+        db.close()
+
+
+def cleanup(user_ids):
+    db = SessionLocal()
+    try:
+        #posts and votes go with their users(ON DELETE CASCADE)
+        db.query(models.User).filter(models.User.id.in_(user_ids)).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+async def run_single(client, headers, posts, direction, concurrency):
+    #every user votes on every post, one request per vote
+    jobs = [(user_headers, post_id) for user_headers in headers for post_id in posts]
+    limit = asyncio.Semaphore(concurrency)
+
+    async def one(user_headers, post_id):
+        async with limit:
+            response = await client.post("/votes/", json={"posts_id": post_id, "dir": direction}, headers=user_headers)
+            assert response.status_code == 201, response.text
+
+    started = time.perf_counter()
+    await asyncio.gather(*[one(user_headers, post_id) for user_headers, post_id in jobs])
+    return len(jobs), time.perf_counter() - started
+
+
+async def run_batch(client, headers, posts, direction, concurrency, batch_size):
+    #each user sends its votes in batches of batch_size
+    requests = []
+    for user_headers in headers:
+        votes = [{"posts_id": post_id, "dir": direction} for post_id in posts]
+        for start in range(0, len(votes), batch_size):
+            requests.append((user_headers, votes[start:start + batch_size]))
+    limit = asyncio.Semaphore(concurrency)
+
+    async def one(user_headers, votes):
+        async with limit:
+            response = await client.post("/votes/batch", json={"votes": votes}, headers=user_headers)
+            assert response.status_code == 200, response.text
+
+    started = time.perf_counter()
+    await asyncio.gather(*[one(user_headers, votes) for user_headers, votes in requests])
+    return sum(len(votes) for _, votes in requests), time.perf_counter() - started
+
+
+async def main(args):
+    user_ids, post_ids = seed(args.users, args.posts)
+    headers = [{"Authorization": f"Bearer {oauth2.create_token({'user_id': user_id})}"} for user_id in user_ids]
+    results = []
+    try:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            for name, buffered in (("single", False), ("single+buffer", True)):
+                settings.vote_buffer_enabled = buffered
+                for direction in (1, 0):   #vote then unvote so the next run starts from no votes again
+                    count, seconds = await run_single(client, headers, post_ids, direction, args.concurrency)
+                    results.append((f"{name} dir={direction}", count, seconds))
+            settings.vote_buffer_enabled = False
+            for direction in (1, 0):
+                count, seconds = await run_batch(client, headers, post_ids, direction, args.concurrency, args.batch_size)
+                results.append((f"batch dir={direction}", count, seconds))
+    finally:
+        cleanup(user_ids)
+
+    print(f"database_mode={settings.database_mode} users={args.users} posts={args.posts} concurrency={args.concurrency}")
+    for name, count, seconds in results:
+        print(f"{name:<22} {count:>7} votes {seconds:>8.2f}s {count / seconds:>10.0f} votes/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.vote_throughput")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--posts", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=20)
+    asyncio.run(main(parser.parse_args()))